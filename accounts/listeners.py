@@ -2,3 +2,7 @@ def profile_changed(sender, instance, **kwargs):
     from accounts.services import UserService
     UserService.invalidate_profile(instance.user_id)
 
+
+def profile_saved(sender, instance, **kwargs):
+    from accounts.services import UserService
+    UserService.refresh_profile(instance, kwargs.get('update_fields'))
@@ -1,8 +1,8 @@
-from accounts.listeners import profile_changed
+from accounts.listeners import profile_changed, profile_saved
 from django.contrib.auth.models import User
 from django.db import models
 from django.db.models.signals import pre_delete, post_save
-from utils.listeners import invalidate_object_cache
+from utils.listeners import invalidate_object_cache, refresh_object_cache
 
 
 class UserProfile(models.Model):
@@ -10,6 +10,8 @@ class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.SET_NULL, null=True)
     avatar = models.FileField(null=True)
     nickname = models.CharField(null=True, max_length=200)
+    # written in batches from redis, see UserService.flush_last_seen
+    last_seen_at = models.DateTimeField(null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -30,7 +32,7 @@ User.profile = property(get_profile)
 
 # hook up with listeners to invalidate cache
 pre_delete.connect(invalidate_object_cache, sender=User)
-post_save.connect(invalidate_object_cache, sender=User)
+post_save.connect(refresh_object_cache, sender=User)
 
 pre_delete.connect(profile_changed, sender=UserProfile)
-post_save.connect(profile_changed, sender=UserProfile)
\ No newline at end of file
+post_save.connect(profile_saved, sender=UserProfile)
\ No newline at end of file
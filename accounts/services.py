@@ -1,29 +1,138 @@
+import time
+
 from accounts.models import UserProfile
 from django.conf import settings
+from django.contrib.auth.models import User
 from django.core.cache import caches
-from twitter.cache import USER_PROFILE_PATTERN
+from twitter.cache import USER_LAST_SEEN_FLUSHING_KEY, USER_LAST_SEEN_KEY, USER_PROFILE_PATTERN
+from utils.cache_generations import CacheGenerations
+from utils.cache_metrics import CacheMetrics
+from utils.early_refresh import EarlyRefresh
+from utils.local_cache import LocalCache
+from utils.memcached_helper import MemcachedHelper
+from utils.redis_client import RedisClient
+from utils.request_cache import RequestCache
+from utils.time_helpers import from_microseconds, to_microseconds, utc_now
 
 cache = caches['testing'] if settings.TESTING else caches['default']
+# users remembered by UserService.touch in each process
+MAX_TOUCHED_USERS = 100000
 
 class UserService:
+    # user id -> time.monotonic() when this process last recorded the user as seen
+    _touched = {}
 
     # keep this method because we need to get or create profile, different from get tweet
     @classmethod
     def get_profile_through_cache(cls, user_id):
-        key = USER_PROFILE_PATTERN.format(user_id=user_id)
+        key = CacheGenerations.get_pattern_key(USER_PROFILE_PATTERN, user_id=user_id)
+        pattern = CacheMetrics.get_pattern(key)
 
-        # read from cache first
-        profile = cache.get(key)
-        # cache hit return
+        # already loaded in this request
+        profile = RequestCache.get(key)
+        if profile is not None:
+            CacheMetrics.hit(pattern, 'request')
+            return profile
+
+        # process local cache
+        profile = LocalCache.get(key)
         if profile is not None:
+            CacheMetrics.hit(pattern, 'local')
+            RequestCache.set(key, profile)
+            return profile
+
+        # read from cache first
+        with CacheMetrics.time_round_trip(pattern, 'memcached'):
+            profile, refresh = EarlyRefresh.unwrap(MemcachedHelper.cache_get(pattern, key))
+        # cache hit return, unless this reader was picked to refresh it early
+        if profile is not None and not refresh:
+            CacheMetrics.hit(pattern, 'memcached')
+            LocalCache.set(key, profile)
+            RequestCache.set(key, profile)
             return profile
 
         # cache miss, read from db
-        profile, _ = UserProfile.objects.get_or_create(user_id=user_id)
-        cache.set(key, profile)
+        CacheMetrics.miss(pattern)
+        with CacheMetrics.time_fill(pattern):
+            start = time.perf_counter()
+            profile, _ = UserProfile.objects.get_or_create(user_id=user_id)
+            delta = time.perf_counter() - start
+            MemcachedHelper.cache_set(
+                pattern, key, *EarlyRefresh.wrap(profile, delta, cache.default_timeout),
+            )
+        LocalCache.set(key, profile)
+        RequestCache.set(key, profile)
         return profile
 
+    @classmethod
+    def refresh_profile(cls, profile, update_fields=None):
+        keys = CacheGenerations.get_pattern_invalidation_keys(
+            USER_PROFILE_PATTERN, user_id=profile.user_id,
+        )
+        if not MemcachedHelper.write_through(keys, profile, update_fields):
+            MemcachedHelper.invalidate_keys(keys)
+
     @classmethod
     def invalidate_profile(cls, user_id):
-        key = USER_PROFILE_PATTERN.format(user_id=user_id)
-        cache.delete(key)
+        MemcachedHelper.invalidate_deleted_keys(CacheGenerations.get_pattern_invalidation_keys(
+            USER_PROFILE_PATTERN, user_id=user_id,
+        ))
+
+    @classmethod
+    def touch(cls, user_id):
+        # record that the user is active, at most once per USER_ACTIVITY_TOUCH_INTERVAL
+        # in each process. flush_last_seen writes it to db in batches.
+        # returns whether it was recorded
+        now = time.monotonic()
+        touched_at = cls._touched.get(user_id)
+        if touched_at is not None and now - touched_at < settings.USER_ACTIVITY_TOUCH_INTERVAL:
+            return False
+        if len(cls._touched) >= MAX_TOUCHED_USERS:
+            cls._touched.clear()
+        cls._touched[user_id] = now
+        RedisClient.get_connection().hset(USER_LAST_SEEN_KEY, user_id, to_microseconds(utc_now()))
+        return True
+
+    @classmethod
+    def flush_last_seen(cls, before_write=None):
+        # write the last seen times recorded since the previous flush to the profiles,
+        # one bulk update. returns {user_id: last_seen_at before this flush}.
+        # before_write(previous_last_seen) is called before the profiles are written,
+        # e.g. to queue the work that needs the previous times. the recorded times stay
+        # in redis until the profiles are written, a flush that died is done again
+        conn = RedisClient.get_connection()
+        # unless the previous flush died, take the recorded times
+        if conn.exists(USER_LAST_SEEN_KEY):
+            conn.renamenx(USER_LAST_SEEN_KEY, USER_LAST_SEEN_FLUSHING_KEY)
+        last_seen = {
+            int(user_id): from_microseconds(int(microseconds))
+            for user_id, microseconds in conn.hgetall(USER_LAST_SEEN_FLUSHING_KEY).items()
+        }
+        if not last_seen:
+            return {}
+
+        profiles = list(UserProfile.objects.filter(user_id__in=last_seen.keys()))
+        previous_last_seen = {profile.user_id: profile.last_seen_at for profile in profiles}
+        # users who have never read their profile have none yet
+        missing_ids = list(User.objects.filter(
+            id__in=set(last_seen.keys()) - set(previous_last_seen.keys()),
+        ).values_list('id', flat=True))
+        for user_id in missing_ids:
+            previous_last_seen[user_id] = None
+        if before_write is not None:
+            before_write(previous_last_seen)
+
+        for profile in profiles:
+            profile.last_seen_at = last_seen[profile.user_id]
+        UserProfile.objects.bulk_update(profiles, ['last_seen_at'])
+        UserProfile.objects.bulk_create([
+            UserProfile(user_id=user_id, last_seen_at=last_seen[user_id])
+            for user_id in missing_ids
+        ])
+        conn.delete(USER_LAST_SEEN_FLUSHING_KEY)
+        return previous_last_seen
+
+    @classmethod
+    def clear_touched(cls):
+        # forget who this process recorded, for testing purpose
+        cls._touched.clear()
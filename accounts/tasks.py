@@ -0,0 +1,31 @@
+from celery import shared_task
+
+from accounts.services import UserService
+from utils.time_constants import ONE_HOUR
+from utils.time_helpers import to_microseconds
+
+
+# last seen times are recorded in redis by UserActivityMiddleware,
+# this periodic task writes them to the profiles
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def flush_user_last_seen_task():
+    # import inside the function to avoid circle dependency
+    from newsfeeds.services import NewsFeedService
+    from newsfeeds.tasks import rebuild_newsfeeds_task
+
+    rebuilds = []
+
+    def queue_rebuilds(previous_last_seen):
+        # queued before the new times are written, once they are the users are not
+        # dormant anymore. a flush that dies after this queues them again, rebuilding
+        # twice is harmless
+        for user_id, last_seen_at in previous_last_seen.items():
+            # nothing was fanned out to them while they were dormant
+            if not NewsFeedService.is_dormant(last_seen_at):
+                continue
+            since = to_microseconds(last_seen_at) if last_seen_at is not None else None
+            rebuild_newsfeeds_task.delay(user_id, since)
+            rebuilds.append(user_id)
+
+    previous_last_seen = UserService.flush_last_seen(before_write=queue_rebuilds)
+    return '{} users seen, {} newsfeeds to rebuild.'.format(len(previous_last_seen), len(rebuilds))
@@ -1,6 +1,10 @@
 # Create your tests here.
 from accounts.models import UserProfile
+from accounts.services import UserService
+from accounts.tasks import flush_user_last_seen_task
 from testing.testcases import TestCase
+from twitter.cache import USER_LAST_SEEN_FLUSHING_KEY, USER_LAST_SEEN_KEY
+from utils.redis_client import RedisClient
 
 
 class UserProfileTests(TestCase):
@@ -14,3 +18,53 @@ class UserProfileTests(TestCase):
         profile = user1.profile
         self.assertEqual(isinstance(profile, UserProfile), True)
         self.assertEqual(UserProfile.objects.count(), 1)
+
+
+class UserActivityTests(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+
+    def test_touch_and_flush(self):
+        user1, client = self.create_user_and_client('user1')
+        user2 = self.create_user('user2')
+        user2.profile
+
+        # recorded by the middleware
+        client.get('/api/newsfeeds/')
+        conn = RedisClient.get_connection()
+        self.assertEqual(conn.hexists(USER_LAST_SEEN_KEY, user1.id), True)
+        # at most once per USER_ACTIVITY_TOUCH_INTERVAL
+        self.assertEqual(UserService.touch(user1.id), False)
+        self.assertEqual(UserService.touch(user2.id), True)
+
+        self.assertEqual(flush_user_last_seen_task(), '2 users seen, 0 newsfeeds to rebuild.')
+        self.assertEqual(conn.exists(USER_LAST_SEEN_KEY), False)
+        profile1 = UserProfile.objects.get(user=user1)
+        profile2 = UserProfile.objects.get(user=user2)
+        self.assertNotEqual(profile1.last_seen_at, None)
+        self.assertNotEqual(profile2.last_seen_at, None)
+
+        UserService.clear_touched()
+        UserService.touch(user1.id)
+        previous_last_seen = UserService.flush_last_seen()
+        self.assertEqual(previous_last_seen, {user1.id: profile1.last_seen_at})
+        self.assertEqual(UserService.flush_last_seen(), {})
+
+    def test_flush_resumes_after_crash(self):
+        user1 = self.create_user('user1')
+        UserService.touch(user1.id)
+
+        def crash(previous_last_seen):
+            raise RuntimeError('worker died')
+
+        with self.assertRaises(RuntimeError):
+            UserService.flush_last_seen(before_write=crash)
+        conn = RedisClient.get_connection()
+        self.assertEqual(conn.exists(USER_LAST_SEEN_FLUSHING_KEY), True)
+        self.assertEqual(UserProfile.objects.filter(user=user1).exists(), False)
+
+        # the next flush finds the times and the previous ones again
+        self.assertEqual(UserService.flush_last_seen(), {user1.id: None})
+        self.assertEqual(conn.exists(USER_LAST_SEEN_FLUSHING_KEY), False)
+        self.assertNotEqual(UserProfile.objects.get(user=user1).last_seen_at, None)
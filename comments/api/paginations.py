@@ -0,0 +1,12 @@
+from utils.paginations import EndlessPagination
+
+
+class CommentPagination(EndlessPagination):
+    # comments are shown oldest first under the tweet
+    ordering = ('created_at', 'id')
+
+    def get_paginated_response(self, data):
+        response = super(CommentPagination, self).get_paginated_response(data)
+        # clients read the list from 'comments'
+        response.data['comments'] = response.data.pop('results')
+        return response
@@ -1,3 +1,4 @@
+from django.contrib.auth.models import User
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 
@@ -5,6 +6,8 @@ from accounts.api.serializers import UserSerializerForComment
 from comments.models import Comment
 from likes.services import LikeService
 from tweets.models import Tweet
+from utils.list_serializers import PrefetchListSerializer
+from utils.memcached_helper import MemcachedHelper
 
 
 class CommentSerializer(serializers.ModelSerializer):
@@ -25,6 +28,11 @@ class CommentSerializer(serializers.ModelSerializer):
             'likes_count',
             'has_liked',
         )
+        list_serializer_class = PrefetchListSerializer
+
+    def prefetch(self, comments):
+        MemcachedHelper.prefetch_objects_through_cache(comments, User, 'user_id', '_cached_user')
+
     def get_likes_count(self, obj):
         return obj.like_set.count()
     def get_has_liked(self, obj):
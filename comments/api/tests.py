@@ -4,6 +4,7 @@ from rest_framework.test import APIClient
 
 from comments.models import Comment
 from testing.testcases import TestCase
+from tweets.tasks import flush_tweet_counters_task
 
 # any api that uses comments api should be tested.
 COMMENT_URL = '/api/comments/'
@@ -181,12 +182,15 @@ class CommentApiTests(TestCase):
             client.post(COMMENT_URL, data)
             response = client.get(tweet_url)
             self.assertEqual(response.data['comments_count'], i + 1)
+            # counts are written to db by the write behind flush
+            flush_tweet_counters_task()
             self.tweet.refresh_from_db()
             self.assertEqual(self.tweet.comments_count, i + 1)
 
         comment_data = self.user2_client.post(COMMENT_URL, data).data
         response = self.user2_client.get(tweet_url)
         self.assertEqual(response.data['comments_count'], 3)
+        flush_tweet_counters_task()
         self.tweet.refresh_from_db()
         self.assertEqual(self.tweet.comments_count, 3)
 
@@ -196,6 +200,7 @@ class CommentApiTests(TestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         response = self.user2_client.get(tweet_url)
         self.assertEqual(response.data['comments_count'], 3)
+        flush_tweet_counters_task()
         self.tweet.refresh_from_db()
         self.assertEqual(self.tweet.comments_count, 3)
 
@@ -204,6 +209,7 @@ class CommentApiTests(TestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         response = self.user1_client.get(tweet_url)
         self.assertEqual(response.data['comments_count'], 2)
+        flush_tweet_counters_task()
         self.tweet.refresh_from_db()
         self.assertEqual(self.tweet.comments_count, 2)
 
@@ -1,3 +1,4 @@
+from comments.api.paginations import CommentPagination
 from comments.api.serializers import (
     CommentSerializerForCreate,
     CommentSerializer,
@@ -22,6 +23,7 @@ class CommentViewSet(viewsets.GenericViewSet):
     serializer_class = CommentSerializerForCreate
     queryset = Comment.objects.all()
     filterset_fields = ('tweet_id',)
+    pagination_class = CommentPagination
 
     def get_permissions(self):
         if self.action == 'create':
@@ -48,14 +50,13 @@ class CommentViewSet(viewsets.GenericViewSet):
         queryset = self.get_queryset() # get_queryset() can be overridden
         # 使用prefetch related可以进行优化
         comments = self.filter_queryset(queryset).prefetch_related('user').order_by('created_at')
+        page = self.paginate_queryset(comments)
         serializer = CommentSerializer(
-            comments,
+            page,
             context={'request': request},
             many=True,
         )
-        return Response({
-            'comments': serializer.data,
-        }, status=status.HTTP_200_OK)
+        return self.get_paginated_response(serializer.data)
 
 
     @method_decorator(ratelimit(key='user', rate = '3/s', method='POST', block=True))
@@ -1,8 +1,7 @@
-from rest_framework.pagination import PageNumberPagination
-from rest_framework.response import Response
+from utils.paginations import EndlessPagination
 
 
-class FriendshipPagination(PageNumberPagination):
+class FriendshipPagination(EndlessPagination):
     # the default page size, if the page size parameter is not in the url
     page_size = 20
     # The default page_size_query_param is None, which means
@@ -12,13 +11,3 @@ class FriendshipPagination(PageNumberPagination):
     page_size_query_param = 'size'
     # The largest size that allowed
     max_page_size = 20
-
-    # 完成翻页返回给前端的数据
-    def get_paginated_response(self, data):
-        return Response({
-            'total_results': self.page.paginator.count,
-            'total_pages': self.page.paginator.num_pages,
-            'page_number': self.page.number,
-            'has_next_page': self.page.has_next(),
-            'results': data, # the previous followings and followers are all results
-        })
\ No newline at end of file
@@ -1,9 +1,12 @@
+from django.contrib.auth.models import User
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 
 from accounts.api.serializers import UserSerializerForFriendship
 from friendships.models import Friendship
 from friendships.services import FriendshipService
+from utils.list_serializers import PrefetchListSerializer
+from utils.memcached_helper import MemcachedHelper
 
 class FollowingUserIdSetMixin:
 
@@ -28,6 +31,12 @@ class FollowerSerializer(serializers.ModelSerializer, FollowingUserIdSetMixin):
     class Meta:
         model = Friendship
         fields = ('user', 'created_at', 'has_followed')
+        list_serializer_class = PrefetchListSerializer
+
+    def prefetch(self, friendships):
+        MemcachedHelper.prefetch_objects_through_cache(
+            friendships, User, 'from_user_id', '_cached_from_user',
+        )
 
     def get_has_followed(self, obj):
         return obj.from_user_id in self.following_user_id_set
@@ -40,6 +49,12 @@ class FollowingSerializer(serializers.ModelSerializer, FollowingUserIdSetMixin):
     class Meta:
         model = Friendship
         fields = ('user', 'created_at', 'has_followed')
+        list_serializer_class = PrefetchListSerializer
+
+    def prefetch(self, friendships):
+        MemcachedHelper.prefetch_objects_through_cache(
+            friendships, User, 'to_user_id', '_cached_to_user',
+        )
 
     def get_has_followed(self, obj):
         return obj.to_user_id in self.following_user_id_set
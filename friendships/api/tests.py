@@ -157,12 +157,12 @@ class FriendshipApiTests(TestCase):
         self._test_friendship_pagination(url, page_size, max_page_size)
 
         # anonymous user hasn't followed anyone
-        response = self.anonymous_client.get(url, {'page': 1})
+        response = self.anonymous_client.get(url)
         for result in response.data['results']:
             self.assertEqual(result['has_followed'], False)
 
         # user2 has followed users with even id
-        response = self.user2_client.get(url, {'page': 1})
+        response = self.user2_client.get(url)
         for result in response.data['results']:
             has_followed = (result['user']['id'] % 2 == 0)
             self.assertEqual(result['has_followed'], has_followed)
@@ -180,61 +180,51 @@ class FriendshipApiTests(TestCase):
         self._test_friendship_pagination(url, page_size, max_page_size)
 
         # anonymous user hasn't followed anyone
-        response = self.anonymous_client.get(url, {'page': 1})
+        response = self.anonymous_client.get(url)
         for result in response.data['results']:
             self.assertEqual(result['has_followed'], False)
 
         # user2 has followed users with even id
-        response = self.user2_client.get(url, {'page': 1})
+        response = self.user2_client.get(url)
         for result in response.data['results']:
             has_followed = (result['user']['id'] % 2 == 0)
             self.assertEqual(result['has_followed'], has_followed)
 
         # user1 has followed all his following users
-        response = self.user1_client.get(url, {'page': 1})
+        response = self.user1_client.get(url)
         for result in response.data['results']:
             self.assertEqual(result['has_followed'], True)
 
 
     def _test_friendship_pagination(self, url, page_size, max_page_size):
         # test anonymous client page 1
-        response = self.anonymous_client.get(url, {'page': 1})
+        response = self.anonymous_client.get(url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         # print(response.data['results'])
         self.assertEqual(len(response.data['results']), page_size)
-        self.assertEqual(response.data['total_pages'], 2)
-        self.assertEqual(response.data['total_results'], page_size * 2)
-        self.assertEqual(response.data['page_number'], 1)
         self.assertEqual(response.data['has_next_page'], True)
+        first_page_ids = [result['user']['id'] for result in response.data['results']]
 
         # test anonymous client page 2
-        response = self.anonymous_client.get(url, {'page': 2})
+        response = self.anonymous_client.get(url, {'cursor': response.data['next_cursor']})
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(len(response.data['results']), page_size)
-        self.assertEqual(response.data['total_pages'], 2)
-        self.assertEqual(response.data['total_results'], page_size * 2)
-        self.assertEqual(response.data['page_number'], 2)
         self.assertEqual(response.data['has_next_page'], False)
+        self.assertEqual(response.data['next_cursor'], None)
+        second_page_ids = [result['user']['id'] for result in response.data['results']]
+        self.assertEqual(len(set(first_page_ids + second_page_ids)), page_size * 2)
 
-        # test anonymous client cannot get a not existed page
-        response = self.anonymous_client.get(url, {'page': 3})
+        # test a cursor that is not issued by the server
+        response = self.anonymous_client.get(url, {'cursor': 'fake cursor'})
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
         # test user cannot customize page_size larger than max_page_size
-        response = self.anonymous_client.get(url, {'page': 1, 'size': max_page_size + 1})
+        response = self.anonymous_client.get(url, {'size': max_page_size + 1})
         # will use max_page_size rather than raise error
         self.assertEqual(len(response.data['results']), max_page_size)
-        self.assertEqual(response.data['total_pages'], 2)
-        self.assertEqual(response.data['total_results'], page_size * 2)
-        self.assertEqual(response.data['page_number'], 1)
         self.assertEqual(response.data['has_next_page'], True)
 
         # test user can customize page size by param size
-        response = self.anonymous_client.get(url, {'page': 1, 'size': 2})
+        response = self.anonymous_client.get(url, {'size': 2})
         self.assertEqual(len(response.data['results']), 2)
-        self.assertEqual(response.data['total_pages'], page_size)
-        self.assertEqual(response.data['total_results'], page_size * 2)
-        self.assertEqual(response.data['page_number'], 1)
         self.assertEqual(response.data['has_next_page'], True)
-
-
@@ -37,10 +37,14 @@ class Friendship(models.Model):
 
     @property
     def cached_from_user(self):
+        if hasattr(self, '_cached_from_user'):
+            return self._cached_from_user
         return MemcachedHelper.get_object_through_cache(User, self.from_user_id)
 
     @property
     def cached_to_user(self):
+        if hasattr(self, '_cached_to_user'):
+            return self._cached_to_user
         return MemcachedHelper.get_object_through_cache(User, self.to_user_id)
 
 # hook up with listeners to invalidate cache
@@ -1,12 +1,27 @@
+import threading
+import time
+
 from django.conf import settings
 from django.core.cache import caches
+from django.db.models import Q
 
 from friendships.models import Friendship
-from twitter.cache import FOLLOWINGS_PATTERN
+from twitter.cache import CELEBRITIES_KEY, FOLLOWINGS_PATTERN
+from utils.cache_generations import CacheGenerations
+from utils.cache_metrics import CacheMetrics
+from utils.early_refresh import EarlyRefresh
+from utils.memcached_helper import MemcachedHelper
+from utils.redis_client import RedisClient
+from utils.request_cache import RequestCache
+from utils.time_helpers import from_microseconds, to_microseconds
 
 cache = caches['testing'] if settings.TESTING else caches['default']
 
 class FriendshipService:
+    # (ids of the celebrities, time.monotonic() when read), see get_celebrity_ids
+    _celebrities = None
+    _lock = threading.Lock()
+
     @classmethod
     def get_followers(self, user):
         friendships = Friendship.objects.filter(
@@ -15,27 +30,155 @@ class FriendshipService:
         return [friendship.from_user for friendship in friendships]
 
     @classmethod
-    def get_follower_ids(cls, to_user_id):
+    def _filter_followers(cls, to_user_id, after=None, last=None, active_since=None):
+        # the friendships in the order of the (to_user_id, created_at) index,
+        # after / last: (created_at, id) bounds of the range, after is excluded.
+        # active_since: only the followers seen since then, see UserService.touch
         friendships = Friendship.objects.filter(to_user_id=to_user_id)
-        return [friendship.from_user_id for friendship in friendships]
+        if after is not None:
+            created_at, friendship_id = after
+            friendships = friendships.filter(
+                Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=friendship_id),
+            )
+        if last is not None:
+            created_at, friendship_id = last
+            friendships = friendships.filter(
+                Q(created_at__lt=created_at) | Q(created_at=created_at, id__lte=friendship_id),
+            )
+        if active_since is not None:
+            friendships = friendships.filter(from_user__userprofile__last_seen_at__gte=active_since)
+        return friendships.order_by('created_at', 'id')
+
+    @classmethod
+    def iter_follower_rows(cls, to_user_id, chunk_size, after=None, active_since=None):
+        # chunks of (created_at, friendship id, follower id), one keyset query per chunk,
+        # so the memory stays flat whatever the number of followers
+        while True:
+            friendships = cls._filter_followers(to_user_id, after=after, active_since=active_since)
+            rows = list(friendships.values_list('created_at', 'id', 'from_user_id')[:chunk_size])
+            if not rows:
+                return
+            yield rows
+            if len(rows) < chunk_size:
+                return
+            after = rows[-1][:2]
+
+    @classmethod
+    def get_follower_range(cls, to_user_id, after, last, active_since=None):
+        # a few ints standing for the followers in (after, last], what a fanout batch
+        # sends through the broker instead of the ids. see get_follower_ids_in_range
+        return {
+            'to_user_id': to_user_id,
+            'after': [to_microseconds(after[0]), after[1]] if after is not None else None,
+            'last': [to_microseconds(last[0]), last[1]],
+            'active_since': to_microseconds(active_since) if active_since is not None else None,
+        }
+
+    @classmethod
+    def get_follower_ids_in_range(cls, follower_range):
+        after, last = follower_range['after'], follower_range['last']
+        active_since = follower_range['active_since']
+        friendships = cls._filter_followers(
+            follower_range['to_user_id'],
+            after=(from_microseconds(after[0]), after[1]) if after is not None else None,
+            last=(from_microseconds(last[0]), last[1]),
+            active_since=from_microseconds(active_since) if active_since is not None else None,
+        )
+        return list(friendships.values_list('from_user_id', flat=True))
+
+    @classmethod
+    def get_follower_count(cls, to_user_id):
+        # counted on the (to_user_id, created_at) index
+        return Friendship.objects.filter(to_user_id=to_user_id).count()
+
+    @classmethod
+    def get_celebrity_ids(cls):
+        # read on every newsfeed request, so each process keeps it for
+        # NEWSFEED_CELEBRITY_REFRESH seconds
+        cached = cls._celebrities
+        now = time.monotonic()
+        if cached is not None and now - cached[1] < settings.NEWSFEED_CELEBRITY_REFRESH:
+            return cached[0]
+        members = RedisClient.get_connection().smembers(CELEBRITIES_KEY)
+        celebrity_ids = {int(member) for member in members}
+        with cls._lock:
+            cls._celebrities = (celebrity_ids, now)
+        return celebrity_ids
+
+    @classmethod
+    def update_celebrity(cls, user_id, follower_count):
+        # returns whether the tweets of the user are pulled instead of fanned out.
+        # the lower demotion threshold keeps users near the threshold from flapping,
+        # a demoted user's pulled tweets are fanned out by fanout_newsfeeds_main_task
+        threshold = settings.NEWSFEED_CELEBRITY_THRESHOLD
+        celebrity_ids = cls.get_celebrity_ids()
+        if user_id in celebrity_ids:
+            is_celebrity = follower_count >= threshold // 2
+        else:
+            is_celebrity = follower_count >= threshold
+        if is_celebrity == (user_id in celebrity_ids):
+            return is_celebrity
+
+        conn = RedisClient.get_connection()
+        if is_celebrity:
+            conn.sadd(CELEBRITIES_KEY, user_id)
+        else:
+            conn.srem(CELEBRITIES_KEY, user_id)
+        # re-read on the next call of this process, the others within the refresh time
+        with cls._lock:
+            cls._celebrities = None
+        return is_celebrity
+
+    @classmethod
+    def get_followed_celebrity_ids(cls, from_user_id):
+        celebrity_ids = cls.get_celebrity_ids()
+        if not celebrity_ids:
+            return set()
+        return cls.get_following_user_id_set(from_user_id) & celebrity_ids
+
+    @classmethod
+    def clear_celebrity_ids(cls):
+        # forget what this process read, for testing purpose
+        with cls._lock:
+            cls._celebrities = None
 
     @classmethod
     def get_following_user_id_set(cls, from_user_id):
-        key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
-        user_id_set = cache.get(key)
+        key = CacheGenerations.get_pattern_key(FOLLOWINGS_PATTERN, user_id=from_user_id)
+        pattern = CacheMetrics.get_pattern(key)
+        user_id_set = RequestCache.get(key)
         if user_id_set is not None:
+            CacheMetrics.hit(pattern, 'request')
+            return user_id_set
+
+        with CacheMetrics.time_round_trip(pattern, 'memcached'):
+            user_id_set, refresh = EarlyRefresh.unwrap(MemcachedHelper.cache_get(pattern, key))
+        if user_id_set is not None and not refresh:
+            CacheMetrics.hit(pattern, 'memcached')
+            RequestCache.set(key, user_id_set)
             return user_id_set
 
-        friendships = Friendship.objects.filter(from_user_id=from_user_id)
-        user_id_set = set([
-            fs.to_user_id for fs in friendships
-        ])
-        cache.set(key, user_id_set)
+        CacheMetrics.miss(pattern)
+        with CacheMetrics.time_fill(pattern):
+            start = time.perf_counter()
+            friendships = Friendship.objects.filter(from_user_id=from_user_id)
+            user_id_set = set([
+                fs.to_user_id for fs in friendships
+            ])
+            delta = time.perf_counter() - start
+            MemcachedHelper.cache_set(
+                pattern, key, *EarlyRefresh.wrap(user_id_set, delta, cache.default_timeout),
+            )
+        RequestCache.set(key, user_id_set)
         return user_id_set
 
     # call this method when friendships have changes
     @classmethod
     def invalidate_following_cache(cls, from_user_id):
-        key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
-        cache.delete(key)
+        keys = CacheGenerations.get_pattern_invalidation_keys(
+            FOLLOWINGS_PATTERN, user_id=from_user_id,
+        )
+        cache.delete_many(keys)
+        for key in keys:
+            RequestCache.delete(key)
 
@@ -23,3 +23,32 @@ class FriendshipServiceTests(TestCase):
         Friendship.objects.filter(from_user=self.lisa, to_user=self.anna).delete()
         user_id_set = FriendshipService.get_following_user_id_set(self.lisa.id)
         self.assertSetEqual(user_id_set, {user1.id, user2.id})
+
+    def test_iter_follower_rows(self):
+        followers = [self.create_user('follower{}'.format(i)) for i in range(5)]
+        for follower in followers:
+            Friendship.objects.create(from_user=follower, to_user=self.anna)
+        Friendship.objects.create(from_user=self.anna, to_user=self.lisa)
+        follower_ids = [follower.id for follower in followers]
+
+        chunks = list(FriendshipService.iter_follower_rows(self.anna.id, 2))
+        self.assertEqual([len(rows) for rows in chunks], [2, 2, 1])
+        self.assertEqual([row[2] for rows in chunks for row in rows], follower_ids)
+
+        # start after the second chunk
+        after = chunks[1][-1][:2]
+        chunks = list(FriendshipService.iter_follower_rows(self.anna.id, 2, after=after))
+        self.assertEqual([row[2] for rows in chunks for row in rows], follower_ids[4:])
+
+        # the followers in (after, last] as a range
+        first, last = list(FriendshipService.iter_follower_rows(self.anna.id, 2))[:2]
+        follower_range = FriendshipService.get_follower_range(self.anna.id, first[-1][:2], last[-1][:2])
+        self.assertEqual(
+            FriendshipService.get_follower_ids_in_range(follower_range),
+            follower_ids[2:4],
+        )
+        follower_range = FriendshipService.get_follower_range(self.anna.id, None, first[-1][:2])
+        self.assertEqual(
+            FriendshipService.get_follower_ids_in_range(follower_range),
+            follower_ids[:2],
+        )
@@ -0,0 +1,6 @@
+from utils.paginations import EndlessPagination
+
+
+class NotificationPagination(EndlessPagination):
+    # django-notifications keeps the time of a notification in timestamp
+    ordering = ('-timestamp', '-id')
@@ -111,23 +111,23 @@ class NotificationApiTests(TestCase):
         # user2 should see no notifications
         response = self.user2_client.get(NOTIFICATION_URL)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(response.data['count'], 0)
+        self.assertEqual(len(response.data['results']), 0)
 
         # user1 should see 2 notifications
         response = self.user1_client.get(NOTIFICATION_URL)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(len(response.data['results']), 2)
 
         # user1 see only one unread after marking
         notification = self.user1.notifications.first()
         notification.unread = False
         notification.save()
         response = self.user1_client.get(NOTIFICATION_URL)
-        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(len(response.data['results']), 2)
         response = self.user1_client.get(NOTIFICATION_URL, {'unread': True})
-        self.assertEqual(response.data['count'], 1)
+        self.assertEqual(len(response.data['results']), 1)
         response = self.user1_client.get(NOTIFICATION_URL, {'unread': False})
-        self.assertEqual(response.data['count'], 1)
+        self.assertEqual(len(response.data['results']), 1)
 
     def test_update(self):
         self.user2_client.post(LIKE_URL, {
@@ -1,3 +1,4 @@
+from inbox.api.paginations import NotificationPagination
 from inbox.api.serializers import (
     NotificationSerializer,
     NotificationSerializerForUpdate
@@ -19,6 +20,7 @@ class NotificationViewSet(
 ):
     serializer_class = NotificationSerializer
     permission_classes = (IsAuthenticated,)
+    pagination_class = NotificationPagination
     filterset_fields = ('unread',) # without this, cannot filter by unread = True / False
 
     def get_queryset(self):
@@ -1,3 +1,4 @@
+from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
@@ -6,6 +7,8 @@ from accounts.api.serializers import UserSerializer, UserSerializerForLike
 from comments.models import Comment
 from likes.models import Like
 from tweets.models import Tweet
+from utils.list_serializers import PrefetchListSerializer
+from utils.memcached_helper import MemcachedHelper
 
 class LikeSerializer(serializers.ModelSerializer):
     user = UserSerializerForLike(source='cached_user')
@@ -13,6 +16,10 @@ class LikeSerializer(serializers.ModelSerializer):
     class Meta:
         model = Like
         fields = ('user', 'created_at')
+        list_serializer_class = PrefetchListSerializer
+
+    def prefetch(self, likes):
+        MemcachedHelper.prefetch_objects_through_cache(likes, User, 'user_id', '_cached_user')
 
 class BaseLikeSerializerForCreateAndCancel(serializers.ModelSerializer):
     content_type = serializers.ChoiceField(choices=['comment', 'tweet'])
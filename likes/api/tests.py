@@ -1,6 +1,7 @@
 from rest_framework import status
 
 from testing.testcases import TestCase
+from tweets.tasks import flush_tweet_counters_task
 
 LIKE_BASE_URL = '/api/likes/'
 LIKE_CANCEL_URL = '/api/likes/cancel/'
@@ -233,11 +234,14 @@ class LikeApiTest(TestCase):
         tweet_url = TWEET_DETAIL_API.format(tweet.id)
         response = self.user1_client.get(tweet_url)
         self.assertEqual(response.data['likes_count'], 1)
+        # counts are written to db by the write behind flush
+        flush_tweet_counters_task()
         tweet.refresh_from_db()
         self.assertEqual(tweet.likes_count, 1)
 
         # user2 canceled likes
         self.user1_client.post(LIKE_BASE_URL + 'cancel/', data)
+        flush_tweet_counters_task()
         tweet.refresh_from_db()
         self.assertEqual(tweet.likes_count, 0)
         response = self.user2_client.get(tweet_url)
@@ -256,12 +260,14 @@ class LikeApiTest(TestCase):
             # check tweet api
             response =  client.get(tweet_url)
             self.assertEqual(response.data['likes_count'], i + 1)
+            flush_tweet_counters_task()
             tweet.refresh_from_db()
             self.assertEqual(tweet.likes_count, i + 1)
 
         self.user2_client.post(LIKE_BASE_URL, data)
         response = self.user2_client.get(tweet_url)
         self.assertEqual(response.data['likes_count'], 4)
+        flush_tweet_counters_task()
         tweet.refresh_from_db()
         self.assertEqual(tweet.likes_count, 4)
 
@@ -274,6 +280,7 @@ class LikeApiTest(TestCase):
 
         # user2 canceled likes
         self.user2_client.post(LIKE_BASE_URL + 'cancel/', data)
+        flush_tweet_counters_task()
         tweet.refresh_from_db()
         self.assertEqual(tweet.likes_count, 3)
         response = self.user2_client.get(tweet_url)
@@ -2,7 +2,6 @@ from utils.redis_helper import RedisHelper
 
 def incr_likes_count(sender, instance, created, **kwargs):
     from tweets.models import Tweet
-    from django.db.models import F
 
     if not created:
         return
@@ -13,16 +12,15 @@ def incr_likes_count(sender, instance, created, **kwargs):
         return
 
     # should not use tweet.likes_count += 1; tweet.save()
-    # because this manipulation is not atomic. should use update syntax
-    # SQL query: UPDATE likes_count = likes_count + 1 FROM tweets_table WHERE id = <instance.object_id>
-    # 没有F会产生并发问题
-    Tweet.objects.filter(id=instance.object_id).update(likes_count=F('likes_count') + 1)
+    # because this manipulation is not atomic.
+    # we don't UPDATE likes_count = likes_count + 1 here either, a viral tweet would
+    # serialise thousands of row lock updates. redis keeps the count and records the
+    # delta, flush_tweet_counters_task writes the deltas to db in bulk.
     RedisHelper.incr_count(instance.content_object, 'likes_count')
 
 
 def decr_likes_count(sender, instance, **kwargs):
     from tweets.models import Tweet
-    from django.db.models import F
 
     model_class = instance.content_type.model_class()
     if model_class != Tweet:
@@ -30,6 +28,4 @@ def decr_likes_count(sender, instance, **kwargs):
         return
 
     # handle tweet likes cancel
-
-    Tweet.objects.filter(id=instance.object_id).update(likes_count=F('likes_count') - 1)
     RedisHelper.decr_count(instance.content_object, 'likes_count')
@@ -35,6 +35,8 @@ class Like(models.Model):
 
     @property
     def cached_user(self):
+        if hasattr(self, '_cached_user'):
+            return self._cached_user
         return MemcachedHelper.get_object_through_cache(User, self.user_id)
 
 
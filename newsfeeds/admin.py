@@ -1,10 +1,17 @@
 from django.contrib import admin
 
 # Register your models here.
-from newsfeeds.models import NewsFeed
+from newsfeeds.models import FanoutProgress, NewsFeed
 
 
 @admin.register(NewsFeed)
 class NewsFeedAdmin(admin.ModelAdmin):
     list_display = ('user', 'tweet', 'created_at')
-    date_hierarchy = 'created_at'
\ No newline at end of file
+    date_hierarchy = 'created_at'
+
+
+@admin.register(FanoutProgress)
+class FanoutProgressAdmin(admin.ModelAdmin):
+    list_display = ('tweet', 'status', 'dispatched', 'created_at', 'updated_at')
+    list_filter = ('status',)
+    date_hierarchy = 'created_at'
@@ -1,6 +1,9 @@
 from rest_framework import serializers
-from newsfeeds.models import NewsFeed
+from newsfeeds.models import FanoutProgress, NewsFeed
 from tweets.api.serializers import TweetSerializer
+from tweets.models import Tweet
+from utils.list_serializers import PrefetchListSerializer
+from utils.memcached_helper import MemcachedHelper
 
 class NewsFeedSerializer(serializers.ModelSerializer):
     tweet = TweetSerializer(source='cached_tweet') # TweetSerializer() has already included UserSerializer()
@@ -8,3 +11,30 @@ class NewsFeedSerializer(serializers.ModelSerializer):
     class Meta:
         model = NewsFeed
         fields = ('id', 'created_at', 'tweet')
+        list_serializer_class = PrefetchListSerializer
+
+    def prefetch(self, newsfeeds):
+        # newsfeed -> tweet -> user, two batched cache lookups for the whole page
+        tweets = MemcachedHelper.prefetch_objects_through_cache(
+            newsfeeds, Tweet, 'tweet_id', '_cached_tweet',
+        )
+        self.fields['tweet'].prefetch(tweets)
+
+
+class FanoutProgressSerializer(serializers.ModelSerializer):
+    status = serializers.CharField(source='get_status_display')
+    # set by NewsFeedService.get_fanout_progress
+    delivered = serializers.IntegerField()
+    pending = serializers.IntegerField()
+
+    class Meta:
+        model = FanoutProgress
+        fields = (
+            'tweet_id',
+            'status',
+            'dispatched',
+            'delivered',
+            'pending',
+            'created_at',
+            'updated_at',
+        )
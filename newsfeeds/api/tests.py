@@ -1,9 +1,11 @@
 from django.conf import settings
+from django.test import override_settings
 
 from newsfeeds.models import NewsFeed
 from friendships.models import Friendship
 from rest_framework.test import APIClient
 
+from friendships.services import FriendshipService
 from newsfeeds.services import NewsFeedService
 from testing.testcases import TestCase
 from rest_framework import status
@@ -114,6 +116,7 @@ class NewsFeedApiTest(TestCase):
         profile = self.user2.profile
         profile.nickname = 'twohuo'
         profile.save()
+        self.run_on_commit_callbacks()
 
         # newsfeed -> tweet -> user -> profile
         # make sure when profile changes, the upstream changes accordingly
@@ -133,6 +136,7 @@ class NewsFeedApiTest(TestCase):
         self.user1.save()
         profile.nickname = 'twohuotwo'
         profile.save()
+        self.run_on_commit_callbacks()
 
         response = self.user2_client.get(NEWSFEEDS_URL)
         results = response.data['results']
@@ -151,6 +155,7 @@ class NewsFeedApiTest(TestCase):
         # update username
         self.user1.username = 'user1newname'
         self.user1.save()
+        self.run_on_commit_callbacks()
         response = self.user2_client.get(NEWSFEEDS_URL)
         results = response.data['results']
         self.assertEqual(results[0]['tweet']['user']['username'], 'user1newname')
@@ -158,6 +163,7 @@ class NewsFeedApiTest(TestCase):
         # update tweet content
         tweet.content = 'content2'
         tweet.save()
+        self.run_on_commit_callbacks()
         response = self.user2_client.get(NEWSFEEDS_URL)
         results = response.data['results']
         self.assertEqual(results[0]['tweet']['content'], 'content2')
@@ -218,3 +224,34 @@ class NewsFeedApiTest(TestCase):
         # cache expired
         self.clear_cache()
         _test_newsfeeds_after_new_feed_pushed()
+
+    @override_settings(NEWSFEED_CELEBRITY_THRESHOLD=1)
+    def test_celebrity_tweets_past_cached_list(self):
+        list_limit = settings.REDIS_LIST_LENGTH_LIMIT
+        page_size = EndlessPagination.page_size
+        user3 = self.create_user('user3')
+        self.create_friendship(self.user1, self.user2)
+        FriendshipService.update_celebrity(self.user2.id, 1)
+        tweets = []
+        for i in range(list_limit + page_size):
+            if i % 2:
+                # pulled from the celebrity
+                tweet = self.create_tweet(self.user2, 'pulled{}'.format(i))
+            else:
+                tweet = self.create_tweet(user3, 'pushed{}'.format(i))
+                self.create_newsfeed(self.user1, tweet)
+            tweets.append(tweet)
+
+        # the pages read from db have the tweets of the celebrity as well
+        response = self.user1_client.get(NEWSFEEDS_URL)
+        results = response.data['results']
+        while response.data['has_next_page']:
+            response = self.user1_client.get(
+                NEWSFEEDS_URL,
+                {'cursor': response.data['next_cursor']},
+            )
+            results.extend(response.data['results'])
+        self.assertEqual(
+            [result['tweet']['id'] for result in results],
+            [tweet.id for tweet in reversed(tweets)],
+        )
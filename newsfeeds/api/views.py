@@ -1,3 +1,5 @@
+from functools import partial
+
 from django.utils.decorators import method_decorator
 from ratelimit.decorators import ratelimit
 from rest_framework import viewsets, status
@@ -23,10 +25,13 @@ class NewsFeedViewSet(viewsets.GenericViewSet):
     def list(self, request):
         cached_newsfeeds = NewsFeedService.get_cached_newsfeeds(request.user.id)
         page = self.paginator.paginate_cached_list(cached_newsfeeds, request)
-        # if page is none. means should retrieve data from database
+        # if page is none. means should retrieve data from database,
+        # the tweets of the followed celebrities are merged in there as well
         if page is None:
-            queryset = NewsFeed.objects.filter(user=request.user)
-            page = self.paginate_queryset(queryset)
+            page = self.paginator.paginate_cached_index(
+                partial(NewsFeedService.get_newsfeeds_page, request.user.id),
+                request,
+            )
 
         serializer = NewsFeedSerializer(
             page,
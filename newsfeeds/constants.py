@@ -1,3 +1,18 @@
 from django.conf import settings
 
-FANOUT_BATCH_SIZE = 1000 if not settings.TESTING else 3
\ No newline at end of file
+FANOUT_BATCH_SIZE = 1000 if not settings.TESTING else 3
+
+class FanoutStatus:
+    # the main task is dispatching the batches
+    DISPATCHING = 0
+    # every batch has been dispatched
+    DISPATCHED = 1
+    # tweet of a celebrity, its followers pull it
+    PULLED = 2
+
+
+FANOUT_STATUS_CHOICES = (
+    (FanoutStatus.DISPATCHING, 'Dispatching'),
+    (FanoutStatus.DISPATCHED, 'Dispatched'),
+    (FanoutStatus.PULLED, 'Pulled'),
+)
@@ -0,0 +1,31 @@
+# Generated by Django 3.1.3 on 2026-10-18 12:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tweets', '0004_auto_20220724_2310'),
+        ('newsfeeds', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FanoutProgress',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.IntegerField(choices=[(0, 'Dispatching'), (1, 'Dispatched'), (2, 'Pulled')], default=0)),
+                ('dispatched', models.IntegerField(default=0)),
+                ('checkpoint_created_at', models.DateTimeField(null=True)),
+                ('checkpoint_id', models.IntegerField(null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('tweet', models.OneToOneField(null=True, on_delete=django.db.models.deletion.SET_NULL, to='tweets.tweet')),
+            ],
+            options={
+                'index_together': {('status', 'updated_at')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.3 on 2026-10-18 19:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('newsfeeds', '0002_fanoutprogress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fanoutprogress',
+            name='attempt',
+            field=models.IntegerField(default=0),
+        ),
+    ]
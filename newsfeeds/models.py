@@ -4,6 +4,7 @@ from django.db import models
 # Create your models here.
 from django.db.models.signals import post_save
 
+from newsfeeds.constants import FANOUT_STATUS_CHOICES, FanoutStatus
 from newsfeeds.listeners import push_newsfeed_to_cache
 from tweets.models import Tweet
 from utils.memcached_helper import MemcachedHelper
@@ -27,7 +28,39 @@ class NewsFeed(models.Model):
 
     @property
     def cached_tweet(self):
+        if hasattr(self, '_cached_tweet'):
+            return self._cached_tweet
         return MemcachedHelper.get_object_through_cache(Tweet, self.tweet_id)
 
 
+class FanoutProgress(models.Model):
+    # checkpoint of fanout_newsfeeds_main_task, a restarted fanout resumes
+    # after the last dispatched batch instead of starting over
+    tweet = models.OneToOneField(Tweet, on_delete=models.SET_NULL, null=True)
+    status = models.IntegerField(
+        default=FanoutStatus.DISPATCHING,
+        choices=FANOUT_STATUS_CHOICES,
+    )
+    # followers in the dispatched batches, counted when they are dispatched.
+    # in the 'range' FANOUT_BATCH_MODE a batch reads its followers later, the ones
+    # who unfollowed or went dormant in between are counted but never delivered
+    dispatched = models.IntegerField(default=0)
+    # fencing token, bumped when the fanout is resumed. a main task that was only
+    # slow stops at its next checkpoint instead of overwriting the resumed one
+    attempt = models.IntegerField(default=0)
+    # (created_at, id) of the friendship of the last dispatched follower,
+    # in the order of the (to_user_id, created_at) index
+    checkpoint_created_at = models.DateTimeField(null=True)
+    checkpoint_id = models.IntegerField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        # find the stalled fanouts to resume
+        index_together = (('status', 'updated_at'),)
+
+    def __str__(self):
+        return f'fanout of {self.tweet_id}: {self.dispatched} dispatched'
+
+
 post_save.connect(push_newsfeed_to_cache, sender=NewsFeed)
\ No newline at end of file
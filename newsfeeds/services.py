@@ -1,8 +1,19 @@
+import heapq
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import OuterRef, Q, Subquery
+
 from friendships.services import FriendshipService
-from newsfeeds.models import NewsFeed
+from newsfeeds.models import FanoutProgress, NewsFeed
 from newsfeeds.tasks import fanout_newsfeeds_main_task
+from tweets.models import Tweet
+from tweets.services import TweetService
 from twitter.cache import USER_NEWSFEEDS_PATTERN
+from utils.cache_generations import CacheGenerations
+from utils.redis_client import RedisClient
 from utils.redis_helper import RedisHelper
+from utils.time_helpers import from_microseconds, utc_now
 
 
 class NewsFeedService(object):
@@ -18,12 +29,190 @@ class NewsFeedService(object):
     # similar to get cached_tweets()
     @classmethod
     def get_cached_newsfeeds(cls, user_id):
-        queryset = NewsFeed.objects.filter(user_id=user_id).order_by('-created_at')
-        key = USER_NEWSFEEDS_PATTERN.format(user_id=user_id)
-        return RedisHelper.load_objects(key, queryset)
+        queryset = NewsFeed.objects.filter(user_id=user_id).order_by('-created_at', '-id')
+        key = CacheGenerations.get_pattern_key(USER_NEWSFEEDS_PATTERN, user_id=user_id)
+        newsfeeds = RedisHelper.load_objects(key, queryset)
+        # the tweets of the celebrities are not fanned out, pull them
+        celebrity_ids = FriendshipService.get_followed_celebrity_ids(user_id)
+        if not celebrity_ids:
+            return newsfeeds
+        return cls._merge_celebrity_tweets(user_id, newsfeeds, celebrity_ids)
+
+    @classmethod
+    def _merge_celebrity_tweets(cls, user_id, newsfeeds, celebrity_ids):
+        # k-way heap merge of the pushed newsfeeds and the cached tweets of each
+        # celebrity, all of them are newest first. pages past the merged list are
+        # read from db by get_newsfeeds_page
+        timelines = [newsfeeds]
+        for celebrity_id in sorted(celebrity_ids):
+            tweets = TweetService.get_latest_cached_tweets(celebrity_id)
+            timelines.append([cls._to_newsfeed(user_id, tweet) for tweet in tweets])
+        return cls._merge_timelines(timelines, settings.REDIS_LIST_LENGTH_LIMIT)
+
+    @classmethod
+    def _merge_timelines(cls, timelines, limit=None):
+        merged = []
+        tweet_ids = set()
+        for newsfeed in heapq.merge(
+            *timelines,
+            key=lambda newsfeed: (newsfeed.created_at, newsfeed.id),
+            reverse=True,
+        ):
+            # pushed before the author became a celebrity, the pushed one comes first
+            if newsfeed.tweet_id in tweet_ids:
+                continue
+            tweet_ids.add(newsfeed.tweet_id)
+            merged.append(newsfeed)
+            if limit is not None and len(merged) >= limit:
+                break
+        return merged
+
+    @classmethod
+    def get_newsfeeds_page(cls, user_id, before=None, after=None, count=None):
+        # the pages past the cached newsfeeds, read from db with the tweets of the
+        # followed celebrities merged in. before / after are the (created_at in
+        # microseconds, id) of a cursor, see EndlessPagination.paginate_cached_index
+        newsfeeds = NewsFeed.objects.filter(user_id=user_id).order_by('-created_at', '-id')
+        celebrity_ids = FriendshipService.get_followed_celebrity_ids(user_id)
+        # a pulled tweet is ordered by (created_at, -tweet id), see _to_newsfeed.
+        # the ones pushed before the author became a celebrity are already in newsfeeds
+        tweets = Tweet.objects.filter(user_id__in=celebrity_ids) \
+            .exclude(newsfeed__user_id=user_id) \
+            .order_by('-created_at', 'id')
+        position = before if before is not None else after
+        if position is not None:
+            created_at, newsfeed_id = from_microseconds(position[0]), position[1]
+            lookup = 'lt' if before is not None else 'gt'
+            newsfeeds = newsfeeds.filter(
+                Q(**{'created_at__' + lookup: created_at})
+                | Q(created_at=created_at, **{'id__' + lookup: newsfeed_id})
+            )
+            tweets = tweets.filter(
+                Q(**{'created_at__' + lookup: created_at})
+                | Q(created_at=created_at, **{'id__' + ('gt' if lookup == 'lt' else 'lt'): -newsfeed_id})
+            )
+        if count is not None:
+            newsfeeds, tweets = newsfeeds[:count], tweets[:count]
+        timelines = [list(newsfeeds)]
+        if celebrity_ids:
+            timelines.append([cls._to_newsfeed(user_id, tweet) for tweet in tweets])
+        return cls._merge_timelines(timelines, count)
+
+    @classmethod
+    def _to_newsfeed(cls, user_id, tweet):
+        # not saved, the negative tweet id keeps the cursors of the pagination unique
+        newsfeed = NewsFeed(
+            id=-tweet.id,
+            user_id=user_id,
+            tweet_id=tweet.id,
+            created_at=tweet.created_at,
+        )
+        newsfeed._cached_tweet = tweet
+        return newsfeed
+
+    @classmethod
+    def warm_cached_newsfeeds(cls, user_ids):
+        # fill the cold newsfeed caches of these users in a few pipelines,
+        # returns the newsfeeds that were loaded from db
+        querysets = {
+            CacheGenerations.get_pattern_key(USER_NEWSFEEDS_PATTERN, user_id=user_id):
+                NewsFeed.objects.filter(user_id=user_id).order_by('-created_at', '-id')
+            for user_id in user_ids
+        }
+        filled = RedisHelper.fill_many(querysets)
+        return [newsfeed for newsfeeds in filled.values() for newsfeed in newsfeeds]
 
     @classmethod
     def push_newsfeed_to_cache(cls, newsfeed):
-        queryset = NewsFeed.objects.filter(user_id=newsfeed.user_id).order_by('-created_at')
-        key = USER_NEWSFEEDS_PATTERN.format(user_id=newsfeed.user_id)
-        RedisHelper.push_object(key, newsfeed, queryset)
\ No newline at end of file
+        queryset = NewsFeed.objects.filter(user_id=newsfeed.user_id).order_by('-created_at', '-id')
+        key = CacheGenerations.get_pattern_key(USER_NEWSFEEDS_PATTERN, user_id=newsfeed.user_id)
+        RedisHelper.push_object(key, newsfeed, queryset)
+
+    @classmethod
+    def push_newsfeeds_to_cache(cls, newsfeeds, if_missing=False):
+        # used by the fanout batches, the cold newsfeeds are not rebuilt,
+        # see RedisHelper.push_objects. returns the number of cached newsfeeds pushed to
+        keyed_newsfeeds = []
+        for newsfeed in newsfeeds:
+            key = CacheGenerations.get_pattern_key(USER_NEWSFEEDS_PATTERN, user_id=newsfeed.user_id)
+            keyed_newsfeeds.append((key, newsfeed))
+        return RedisHelper.push_objects(keyed_newsfeeds, if_missing=if_missing)
+
+    @classmethod
+    def invalidate_cached_newsfeeds(cls, user_ids):
+        # loaded again from db on the next read
+        keys = []
+        for user_id in user_ids:
+            keys.extend(CacheGenerations.get_pattern_invalidation_keys(
+                USER_NEWSFEEDS_PATTERN,
+                user_id=user_id,
+            ))
+        if keys:
+            RedisClient.delete(keys)
+
+    @classmethod
+    def get_active_since(cls):
+        # the tweets are only fanned out to the followers seen since then,
+        # None if NEWSFEED_FANOUT_ACTIVE_DAYS is off
+        if settings.NEWSFEED_FANOUT_ACTIVE_DAYS is None:
+            return None
+        return utc_now() - timedelta(days=settings.NEWSFEED_FANOUT_ACTIVE_DAYS)
+
+    @classmethod
+    def is_dormant(cls, last_seen_at):
+        active_since = cls.get_active_since()
+        if active_since is None:
+            return False
+        return last_seen_at is None or last_seen_at < active_since
+
+    @classmethod
+    def rebuild_newsfeeds(cls, user_id, since=None):
+        # add the tweets of the followings posted since the user was last seen, they were
+        # not fanned out to a dormant user. the celebrities are pulled when reading anyway.
+        # returns the number of newsfeeds added
+        following_ids = FriendshipService.get_following_user_id_set(user_id) \
+            - FriendshipService.get_celebrity_ids()
+        if not following_ids:
+            return 0
+        tweets = Tweet.objects.filter(user_id__in=following_ids)
+        if since is not None:
+            tweets = tweets.filter(created_at__gt=since)
+        tweets = tweets.order_by('-created_at')[:settings.REDIS_LIST_LENGTH_LIMIT]
+        tweet_ids = list(tweets.values_list('id', flat=True))
+        # the ones fanned out before the user became dormant are already there
+        existing_ids = set(NewsFeed.objects.filter(
+            user_id=user_id,
+            tweet_id__in=tweet_ids,
+        ).values_list('tweet_id', flat=True))
+        newsfeeds = [
+            NewsFeed(user_id=user_id, tweet_id=tweet_id)
+            for tweet_id in reversed(tweet_ids)
+            if tweet_id not in existing_ids
+        ]
+        NewsFeed.objects.bulk_create(newsfeeds, ignore_conflicts=True)
+        # created_at is auto_now_add, the newsfeeds take the time of their tweets so that
+        # they are not ordered above the newer ones, one UPDATE for all of them
+        NewsFeed.objects.filter(
+            user_id=user_id,
+            tweet_id__in=[newsfeed.tweet_id for newsfeed in newsfeeds],
+        ).update(created_at=Subquery(
+            Tweet.objects.filter(id=OuterRef('tweet_id')).values('created_at')[:1],
+        ))
+
+        cls.invalidate_cached_newsfeeds([user_id])
+        return len(newsfeeds)
+
+    @classmethod
+    def get_fanout_progress(cls, tweet):
+        # None if the fanout of the tweet has not started.
+        # delivered: the followers who have the newsfeed, so that it stays right
+        # when batches are retried or dispatched twice.
+        # dispatched, and so pending, are approximate in the 'range' FANOUT_BATCH_MODE,
+        # see FanoutProgress.dispatched
+        progress = FanoutProgress.objects.filter(tweet_id=tweet.id).first()
+        if progress is None:
+            return None
+        progress.delivered = NewsFeed.objects.filter(tweet_id=tweet.id) \
+            .exclude(user_id=tweet.user_id).count()
+        progress.pending = max(progress.dispatched - progress.delivered, 0)
+        return progress
@@ -1,50 +1,199 @@
+import time
+from datetime import timedelta
+
 from celery import shared_task
+from django.conf import settings
+from django.db.models import F
 
 from friendships.services import FriendshipService
-from newsfeeds.constants import FANOUT_BATCH_SIZE
-from newsfeeds.models import NewsFeed
+from newsfeeds.constants import FANOUT_BATCH_SIZE, FanoutStatus
+from newsfeeds.models import FanoutProgress, NewsFeed
 from tweets.models import Tweet
 from utils.time_constants import ONE_HOUR
+from utils.time_helpers import from_microseconds, utc_now
 
 # we need tweet_id and follower_id to create newsfeed.
 # So directly pass in both of them can reduce one db query
 @shared_task(routing_key='newsfeeds', time_limit=ONE_HOUR)
-def fanout_newsfeeds_batch_task(tweet_id, follower_ids):
-    # this is not the final version of this function. will improve it later
+def fanout_newsfeeds_batch_task(tweet_id, follower_ids=None, follower_range=None):
+    # the followers are either follower_ids, or follower_range from
+    # FriendshipService.get_follower_range when FANOUT_BATCH_MODE = 'range'
     # import inside the function to avoid circle dependency
     from newsfeeds.services import NewsFeedService
 
+    # one indexed read per batch, the newsfeeds take the time of the tweet
+    created_at = Tweet.objects.filter(id=tweet_id).values_list('created_at', flat=True).first()
+    if created_at is None:
+        return "tweet {} does not exist.".format(tweet_id)
+    if follower_range is not None:
+        follower_ids = FriendshipService.get_follower_ids_in_range(follower_range)
+
     # shouldn't use sql query inside for loop!
     # for follower_id in follower_ids:
     #     NewsFeed.objects.create(user_id=follower_id, tweet_id=tweet_id)
 
-    # correct approach: use bulk_create
-    newsfeeds = [
-        NewsFeed(user_id=follower_id, tweet_id=tweet_id)
-        for follower_id in follower_ids
-    ]
-    NewsFeed.objects.bulk_create(newsfeeds)
+    # correct approach: use bulk_create.
+    # a retried or re-dispatched batch skips the followers that already have the newsfeed,
+    # and ignores the conflicts with a batch running at the same time
+    existing_ids = set(NewsFeed.objects.filter(
+        tweet_id=tweet_id,
+        user_id__in=follower_ids,
+    ).values_list('user_id', flat=True))
+    new_ids = [follower_id for follower_id in follower_ids if follower_id not in existing_ids]
+    NewsFeed.objects.bulk_create(
+        [NewsFeed(user_id=follower_id, tweet_id=tweet_id) for follower_id in new_ids],
+        ignore_conflicts=True,
+    )
+    # created_at is auto_now_add, a batch that runs late, e.g. resumed after a stall,
+    # would order the newsfeeds above the newer ones. see NewsFeedService.rebuild_newsfeeds
+    NewsFeed.objects.filter(tweet_id=tweet_id, user_id__in=new_ids).update(created_at=created_at)
+    # bulk_create does not set the ids on mysql or when ignoring conflicts,
+    # the cached newsfeeds need them for the pagination
+    newsfeeds = list(NewsFeed.objects.filter(tweet_id=tweet_id, user_id__in=follower_ids))
+    created = [newsfeed for newsfeed in newsfeeds if newsfeed.user_id not in existing_ids]
+    retried = [newsfeed for newsfeed in newsfeeds if newsfeed.user_id in existing_ids]
 
-    # bulk create will not trigger post_save signal, so we need to manually push into cache
-    for newsfeed in newsfeeds:
-        NewsFeedService.push_newsfeed_to_cache(newsfeed)
+    # bulk create will not trigger post_save signal, so we need to manually push into cache.
+    # all of them in one pipeline per redis node, the followers whose newsfeeds are
+    # not cached are skipped, their newsfeeds are loaded from db when they read them.
+    # the newsfeeds that existed may come from a run that died before pushing them,
+    # they are pushed to the cached newsfeeds that do not have them yet
+    start = time.perf_counter()
+    if created_at < utc_now() - timedelta(seconds=settings.FANOUT_PUSH_WINDOW):
+        # an old tweet pushed to the head would sit above the newer newsfeeds
+        NewsFeedService.invalidate_cached_newsfeeds([newsfeed.user_id for newsfeed in newsfeeds])
+        return "{} newsfeeds created, {} cached newsfeeds invalidated in {:.1f}ms.".format(
+            len(created), len(newsfeeds), (time.perf_counter() - start) * 1000,
+        )
+    pushed = NewsFeedService.push_newsfeeds_to_cache(created)
+    pushed += NewsFeedService.push_newsfeeds_to_cache(retried, if_missing=True)
+    redis_time = time.perf_counter() - start
 
     # async can have return value, which will show in the log
-    return "{} newsfeeds created.".format(len(newsfeeds))
+    return "{} newsfeeds created, {} cached newsfeeds pushed in {:.1f}ms.".format(
+        len(created), pushed, redis_time * 1000,
+    )
 
 @shared_task(routing_key='default', time_limit=ONE_HOUR)
-def fanout_newsfeeds_main_task(tweet_id, tweet_user_id):
+def fanout_newsfeeds_main_task(tweet_id, tweet_user_id, attempt=0):
+    # attempt: FanoutProgress.attempt the task was started with, see resume_fanouts_task
+    from newsfeeds.services import NewsFeedService
+
+    # safe to run again: the progress keeps the last dispatched follower,
+    # a retried or resumed fanout continues after it
+    progress, _ = FanoutProgress.objects.get_or_create(tweet_id=tweet_id)
+    if progress.status != FanoutStatus.DISPATCHING:
+        return "fanout already {}.".format(progress.get_status_display().lower())
+    if progress.attempt != attempt:
+        return "fanout taken over by attempt {}.".format(progress.attempt)
+    # every write of the progress is fenced by the attempt, see FanoutProgress.attempt
+    fenced = FanoutProgress.objects.filter(
+        id=progress.id,
+        status=FanoutStatus.DISPATCHING,
+        attempt=attempt,
+    )
+
     # first create the newsfeed that fanout to oneself, so that the author can see the tweet right now.
-    NewsFeed.objects.create(user_id=tweet_user_id, tweet_id=tweet_id)
-
-    # get all follower ids, divide them based on the batch size
-    follower_ids = FriendshipService.get_follower_ids(tweet_user_id)
-    index = 0
-    while index < len(follower_ids):
-        batch_ids = follower_ids[index: index + FANOUT_BATCH_SIZE]
-        fanout_newsfeeds_batch_task.delay(tweet_id, batch_ids)
-        index += FANOUT_BATCH_SIZE
-    return "{} newsfeeds going to fanout, {} batches created.".format(
-        len(follower_ids),
-        (len(follower_ids) - 1) // FANOUT_BATCH_SIZE + 1,
+    NewsFeed.objects.get_or_create(user_id=tweet_user_id, tweet_id=tweet_id)
+
+    # the followers of a celebrity pull its tweets, see NewsFeedService.get_cached_newsfeeds
+    follower_count = FriendshipService.get_follower_count(tweet_user_id)
+    was_celebrity = tweet_user_id in FriendshipService.get_celebrity_ids()
+    if FriendshipService.update_celebrity(tweet_user_id, follower_count):
+        fenced.update(status=FanoutStatus.PULLED, updated_at=utc_now())
+        return "{} followers, celebrity tweet is not fanned out.".format(follower_count)
+    if was_celebrity:
+        # demoted, its followers stop pulling its tweets
+        fanout_pulled_tweets(tweet_user_id)
+
+    # stream the followers after the checkpoint in chunks of the batch size,
+    # each chunk is dispatched before the next one is read.
+    # with NEWSFEED_FANOUT_ACTIVE_DAYS only the active ones, the dormant followers
+    # get their newsfeeds rebuilt when they are seen again
+    checkpoint = None
+    if progress.checkpoint_id is not None:
+        checkpoint = (progress.checkpoint_created_at, progress.checkpoint_id)
+    active_since = NewsFeedService.get_active_since()
+    followers = batches = 0
+    for rows in FriendshipService.iter_follower_rows(
+        tweet_user_id,
+        FANOUT_BATCH_SIZE,
+        after=checkpoint,
+        active_since=active_since,
+    ):
+        last = rows[-1][:2]
+        if settings.FANOUT_BATCH_MODE == 'range':
+            fanout_newsfeeds_batch_task.delay(
+                tweet_id,
+                follower_range=FriendshipService.get_follower_range(
+                    tweet_user_id, checkpoint, last, active_since,
+                ),
+            )
+        else:
+            fanout_newsfeeds_batch_task.delay(tweet_id, [follower_id for _, _, follower_id in rows])
+        # checkpoint after each batch, a batch dispatched twice is harmless
+        checkpoint = last
+        followers += len(rows)
+        batches += 1
+        if not fenced.update(
+            checkpoint_created_at=checkpoint[0],
+            checkpoint_id=checkpoint[1],
+            dispatched=F('dispatched') + len(rows),
+            updated_at=utc_now(),
+        ):
+            return "fanout taken over after {} batches.".format(batches)
+    fenced.update(status=FanoutStatus.DISPATCHED, updated_at=utc_now())
+    return "{} newsfeeds going to fanout, {} batches created.".format(followers, batches)
+
+def fanout_pulled_tweets(tweet_user_id):
+    # fan out the latest tweets the user posted while it was a celebrity, their fanouts
+    # start over like resumed ones, see resume_fanouts_task. only as many as a cached
+    # newsfeed holds, the older ones stay out of the newsfeeds of its followers
+    pulled = FanoutProgress.objects.filter(
+        tweet__user_id=tweet_user_id,
+        status=FanoutStatus.PULLED,
+    ).order_by('-tweet__created_at')[:settings.REDIS_LIST_LENGTH_LIMIT]
+    fanouts = 0
+    for progress_id, attempt, tweet_id in pulled.values_list('id', 'attempt', 'tweet_id'):
+        if FanoutProgress.objects.filter(
+            id=progress_id,
+            status=FanoutStatus.PULLED,
+            attempt=attempt,
+        ).update(status=FanoutStatus.DISPATCHING, attempt=attempt + 1, updated_at=utc_now()):
+            fanout_newsfeeds_main_task.delay(tweet_id, tweet_user_id, attempt + 1)
+            fanouts += 1
+    return fanouts
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def resume_fanouts_task():
+    # the main tasks that stopped dispatching batches, e.g. their worker died
+    stalled_before = utc_now() - timedelta(seconds=settings.FANOUT_STALL_TIMEOUT)
+    progresses = FanoutProgress.objects.filter(
+        status=FanoutStatus.DISPATCHING,
+        updated_at__lt=stalled_before,
     )
+    resumed = 0
+    for progress_id, attempt, tweet_id, tweet_user_id in progresses.values_list(
+        'id', 'attempt', 'tweet_id', 'tweet__user_id',
+    ):
+        # the new attempt fences off the stalled task in case it is only slow, and keeps
+        # the next run from resuming it again while the resumed task is queued
+        if not FanoutProgress.objects.filter(id=progress_id, attempt=attempt).update(
+            attempt=attempt + 1,
+            updated_at=utc_now(),
+        ):
+            continue
+        if tweet_id is not None:
+            fanout_newsfeeds_main_task.delay(tweet_id, tweet_user_id, attempt + 1)
+            resumed += 1
+    return "{} fanouts resumed.".format(resumed)
+
+@shared_task(routing_key='newsfeeds', time_limit=ONE_HOUR)
+def rebuild_newsfeeds_task(user_id, since=None):
+    # since: when the user was last seen, in microseconds
+    from newsfeeds.services import NewsFeedService
+
+    if since is not None:
+        since = from_microseconds(since)
+    created = NewsFeedService.rebuild_newsfeeds(user_id, since)
+    return "{} newsfeeds rebuilt.".format(created)
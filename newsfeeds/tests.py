@@ -1,9 +1,26 @@
-from newsfeeds.models import NewsFeed
+from datetime import timedelta
+
+from django.test import override_settings
+
+from accounts.models import UserProfile
+from accounts.services import UserService
+from accounts.tasks import flush_user_last_seen_task
+
+from friendships.models import Friendship
+from friendships.services import FriendshipService
+from newsfeeds.constants import FanoutStatus
+from newsfeeds.models import FanoutProgress, NewsFeed
 from newsfeeds.services import NewsFeedService
-from newsfeeds.tasks import fanout_newsfeeds_main_task
+from newsfeeds.tasks import (
+    fanout_newsfeeds_batch_task,
+    fanout_newsfeeds_main_task,
+    resume_fanouts_task,
+)
 from testing.testcases import TestCase
-from twitter.cache import USER_NEWSFEEDS_PATTERN
+from tweets.models import Tweet
+from twitter.cache import USER_NEWSFEEDS_PATTERN, USER_TWEETS_PATTERN
 from utils.redis_client import RedisClient
+from utils.time_helpers import utc_now
 
 
 class NewsFeedServiceTests(TestCase):
@@ -59,6 +76,13 @@ class NewsFeedTaskTests(TestCase):
         self.user1 = self.create_user('user1')
         self.user2 = self.create_user('uesr2')
 
+    def create_followers(self):
+        # user2 and 3 more users following user1, 2 fanout batches
+        followers = [self.user2] + [self.create_user('follower{}'.format(i)) for i in range(3)]
+        for follower in followers:
+            self.create_friendship(follower, self.user1)
+        return followers
+
     def test_fanout_main_task(self):
         tweet = self.create_tweet(self.user1, 'tweet1')
         self.create_friendship(self.user2, self.user1)
@@ -88,3 +112,223 @@ class NewsFeedTaskTests(TestCase):
         self.assertEqual(len(cached_list), 3)
         cached_list = NewsFeedService.get_cached_newsfeeds(self.user2.id)
         self.assertEqual(len(cached_list), 3)
+
+    @override_settings(NEWSFEED_CELEBRITY_THRESHOLD=2)
+    def test_celebrity_tweets_are_pulled(self):
+        user3 = self.create_user('user3')
+        self.create_friendship(self.user2, self.user1)
+        self.create_friendship(user3, self.user1)
+        self.create_friendship(self.user2, user3)
+
+        # 2 followers, user1 becomes a celebrity
+        tweet1 = self.create_tweet(self.user1, 'tweet1')
+        msg = fanout_newsfeeds_main_task(tweet1.id, self.user1.id)
+        self.assertEqual(msg, '2 followers, celebrity tweet is not fanned out.')
+        self.assertEqual(NewsFeed.objects.filter(tweet=tweet1).count(), 1)
+        self.assertEqual(FriendshipService.get_celebrity_ids(), {self.user1.id})
+
+        tweet2 = self.create_tweet(user3, 'tweet2')
+        fanout_newsfeeds_main_task(tweet2.id, user3.id)
+        tweet3 = self.create_tweet(self.user1, 'tweet3')
+        fanout_newsfeeds_main_task(tweet3.id, self.user1.id)
+
+        # the pushed newsfeed of tweet2 merged with the tweets of user1
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(self.user2.id)
+        self.assertEqual([f.tweet_id for f in newsfeeds], [tweet3.id, tweet2.id, tweet1.id])
+        self.assertEqual(newsfeeds[0].id, -tweet3.id)
+        # its own tweet is pushed to user3
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(user3.id)
+        self.assertEqual([f.tweet_id for f in newsfeeds], [tweet3.id, tweet2.id, tweet1.id])
+        self.assertEqual(newsfeeds[1].id, NewsFeed.objects.get(user=user3, tweet=tweet2).id)
+
+        # demoted below half of the threshold, fanned out again
+        Friendship.objects.filter(to_user=self.user1).delete()
+        tweet4 = self.create_tweet(self.user1, 'tweet4')
+        msg = fanout_newsfeeds_main_task(tweet4.id, self.user1.id)
+        self.assertEqual(msg, '0 newsfeeds going to fanout, 0 batches created.')
+        self.assertEqual(FriendshipService.get_celebrity_ids(), set())
+
+    @override_settings(NEWSFEED_CELEBRITY_THRESHOLD=4)
+    def test_demoted_celebrity_tweets_are_fanned_out(self):
+        self.create_followers()
+        tweet1 = self.create_tweet(self.user1, 'tweet1')
+        msg = fanout_newsfeeds_main_task(tweet1.id, self.user1.id)
+        self.assertEqual(msg, '4 followers, celebrity tweet is not fanned out.')
+        Tweet.objects.filter(id=tweet1.id).update(created_at=utc_now() - timedelta(days=2))
+        tweet1.refresh_from_db()
+        key = USER_TWEETS_PATTERN.format(user_id=self.user1.id)
+        RedisClient.get_connection(key).delete(key)
+
+        # another user tweets after the pulled tweet
+        user3 = self.create_user('user3')
+        self.create_friendship(self.user2, user3)
+        tweet3 = self.create_tweet(user3, 'tweet3')
+        Tweet.objects.filter(id=tweet3.id).update(created_at=utc_now() - timedelta(days=1))
+        fanout_newsfeeds_main_task(tweet3.id, user3.id)
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(self.user2.id)
+        self.assertEqual([f.tweet_id for f in newsfeeds], [tweet3.id, tweet1.id])
+
+        # 1 follower left, below half of the threshold
+        Friendship.objects.filter(to_user=self.user1).exclude(from_user=self.user2).delete()
+        tweet2 = self.create_tweet(self.user1, 'tweet2')
+        fanout_newsfeeds_main_task(tweet2.id, self.user1.id)
+        self.assertEqual(FriendshipService.get_celebrity_ids(), set())
+        # the tweet posted while it was a celebrity is not lost, and keeps its place
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(self.user2.id)
+        self.assertEqual([f.tweet_id for f in newsfeeds], [tweet2.id, tweet3.id, tweet1.id])
+        newsfeed = NewsFeed.objects.get(user=self.user2, tweet=tweet1)
+        self.assertEqual(newsfeed.created_at, tweet1.created_at)
+        progress = FanoutProgress.objects.get(tweet=tweet1)
+        self.assertEqual((progress.status, progress.attempt), (FanoutStatus.DISPATCHED, 1))
+
+    def test_fanout_batch_task_skips_cold_newsfeeds(self):
+        user3 = self.create_user('user3')
+        self.create_newsfeed(self.user2, self.create_tweet(self.user2))
+        # user2's newsfeeds are cached, user3's are not
+        NewsFeedService.get_cached_newsfeeds(self.user2.id)
+        conn = RedisClient.get_connection()
+        key3 = USER_NEWSFEEDS_PATTERN.format(user_id=user3.id)
+        self.assertEqual(conn.exists(key3), False)
+
+        tweet = self.create_tweet(self.user1)
+        msg = fanout_newsfeeds_batch_task(tweet.id, [self.user2.id, user3.id])
+        self.assertTrue(msg.startswith('2 newsfeeds created, 1 cached newsfeeds pushed in '))
+        self.assertEqual(conn.exists(key3), False)
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(self.user2.id)
+        self.assertEqual([f.tweet_id for f in newsfeeds][0], tweet.id)
+        self.assertEqual(len(newsfeeds), 2)
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(user3.id)
+        self.assertEqual([f.tweet_id for f in newsfeeds], [tweet.id])
+
+        # script cache flushed on the server
+        conn.script_flush()
+        tweet = self.create_tweet(self.user1)
+        msg = fanout_newsfeeds_batch_task(tweet.id, [self.user2.id, user3.id])
+        self.assertTrue(msg.startswith('2 newsfeeds created, 2 cached newsfeeds pushed in '))
+
+    @override_settings(NEWSFEED_FANOUT_ACTIVE_DAYS=7)
+    def test_fanout_to_active_followers(self):
+        user3 = self.create_user('user3')
+        self.create_friendship(self.user2, self.user1)
+        self.create_friendship(user3, self.user1)
+        UserProfile.objects.create(user=self.user2, last_seen_at=utc_now())
+        dormant_since = utc_now() - timedelta(days=30)
+        UserProfile.objects.create(user=user3, last_seen_at=dormant_since)
+
+        old_tweet = self.create_tweet(self.user1, 'before')
+        NewsFeed.objects.create(user=user3, tweet=old_tweet)
+        tweet = self.create_tweet(self.user1, 'tweet')
+        msg = fanout_newsfeeds_main_task(tweet.id, self.user1.id)
+        self.assertEqual(msg, '1 newsfeeds going to fanout, 1 batches created.')
+        self.assertEqual(NewsFeed.objects.filter(user=self.user2, tweet=tweet).exists(), True)
+        self.assertEqual(NewsFeed.objects.filter(user=user3, tweet=tweet).exists(), False)
+        self.assertEqual(len(NewsFeedService.get_cached_newsfeeds(user3.id)), 1)
+
+        # user3 comes back, its newsfeeds are rebuilt from the tweets of user1
+        UserService.touch(user3.id)
+        UserService.touch(self.user2.id)
+        self.assertEqual(flush_user_last_seen_task(), '2 users seen, 1 newsfeeds to rebuild.')
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(user3.id)
+        self.assertEqual([f.tweet_id for f in newsfeeds], [tweet.id, old_tweet.id])
+        self.assertEqual(NewsFeedService.rebuild_newsfeeds(user3.id, dormant_since), 0)
+
+        # the rebuilt newsfeeds are ordered by their tweets, below the newer newsfeeds
+        newer_tweet = self.create_tweet(self.user2)
+        self.create_newsfeed(user3, newer_tweet)
+        Tweet.objects.filter(id=tweet.id).update(created_at=utc_now() - timedelta(days=1))
+        NewsFeed.objects.filter(user=user3, tweet=tweet).delete()
+        self.assertEqual(NewsFeedService.rebuild_newsfeeds(user3.id, dormant_since), 1)
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(user3.id)
+        self.assertEqual([f.tweet_id for f in newsfeeds], [newer_tweet.id, old_tweet.id, tweet.id])
+
+    def test_fanout_is_idempotent_and_resumable(self):
+        followers = self.create_followers()
+        tweet = self.create_tweet(self.user1)
+
+        msg = fanout_newsfeeds_main_task(tweet.id, self.user1.id)
+        self.assertEqual(msg, '4 newsfeeds going to fanout, 2 batches created.')
+        self.assertEqual(NewsFeed.objects.filter(tweet=tweet).count(), 5)
+        progress = FanoutProgress.objects.get(tweet=tweet)
+        self.assertEqual(progress.status, FanoutStatus.DISPATCHED)
+        self.assertEqual(progress.dispatched, 4)
+        self.assertEqual(fanout_newsfeeds_main_task(tweet.id, self.user1.id), 'fanout already dispatched.')
+
+        # a retried batch does not fail on the newsfeeds it created before
+        msg = fanout_newsfeeds_batch_task(tweet.id, [follower.id for follower in followers[:3]])
+        self.assertTrue(msg.startswith('0 newsfeeds created, 0 cached newsfeeds pushed'))
+        self.assertEqual(NewsFeed.objects.filter(tweet=tweet).count(), 5)
+
+        # the main task died after the first batch, resumed after the checkpoint
+        NewsFeed.objects.filter(tweet=tweet, user=followers[3]).delete()
+        friendship = Friendship.objects.get(from_user=followers[2], to_user=self.user1)
+        FanoutProgress.objects.filter(id=progress.id).update(
+            status=FanoutStatus.DISPATCHING,
+            dispatched=3,
+            checkpoint_created_at=friendship.created_at,
+            checkpoint_id=friendship.id,
+            updated_at=utc_now() - timedelta(hours=1),
+        )
+        self.assertEqual(resume_fanouts_task(), '1 fanouts resumed.')
+        # dated by the tweet, not by the resume
+        newsfeed = NewsFeed.objects.get(tweet=tweet, user=followers[3])
+        self.assertEqual(newsfeed.created_at, tweet.created_at)
+        progress.refresh_from_db()
+        self.assertEqual(progress.status, FanoutStatus.DISPATCHED)
+        self.assertEqual((progress.dispatched, progress.attempt), (4, 1))
+        self.assertEqual(resume_fanouts_task(), '0 fanouts resumed.')
+
+        progress = NewsFeedService.get_fanout_progress(tweet)
+        self.assertEqual((progress.delivered, progress.pending), (4, 0))
+
+    def test_retried_batch_pushes_missing_newsfeeds(self):
+        user3 = self.create_user('user3')
+        old_tweet = self.create_tweet(self.user1)
+        for user in (self.user2, user3):
+            self.create_newsfeed(user, old_tweet)
+            NewsFeedService.get_cached_newsfeeds(user.id)
+        tweet = self.create_tweet(self.user1)
+        # the first run created the newsfeeds and died before pushing them
+        NewsFeed.objects.bulk_create([
+            NewsFeed(user=self.user2, tweet=tweet),
+            NewsFeed(user=user3, tweet=tweet),
+        ])
+        NewsFeedService.push_newsfeeds_to_cache(
+            list(NewsFeed.objects.filter(user=self.user2, tweet=tweet)),
+        )
+
+        msg = fanout_newsfeeds_batch_task(tweet.id, [self.user2.id, user3.id])
+        self.assertTrue(msg.startswith('0 newsfeeds created, 2 cached newsfeeds pushed'))
+        for user in (self.user2, user3):
+            newsfeeds = NewsFeedService.get_cached_newsfeeds(user.id)
+            self.assertEqual([f.tweet_id for f in newsfeeds], [tweet.id, old_tweet.id])
+
+    def test_slow_fanout_is_fenced_off(self):
+        self.create_followers()
+        tweet = self.create_tweet(self.user1)
+        # resume_fanouts_task started attempt 1 while the first task was still running
+        FanoutProgress.objects.create(tweet=tweet, attempt=1)
+
+        # the stalled task was only slow, it leaves the progress to the resumed one
+        self.assertEqual(
+            fanout_newsfeeds_main_task(tweet.id, self.user1.id),
+            'fanout taken over by attempt 1.',
+        )
+        msg = fanout_newsfeeds_main_task(tweet.id, self.user1.id, 1)
+        self.assertEqual(msg, '4 newsfeeds going to fanout, 2 batches created.')
+        progress = FanoutProgress.objects.get(tweet=tweet)
+        self.assertEqual((progress.status, progress.dispatched), (FanoutStatus.DISPATCHED, 4))
+
+    @override_settings(FANOUT_BATCH_MODE='range')
+    def test_fanout_with_follower_ranges(self):
+        followers = self.create_followers()
+        NewsFeedService.get_cached_newsfeeds(followers[3].id)
+        tweet = self.create_tweet(self.user1)
+
+        msg = fanout_newsfeeds_main_task(tweet.id, self.user1.id)
+        self.assertEqual(msg, '4 newsfeeds going to fanout, 2 batches created.')
+        self.assertEqual(
+            set(NewsFeed.objects.filter(tweet=tweet).values_list('user_id', flat=True)),
+            {self.user1.id} | {follower.id for follower in followers},
+        )
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(followers[3].id)
+        self.assertEqual([f.tweet_id for f in newsfeeds], [tweet.id])
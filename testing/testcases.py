@@ -1,14 +1,18 @@
+from accounts.services import UserService
 from comments.models import Comment
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.core.cache import caches
+from django.db import connection
 from django.test import TestCase as DjangoTestCase
 
 from friendships.models import Friendship
+from friendships.services import FriendshipService
 from likes.models import Like
 from newsfeeds.models import NewsFeed
 from rest_framework.test import APIClient
 from tweets.models import Tweet
+from utils.cache_generations import CacheGenerations
 from utils.redis_client import RedisClient
 
 
@@ -17,6 +21,18 @@ class TestCase(DjangoTestCase):
     def clear_cache(self):
         caches['testing'].clear()
         RedisClient.clear()
+        CacheGenerations.clear()
+        FriendshipService.clear_celebrity_ids()
+        UserService.clear_touched()
+
+    def run_on_commit_callbacks(self):
+        # TestCase never commits, run what transaction.on_commit queued as a commit would.
+        # connection.run_on_commit is private, replace this with
+        # TestCase.captureOnCommitCallbacks once we are on django >= 3.2
+        callbacks = connection.run_on_commit
+        connection.run_on_commit = []
+        for _, callback in callbacks:
+            callback()
 
     @property
     def anonymous_client(self):
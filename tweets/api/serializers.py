@@ -1,3 +1,4 @@
+from django.contrib.auth.models import User
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 
@@ -8,6 +9,8 @@ from tweets.constants import TWEET_PHOTOS_UPLOAD_LIMIT
 from tweets.models import Tweet
 from accounts.api.serializers import UserSerializer, UserSerializerForTweet
 from tweets.services import TweetService
+from utils.list_serializers import PrefetchListSerializer
+from utils.memcached_helper import MemcachedHelper
 from utils.redis_helper import RedisHelper
 
 
@@ -30,6 +33,11 @@ class TweetSerializer(serializers.ModelSerializer):
             'has_liked',
             'photo_urls',
         )
+        list_serializer_class = PrefetchListSerializer
+
+    def prefetch(self, tweets):
+        MemcachedHelper.prefetch_objects_through_cache(tweets, User, 'user_id', '_cached_user')
+        RedisHelper.prefetch_counts(tweets, ['likes_count', 'comments_count'])
 
     def get_likes_count(self, obj):
         # select count(*) -> redis get
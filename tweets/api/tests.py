@@ -1,16 +1,19 @@
 
 # should end with '/', otherwise will cause 301 redirect
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import override_settings
 from rest_framework import status
 from rest_framework.test import APIClient
 
 from testing.testcases import TestCase
 from tweets.models import Tweet, TweetPhoto
 from utils.paginations import EndlessPagination
+from utils.redis_client import RedisClient
 
 TWEET_LIST_API = '/api/tweets/'
 TWEET_CREATE_API = '/api/tweets/'
 TWEET_RETRIEVE_API = '/api/tweets/{}/'
+TWEET_FANOUT_API = '/api/tweets/{}/fanout/'
 
 
 class TweetApiTests(TestCase):
@@ -222,3 +225,76 @@ class TweetApiTests(TestCase):
 
         # 没有page number的概念，数据量大只要测当前页信息数量而不是总信息数量
 
+    def test_cursor_pagination(self):
+        page_size = EndlessPagination.page_size
+        for i in range(page_size * 2):
+            self.tweets1.append(self.create_tweet(self.user1, 'tweet{}'.format(i)))
+        # tweets created at the same time are neither skipped nor repeated
+        Tweet.objects.filter(user=self.user1).update(created_at=self.tweets1[0].created_at)
+        RedisClient.clear()
+
+        tweet_ids = []
+        params = {'user_id': self.user1.id}
+        while True:
+            response = self.anonymous_client.get(TWEET_LIST_API, params)
+            tweet_ids.extend(result['id'] for result in response.data['results'])
+            if not response.data['has_next_page']:
+                break
+            params['cursor'] = response.data['next_cursor']
+        self.assertEqual(tweet_ids, sorted([tweet.id for tweet in self.tweets1], reverse=True))
+
+        # refresh with the previous cursor of the first page
+        response = self.anonymous_client.get(TWEET_LIST_API, {'user_id': self.user1.id})
+        previous_cursor = response.data['previous_cursor']
+        new_tweet = self.create_tweet(self.user1, 'a new tweet')
+        response = self.anonymous_client.get(TWEET_LIST_API, {
+            'user_id': self.user1.id,
+            'cursor': previous_cursor,
+        })
+        self.assertEqual([result['id'] for result in response.data['results']], [new_tweet.id])
+
+        # cursors are signed
+        response = self.anonymous_client.get(TWEET_LIST_API, {
+            'user_id': self.user1.id,
+            'cursor': previous_cursor + 'x',
+        })
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_request_cache_headers(self):
+        tweet = self.create_tweet(self.user1)
+        self.create_comment(self.user1, tweet)
+        # the author of the tweet is also the author of the comment,
+        # the second lookup is answered by the request cache
+        response = self.anonymous_client.get(TWEET_RETRIEVE_API.format(tweet.id))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(int(response['X-Request-Cache-Hits']) > 0, True)
+        self.assertEqual('X-Request-Cache-Misses' in response, True)
+
+    def test_fanout_status(self):
+        self.create_friendship(self.user2, self.user1)
+        response = self.user1_client.post(TWEET_CREATE_API, {'content': 'fanned out'})
+        url = TWEET_FANOUT_API.format(response.data['id'])
+
+        response = self.anonymous_client.get(url)
+        self.assertEqual(response.status_code, 403)
+        user2_client = APIClient()
+        user2_client.force_authenticate(self.user2)
+        response = user2_client.get(url)
+        self.assertEqual(response.status_code, 403)
+
+        response = self.user1_client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['status'], 'Dispatched')
+        self.assertEqual(response.data['dispatched'], 1)
+        self.assertEqual(response.data['delivered'], 1)
+        self.assertEqual(response.data['pending'], 0)
+
+        # not fanned out
+        response = self.user1_client.get(TWEET_FANOUT_API.format(self.tweets1[0].id))
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(USER_TWEETS_CACHE_MODE='zset')
+class TweetApiSortedSetIndexTests(TweetApiTests):
+    # same tests, with the user tweets cached as a sorted set of ids
+    pass
@@ -1,6 +1,10 @@
+from functools import partial
+
+from django.conf import settings
 from django.utils.decorators import method_decorator
 from ratelimit.decorators import ratelimit
-from rest_framework import viewsets
+from rest_framework import status, viewsets
+from rest_framework.decorators import action
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 
@@ -10,6 +14,7 @@ from tweets.api.serializers import (
     TweetSerializerForDetail,
 )
 from tweets.models import Tweet
+from newsfeeds.api.serializers import FanoutProgressSerializer
 from newsfeeds.services import NewsFeedService
 from tweets.services import TweetService
 from utils.decorators import required_params
@@ -36,8 +41,14 @@ class TweetViewSet(viewsets.GenericViewSet):
         # if 'user_id' not in request.query_params:
         #     return Response('missing user_id', status=400)
         user_id = request.query_params['user_id']
-        cached_tweets = TweetService.get_cached_tweets(user_id=user_id)
-        page = self.paginator.paginate_cached_list(cached_tweets, request)
+        if settings.USER_TWEETS_CACHE_MODE == 'zset':
+            page = self.paginator.paginate_cached_index(
+                partial(TweetService.get_cached_tweets_page, user_id),
+                request,
+            )
+        else:
+            cached_tweets = TweetService.get_cached_tweets(user_id=user_id)
+            page = self.paginator.paginate_cached_list(cached_tweets, request)
 
         # when page is none, it means should retrieve data from database
         if page is None:
@@ -81,4 +92,21 @@ class TweetViewSet(viewsets.GenericViewSet):
         return Response(
             TweetSerializer(tweet, context={'request': request}).data,
             status=201,
-        )
\ No newline at end of file
+        )
+
+    @action(methods=['GET'], detail=True)
+    def fanout(self, request, pk):
+        # delivered / pending newsfeeds of the tweet, for its author and the admins
+        tweet = self.get_object()
+        if tweet.user_id != request.user.id and not request.user.is_staff:
+            return Response({
+                'success': False,
+                'message': 'You do not have permission to access this object.',
+            }, status=status.HTTP_403_FORBIDDEN)
+        progress = NewsFeedService.get_fanout_progress(tweet)
+        if progress is None:
+            return Response({
+                'success': False,
+                'message': 'The fanout of this tweet has not started.',
+            }, status=status.HTTP_404_NOT_FOUND)
+        return Response(FanoutProgressSerializer(progress).data)
@@ -5,7 +5,7 @@ from django.db.models.signals import post_save, pre_delete
 from likes.models import Like
 from tweets.constants import TweetPhotoStatus, TWEET_PHOTO_STATUS_CHOICES
 from tweets.listeners import push_tweet_to_cache
-from utils.listeners import invalidate_object_cache
+from utils.listeners import invalidate_object_cache, refresh_object_cache
 from utils.memcached_helper import MemcachedHelper
 from utils.time_helpers import utc_now
 
@@ -50,6 +50,9 @@ class Tweet(models.Model):
 
     @property
     def cached_user(self):
+        # set by MemcachedHelper.prefetch_objects_through_cache when serializing a whole page
+        if hasattr(self, '_cached_user'):
+            return self._cached_user
         return MemcachedHelper.get_object_through_cache(User, self.user_id)
 
 
@@ -94,6 +97,6 @@ class TweetPhoto(models.Model):
         return f'{self.tweet_id}: {self.file}'
 
 
-post_save.connect(invalidate_object_cache, sender=Tweet)
+post_save.connect(refresh_object_cache, sender=Tweet)
 pre_delete.connect(invalidate_object_cache, sender=Tweet)
 post_save.connect(push_tweet_to_cache, sender=Tweet)
\ No newline at end of file
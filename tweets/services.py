@@ -1,5 +1,9 @@
+from django.conf import settings
+
 from tweets.models import TweetPhoto, Tweet
-from twitter.cache import USER_TWEETS_PATTERN
+from twitter.cache import USER_TWEETS_INDEX_PATTERN, USER_TWEETS_PATTERN
+from utils.cache_generations import CacheGenerations
+from utils.memcached_helper import MemcachedHelper
 from utils.redis_helper import RedisHelper
 
 
@@ -27,14 +31,58 @@ class TweetService(object):
     @classmethod
     def get_cached_tweets(cls, user_id):
         # queryset is lazy loading, so won't visit the database here
-        queryset = Tweet.objects.filter(user_id=user_id).order_by('-created_at')
-        key = USER_TWEETS_PATTERN.format(user_id=user_id)
+        queryset = Tweet.objects.filter(user_id=user_id).order_by('-created_at', '-id')
+        key = CacheGenerations.get_pattern_key(USER_TWEETS_PATTERN, user_id=user_id)
         # 在load_objects中如果没有这个tweet的cache，才会访问数据库得到queryset的结果
         return  RedisHelper.load_objects(key, queryset)
 
+    @classmethod
+    def get_cached_tweets_page(cls, user_id, before=None, after=None, count=None):
+        # USER_TWEETS_CACHE_MODE = 'zset': only ids are in redis, ordered by created_at,
+        # the tweets themselves come from memcached in one get_many.
+        # returns None if the page has to be read from db
+        queryset = Tweet.objects.filter(user_id=user_id).order_by('-created_at', '-id')
+        key = CacheGenerations.get_pattern_key(USER_TWEETS_INDEX_PATTERN, user_id=user_id)
+        tweet_ids = RedisHelper.load_object_ids(key, queryset, before, after, count)
+        if tweet_ids is None:
+            return None
+        return MemcachedHelper.get_objects_through_cache(Tweet, tweet_ids)
+
+    @classmethod
+    def get_latest_cached_tweets(cls, user_id):
+        # the latest REDIS_LIST_LENGTH_LIMIT tweets, from whichever cache USER_TWEETS_CACHE_MODE uses
+        if settings.USER_TWEETS_CACHE_MODE != 'zset':
+            return cls.get_cached_tweets(user_id)
+        tweets = cls.get_cached_tweets_page(user_id, count=settings.REDIS_LIST_LENGTH_LIMIT)
+        if tweets is None:
+            queryset = Tweet.objects.filter(user_id=user_id).order_by('-created_at', '-id')
+            tweets = list(queryset[:settings.REDIS_LIST_LENGTH_LIMIT])
+        return tweets
+
+    @classmethod
+    def warm_cached_tweets(cls, user_ids):
+        # fill the cold tweet caches of these users in a few pipelines,
+        # returns the tweets that were loaded from db
+        querysets = {}
+        index = settings.USER_TWEETS_CACHE_MODE == 'zset'
+        pattern = USER_TWEETS_INDEX_PATTERN if index else USER_TWEETS_PATTERN
+        for user_id in user_ids:
+            key = CacheGenerations.get_pattern_key(pattern, user_id=user_id)
+            querysets[key] = Tweet.objects.filter(user_id=user_id).order_by('-created_at', '-id')
+        filled = RedisHelper.fill_many(querysets, index=index)
+        if not index:
+            return [tweet for tweets in filled.values() for tweet in tweets]
+        # only the ids are in redis, the tweets are read from memcached
+        tweet_ids = [tweet_id for rows in filled.values() for tweet_id, _ in rows]
+        return MemcachedHelper.get_objects_through_cache(Tweet, tweet_ids)
+
     # use this when creating tweet (listener)
     @classmethod
     def push_tweet_to_cache(cls, tweet):
-        queryset = Tweet.objects.filter(user_id=tweet.user_id).order_by('-created_at')
-        key = USER_TWEETS_PATTERN.format(user_id=tweet.user_id)
+        queryset = Tweet.objects.filter(user_id=tweet.user_id).order_by('-created_at', '-id')
+        if settings.USER_TWEETS_CACHE_MODE == 'zset':
+            key = CacheGenerations.get_pattern_key(USER_TWEETS_INDEX_PATTERN, user_id=tweet.user_id)
+            RedisHelper.push_object_to_index(key, tweet, queryset)
+            return
+        key = CacheGenerations.get_pattern_key(USER_TWEETS_PATTERN, user_id=tweet.user_id)
         RedisHelper.push_object(key, tweet, queryset)
@@ -0,0 +1,16 @@
+from celery import shared_task
+
+from tweets.models import Tweet
+from utils.redis_helper import RedisHelper
+from utils.time_constants import ONE_HOUR
+
+
+# likes_count and comments_count are kept in redis (write behind),
+# this periodic task writes the accumulated deltas back to the tweets table
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def flush_tweet_counters_task():
+    flushed = 0
+    for attr in ('likes_count', 'comments_count'):
+        flushed += RedisHelper.flush_count_deltas(Tweet, attr)
+    RedisHelper.delete_old_flushes()
+    return '{} tweet counters flushed.'.format(flushed)
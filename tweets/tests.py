@@ -1,12 +1,17 @@
 from datetime import timedelta
+from django.test import override_settings
 from testing.testcases import TestCase
 from tweets.constants import TweetPhotoStatus
-from tweets.models import TweetPhoto
+from tweets.models import Tweet, TweetPhoto
 from tweets.services import TweetService
-from twitter.cache import USER_TWEETS_PATTERN
+from tweets.tasks import flush_tweet_counters_task
+from twitter.cache import USER_TWEETS_INDEX_PATTERN, USER_TWEETS_PATTERN
+from utils.models import CounterFlush
 from utils.redis_client import RedisClient
+from utils.redis_helper import FLUSH_ID_FIELD, RedisHelper
+from utils.redis_scripts import FINISH_FLUSH_SCRIPT
 from utils.redis_serializers import DjangoModelSerializer
-from utils.time_helpers import utc_now
+from utils.time_helpers import to_microseconds, utc_now
 
 # Create your tests here.
 
@@ -102,3 +107,127 @@ class TweetServiceTests(TestCase):
         # test order
         tweets = TweetService.get_cached_tweets(self.user1.id)
         self.assertEqual([t.id for t in tweets], [tweet2.id, tweet1.id])
+
+    @override_settings(USER_TWEETS_CACHE_MODE='zset', REDIS_LIST_LENGTH_LIMIT=5)
+    def test_get_cached_tweets_page(self):
+        tweets = [self.create_tweet(self.user1, 'tweet {}'.format(i)) for i in range(7)]
+        # two tweets created in the same microsecond, ordered by id
+        Tweet.objects.filter(id=tweets[3].id).update(created_at=tweets[4].created_at)
+        tweets = list(Tweet.objects.filter(user=self.user1).order_by('-created_at', '-id'))
+        RedisClient.clear()
+        conn = RedisClient.get_connection()
+        key = USER_TWEETS_INDEX_PATTERN.format(user_id=self.user1.id)
+
+        def position(tweet):
+            return to_microseconds(tweet.created_at), tweet.id
+
+        # cache miss, the index keeps the latest 5 ids only
+        page = TweetService.get_cached_tweets_page(self.user1.id, count=3)
+        self.assertEqual([t.id for t in page], [t.id for t in tweets[:3]])
+        self.assertEqual(conn.zcard(key), 5)
+
+        # next page starts in the middle of the tie
+        page = TweetService.get_cached_tweets_page(
+            self.user1.id, before=position(tweets[2]), count=2,
+        )
+        self.assertEqual([t.id for t in page], [tweets[3].id, tweets[4].id])
+
+        # older tweets are only in db
+        page = TweetService.get_cached_tweets_page(
+            self.user1.id, before=position(tweets[3]), count=2,
+        )
+        self.assertEqual(page, None)
+
+        # new tweet is added to the index, the oldest one is dropped
+        new_tweet = self.create_tweet(self.user1, 'new tweet')
+        self.assertEqual(conn.zcard(key), 5)
+        self.assertEqual(conn.zscore(key, RedisHelper.get_index_member(tweets[4].id)), None)
+        page = TweetService.get_cached_tweets_page(self.user1.id, after=position(tweets[0]))
+        self.assertEqual([t.id for t in page], [new_tweet.id])
+
+
+class TweetCounterTests(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+        self.user1 = self.create_user('user1')
+        self.tweet = self.create_tweet(self.user1)
+
+    def test_write_behind_flush(self):
+        for i in range(3):
+            RedisHelper.incr_count(self.tweet, 'likes_count')
+        RedisHelper.incr_count(self.tweet, 'comments_count')
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 0)
+        self.assertEqual(RedisHelper.get_count(self.tweet, 'likes_count'), 3)
+
+        msg = flush_tweet_counters_task()
+        self.assertEqual(msg, '2 tweet counters flushed.')
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 3)
+        self.assertEqual(self.tweet.comments_count, 1)
+        self.assertEqual(RedisHelper.get_count(self.tweet, 'likes_count'), 3)
+
+        # nothing new to flush
+        self.assertEqual(flush_tweet_counters_task(), '0 tweet counters flushed.')
+
+    def test_flush_resumes_after_crash(self):
+        conn = RedisClient.get_connection()
+        deltas_key, flushing_key = RedisHelper.get_count_delta_keys(Tweet, 'likes_count')
+        RedisHelper.incr_count(self.tweet, 'likes_count')
+        RedisHelper.incr_count(self.tweet, 'likes_count')
+        # a worker died right after taking the deltas
+        conn.rename(deltas_key, flushing_key)
+        RedisHelper.decr_count(self.tweet, 'likes_count')
+
+        # the count is rebuilt from db + deltas in both hashes
+        conn.delete(RedisHelper.get_count_key(self.tweet, 'likes_count'))
+        self.assertEqual(RedisHelper.get_count(self.tweet, 'likes_count'), 1)
+
+        flush_tweet_counters_task()
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 1)
+        self.assertEqual(conn.exists(deltas_key, flushing_key), 0)
+
+    def test_flush_applied_once(self):
+        conn = RedisClient.get_connection()
+        deltas_key, flushing_key = RedisHelper.get_count_delta_keys(Tweet, 'likes_count')
+        RedisHelper.incr_count(self.tweet, 'likes_count')
+        RedisHelper.incr_count(self.tweet, 'likes_count')
+        conn.rename(deltas_key, flushing_key)
+        conn.hset(flushing_key, FLUSH_ID_FIELD, 'flush1')
+        # a worker died after committing the flush, before deleting the hash
+        CounterFlush.objects.create(flush_id='flush1')
+        Tweet.objects.filter(id=self.tweet.id).update(likes_count=2)
+
+        # the deltas of the applied flush are not added to db again
+        conn.delete(RedisHelper.get_count_key(self.tweet, 'likes_count'))
+        self.assertEqual(RedisHelper.get_count(self.tweet, 'likes_count'), 2)
+        self.assertEqual(flush_tweet_counters_task(), '0 tweet counters flushed.')
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 2)
+        self.assertEqual(conn.exists(flushing_key), 0)
+
+    def test_flush_keeps_newer_deltas(self):
+        conn = RedisClient.get_connection()
+        deltas_key, flushing_key = RedisHelper.get_count_delta_keys(Tweet, 'likes_count')
+        RedisHelper.incr_count(self.tweet, 'likes_count')
+        conn.rename(deltas_key, flushing_key)
+        conn.hset(flushing_key, FLUSH_ID_FIELD, 'flush2')
+        # a flusher that lost its lock to a newer flush does not delete its deltas
+        RedisClient.run_script(
+            FINISH_FLUSH_SCRIPT, keys=[flushing_key], args=[FLUSH_ID_FIELD, 'flush1'], conn=conn,
+        )
+        self.assertEqual(conn.exists(flushing_key), 1)
+        flush_tweet_counters_task()
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 1)
+
+    def test_delete_old_flushes(self):
+        CounterFlush.objects.create(flush_id='flush1')
+        old = CounterFlush.objects.create(flush_id='flush2')
+        CounterFlush.objects.filter(id=old.id).update(created_at=utc_now() - timedelta(days=2))
+        self.assertEqual(RedisHelper.delete_old_flushes(), 1)
+        self.assertEqual(
+            list(CounterFlush.objects.values_list('flush_id', flat=True)), ['flush1'],
+        )
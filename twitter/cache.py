@@ -4,6 +4,25 @@ USER_PROFILE_PATTERN = 'userprofile:{user_id}'
 
 # redis
 USER_TWEETS_PATTERN = 'user_tweets:{user_id}'
+# sorted set of tweet ids scored by created_at, used when USER_TWEETS_CACHE_MODE = 'zset'
+USER_TWEETS_INDEX_PATTERN = 'user_tweets_index:{user_id}'
 USER_NEWSFEEDS_PATTERN = 'user_newsfeeds:{user_id}'
+# set of the ids of the users whose tweets are not fanned out, their followers pull
+# them when reading their newsfeeds. no id in the key, it lives on the first node
+CELEBRITIES_KEY = 'celebrities'
+# hash of user id -> when the user was last seen (microseconds), written to
+# UserProfile.last_seen_at in batches. no id in the key, it lives on the first node
+USER_LAST_SEEN_KEY = 'user_last_seen'
+# the last seen times being written to db, kept until the profiles are written
+USER_LAST_SEEN_FLUSHING_KEY = 'user_last_seen_flushing'
+# write behind counters, hash of object id -> increments not written to db yet
+# counter is like Tweet.likes_count
+COUNTER_DELTAS_PATTERN = 'counter_deltas:{counter}'
+# the deltas being written to db by the flush task, kept until the db transaction commits
+COUNTER_FLUSHING_PATTERN = 'counter_flushing:{counter}'
+
+# generation of a cache namespace, see utils/cache_generations.py
+# namespace is a model name (User) or the prefix of a pattern above (userprofile)
+CACHE_GENERATION_PATTERN = 'cache_generation:{namespace}'
 
 # ...
\ No newline at end of file
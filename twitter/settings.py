@@ -53,6 +53,8 @@ INSTALLED_APPS = [
     'comments',
     'likes',
     'inbox',
+    # shared helpers, only registered for its management commands
+    'utils',
 ]
 
 REST_FRAMEWORK = {
@@ -76,6 +78,10 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # request scoped identity map in front of memcached, see utils/request_cache.py
+    'utils.middlewares.RequestCacheMiddleware',
+    # last seen time of the users, see UserService.touch
+    'utils.middlewares.UserActivityMiddleware',
 ]
 
 ROOT_URLCONF = 'twitter.urls'
@@ -178,25 +184,60 @@ MEDIA_ROOT = 'media/'
 # sudo apt-get install memcached
 # use `pip install python-memcached`
 # DO NOT pip install memcache or django-memcached (out-dated)
+# memcached nodes, keys are spread over them by consistent hashing,
+# see utils/memcached_backend.py
+MEMCACHED_NODES = ['127.0.0.1:11211']
+MEMCACHED_OPTIONS = {
+    # a node that does not answer is left out of the hash ring for this long
+    'dead_retry': 30,  # in seconds
+    'socket_timeout': 1,  # in seconds
+}
+
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
-        'LOCATION': '127.0.0.1:11211',
+        'BACKEND': 'utils.memcached_backend.KetamaMemcachedCache',
+        'LOCATION': MEMCACHED_NODES,
         'TIMEOUT': 86400, # default TTL(time to live)
+        'OPTIONS': MEMCACHED_OPTIONS,
     },
     'testing': {
-        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
-        'LOCATION': '127.0.0.1:11211',
+        'BACKEND': 'utils.memcached_backend.KetamaMemcachedCache',
+        'LOCATION': MEMCACHED_NODES,
         'TIMEOUT': 86400,
         'KEY_PREFIX': 'testing',
+        'OPTIONS': MEMCACHED_OPTIONS,
     },
     'ratelimit': {
-        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
-        'LOCATION': '127.0.0.1:11211',
+        'BACKEND': 'utils.memcached_backend.KetamaMemcachedCache',
+        'LOCATION': MEMCACHED_NODES,
         'TIMEOUT': 86400 * 7,
         'KEY_PREFIX': 'rl',
+        'OPTIONS': MEMCACHED_OPTIONS,
     },
 }
+# objects that are not in db are cached as a tombstone for a short time,
+# see utils/memcached_helper.py
+MEMCACHED_TOMBSTONE_TIMEOUT = 60  # in seconds
+# probabilistic early refresh (XFetch) of memcached and redis entries, see utils/early_refresh.py
+CACHE_EARLY_REFRESH = False
+CACHE_EARLY_REFRESH_BETA = 1.0  # > 1 refreshes earlier, < 1 later
+CACHE_TTL_JITTER = 0.1  # ttls are shortened by up to this ratio on write
+# generations of the cache namespaces are re-read from redis this often,
+# see utils/cache_generations.py
+CACHE_GENERATION_REFRESH = 5  # in seconds
+# saved User / Tweet / UserProfile objects are written to cache after commit
+# instead of deleted from it, deletes still invalidate
+CACHE_WRITE_THROUGH = True
+# rows without updated_at can not tell which concurrent save is newer,
+# they are written through with this timeout, see MemcachedHelper.write_through
+CACHE_WRITE_THROUGH_TIMEOUT = 60  # in seconds
+# cached values at least this large are compressed with zlib, see utils/compression.py
+# per key pattern thresholds override the default, None turns compression off
+CACHE_COMPRESSION_THRESHOLD = 1024  # in bytes
+CACHE_COMPRESSION_THRESHOLDS = {
+    # e.g. 'followings': 512,
+}
+CACHE_COMPRESSION_LEVEL = 6
 
 # Redis
 # 安装方法: sudo apt-get install redis
@@ -204,8 +245,61 @@ CACHES = {
 REDIS_HOST = '127.0.0.1'
 REDIS_PORT = 6379 # 查一下得到的默认redis跑的端口
 REDIS_DB = 0 if TESTING else 1 # 和memcached区分方法不一样
+# the keyspace is sharded over these nodes by consistent hashing on the id in the key,
+# see utils/redis_client.py. run `python manage.py rebalance_redis` after adding a node
+REDIS_NODES = [
+    {'host': REDIS_HOST, 'port': REDIS_PORT, 'db': REDIS_DB},
+]
+# connection pool of each process, see utils/redis_client.py
+REDIS_MAX_CONNECTIONS = 50
+REDIS_POOL_TIMEOUT = 1  # in seconds, wait for a free connection when all are in use
+REDIS_SOCKET_TIMEOUT = 1  # in seconds
+REDIS_SOCKET_CONNECT_TIMEOUT = 1  # in seconds
+REDIS_HEALTH_CHECK_INTERVAL = 30  # in seconds
 REDIS_KEY_EXPIRE_TIME = 7 * 86400  # in seconds
 REDIS_LIST_LENGTH_LIMIT = 200 if not TESTING else 20
+# only one process rebuilds a missing list from db, the others wait for it
+REDIS_FILL_LOCK_TIMEOUT = 5  # in seconds
+REDIS_FILL_POLL_INTERVAL = 0.01  # in seconds
+# how the tweets of a user are cached
+#   'list': the latest tweets serialized in a redis list
+#   'zset': a redis sorted set of tweet ids scored by created_at, the tweets are
+#           read from memcached in one get_many, so each tweet is stored only once
+USER_TWEETS_CACHE_MODE = 'list'
+# the tweets of users with at least this many followers are not fanned out, followers
+# merge them into their newsfeeds when reading. accounts are reclassified when they
+# tweet, and demoted only below half of the threshold so that they do not flip
+NEWSFEED_CELEBRITY_THRESHOLD = 10000
+NEWSFEED_CELEBRITY_REFRESH = 5  # in seconds, the celebrity set is re-read from redis this often
+# only the followers seen during the last days get the tweets fanned out, None for all
+# of them. the newsfeeds of the others are rebuilt when they are seen again
+NEWSFEED_FANOUT_ACTIVE_DAYS = None
+# a user is recorded as seen at most this often by each process, see UserService.touch
+USER_ACTIVITY_TOUCH_INTERVAL = 60  # in seconds
+# a fanout that has not dispatched a batch for this long is resumed from its checkpoint,
+# see newsfeeds.tasks.resume_fanouts_task
+FANOUT_STALL_TIMEOUT = 300  # in seconds
+# the newsfeeds of a tweet older than this, e.g. replayed after a celebrity is demoted,
+# are not pushed to the head of the cached newsfeeds, those are loaded again from db
+FANOUT_PUSH_WINDOW = 3600  # in seconds
+# what a fanout batch task receives
+#   'ids': the ids of its followers
+#   'range': the (created_at, id) bounds of its followers in the (to_user_id, created_at)
+#            index, a few ints instead of a list of FANOUT_BATCH_SIZE ids in the broker,
+#            the batch reads the ids itself, so the dispatched / pending counts of the
+#            fanout progress are approximate
+FANOUT_BATCH_MODE = 'ids'
+
+# Process local LRU cache under memcached for the hottest objects, see utils/local_cache.py
+# invalidations are broadcast to every worker through the redis channel below
+LOCAL_CACHE_ENABLED = False
+LOCAL_CACHE_MAX_SIZE = 10000  # number of entries per process
+LOCAL_CACHE_TIMEOUT = 60  # in seconds
+LOCAL_CACHE_INVALIDATION_CHANNEL = 'local_cache_invalidation'
+
+# hits / misses / latency of the caches per key pattern, see utils/cache_metrics.py
+# exposed to prometheus on /api/metrics/ (admin only)
+CACHE_METRICS_ENABLED = True
 
 # Celery Configuration Options
 # 使用如下命令把 worker 进程（只执行异步任务的进程，可以在不同的机器上）单独跑起来
@@ -218,6 +312,27 @@ CELERY_QUEUES = (
     Queue('default', routing_key='default'),
     Queue('newsfeeds', routing_key='newsfeeds'),
 )
+# periodic tasks, run the scheduler with
+#   celery -A twitter beat -l INFO
+CELERY_BEAT_SCHEDULE = {
+    'flush-tweet-counters': {
+        'task': 'tweets.tasks.flush_tweet_counters_task',
+        'schedule': 10.0,  # in seconds
+    },
+    'flush-user-last-seen': {
+        'task': 'accounts.tasks.flush_user_last_seen_task',
+        'schedule': 10.0,  # in seconds
+    },
+    'resume-fanouts': {
+        'task': 'newsfeeds.tasks.resume_fanouts_task',
+        'schedule': 60.0,  # in seconds
+    },
+}
+
+# write behind counters, see RedisHelper.flush_count_deltas
+COUNTER_FLUSH_LOCK_TIMEOUT = 60  # in seconds
+# applied flush ids are kept this long to recognize a flush that is retried
+COUNTER_FLUSH_RETENTION = 86400  # in seconds
 
 # Rate limit
 RATELIMIT_USE_CACHE = 'ratelimit'
@@ -26,6 +26,7 @@ from friendships.api.views import FriendshipViewSet
 from newsfeeds.api.views import NewsFeedViewSet
 from comments.api.views import CommentViewSet
 from inbox.api.views import NotificationViewSet
+from utils.views import metrics
 import notifications.urls
 
 router = routers.DefaultRouter()
@@ -43,6 +44,7 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('', include(router.urls)),
     path('api-auth/', include('rest_framework.urls', namespace='rest_framework')),
+    path('api/metrics/', metrics, name='metrics'),
     url('^inbox/notifications/', include(notifications.urls, namespace='notifications')),
 ]
 
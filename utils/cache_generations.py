@@ -0,0 +1,84 @@
+import threading
+import time
+
+from django.conf import settings
+
+from twitter.cache import CACHE_GENERATION_PATTERN
+from utils.redis_client import RedisClient
+
+
+class CacheGenerations:
+    """
+    Generation counter per cache namespace: a model for the Model:id objects of
+    MemcachedHelper, or the prefix of a pattern in twitter/cache.py. The generation
+    is part of the keys, so bumping it drops the whole namespace at once without a
+    flush: readers build new keys and the old entries age out by their ttl.
+    Generation 0 keeps the plain keys (User:1), then User:g1:1, User:g2:1 ...
+    The counters are in redis, on the first node so that adding nodes does not move
+    them. Each process keeps what it read for CACHE_GENERATION_REFRESH seconds, a bump
+    reaches the other processes within that time. Meanwhile they read both the old and
+    the new generation, so invalidations read the generation from redis and delete the
+    key in both of them, see get_invalidation_keys.
+    The write behind counters are not versioned, their deltas must not be dropped.
+    """
+    # namespace -> (generation, time.monotonic() when read)
+    _generations = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls, namespace, fresh=False):
+        # fresh: read redis even if this process read it recently
+        cached = cls._generations.get(namespace)
+        now = time.monotonic()
+        if not fresh and cached is not None \
+                and now - cached[1] < settings.CACHE_GENERATION_REFRESH:
+            return cached[0]
+        key = CACHE_GENERATION_PATTERN.format(namespace=namespace)
+        generation = int(RedisClient.get_connection().get(key) or 0)
+        with cls._lock:
+            cls._generations[namespace] = (generation, now)
+        return generation
+
+    @classmethod
+    def bump(cls, namespace):
+        key = CACHE_GENERATION_PATTERN.format(namespace=namespace)
+        generation = RedisClient.get_connection().incr(key)
+        with cls._lock:
+            cls._generations[namespace] = (generation, time.monotonic())
+        return generation
+
+    @classmethod
+    def format_key(cls, namespace, key, generation=None):
+        # key starts with the namespace, e.g. userprofile:1 -> userprofile:g2:1
+        if generation is None:
+            generation = cls.get(namespace)
+        if not generation:
+            return key
+        return '{}:g{}{}'.format(namespace, generation, key[len(namespace):])
+
+    @classmethod
+    def get_pattern_key(cls, pattern, **kwargs):
+        # FOLLOWINGS_PATTERN.format(user_id=1) with the generation of 'followings'
+        namespace = pattern.split(':', 1)[0]
+        return cls.format_key(namespace, pattern.format(**kwargs))
+
+    @classmethod
+    def get_invalidation_keys(cls, namespace, key):
+        # the key in the current generation in redis, then in the one before, which the
+        # processes that have not seen the bump yet still read and fill
+        generation = cls.get(namespace, fresh=True)
+        keys = [cls.format_key(namespace, key, generation)]
+        if generation:
+            keys.append(cls.format_key(namespace, key, generation - 1))
+        return keys
+
+    @classmethod
+    def get_pattern_invalidation_keys(cls, pattern, **kwargs):
+        namespace = pattern.split(':', 1)[0]
+        return cls.get_invalidation_keys(namespace, pattern.format(**kwargs))
+
+    @classmethod
+    def clear(cls):
+        # forget what this process read, for testing purpose
+        with cls._lock:
+            cls._generations.clear()
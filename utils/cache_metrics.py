@@ -0,0 +1,203 @@
+import bisect
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+
+# upper bounds of the histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+# compression of a single value is much faster than a round trip
+CODEC_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01)
+
+
+class Histogram:
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        total = 0
+        for bucket, count in zip(self.buckets, self.counts):
+            total += count
+            yield bucket, total
+
+
+class CacheMetrics:
+    """
+    In process counters of the caches, labelled by key pattern: the part of the key
+    before the first ':' (followings, userprofile, user_tweets, user_newsfeeds,
+    Model for the Model:id object cache, Model.attr for the counters). A batch
+    command serving several patterns is timed under each of them.
+    - hits by tier (request, local, memcached, redis) and misses
+    - fill: time to rebuild the cache from db on a miss
+    - round trip: time of the memcached / redis command
+    - compression: bytes before / after and time to compress / decompress, see
+      utils/compression.py
+    Rendered in prometheus text format by utils.views.metrics. Every worker process
+    has its own numbers, prometheus should scrape each of them.
+    """
+    _lock = threading.Lock()
+    _hits = defaultdict(int)
+    _misses = defaultdict(int)
+    _fills = {}
+    _round_trips = {}
+    _codecs = {}
+    # pattern -> [bytes before compression, bytes after]
+    _compressed_bytes = defaultdict(lambda: [0, 0])
+
+    @classmethod
+    def is_enabled(cls):
+        return settings.CACHE_METRICS_ENABLED
+
+    @classmethod
+    def get_pattern(cls, key):
+        return key.split(':', 1)[0]
+
+    @classmethod
+    def hit(cls, pattern, tier, count=1):
+        if not count or not cls.is_enabled():
+            return
+        with cls._lock:
+            cls._hits[(pattern, tier)] += count
+
+    @classmethod
+    def miss(cls, pattern, count=1):
+        if not count or not cls.is_enabled():
+            return
+        with cls._lock:
+            cls._misses[pattern] += count
+
+    @classmethod
+    def compressed(cls, pattern, raw_size, stored_size):
+        if not cls.is_enabled():
+            return
+        with cls._lock:
+            sizes = cls._compressed_bytes[pattern]
+            sizes[0] += raw_size
+            sizes[1] += stored_size
+
+    @classmethod
+    def _observe(cls, histograms, labels, seconds, buckets=LATENCY_BUCKETS):
+        with cls._lock:
+            histogram = histograms.get(labels)
+            if histogram is None:
+                histogram = histograms[labels] = Histogram(buckets)
+            histogram.observe(seconds)
+
+    @classmethod
+    def _observe_patterns(cls, histograms, patterns, extra, seconds):
+        # a batch command serving several patterns (e.g. the counters of a page of
+        # tweets) is observed once under each of them
+        if isinstance(patterns, str):
+            patterns = (patterns,)
+        for pattern in patterns:
+            cls._observe(histograms, (pattern,) + extra, seconds)
+
+    @classmethod
+    @contextmanager
+    def time_fill(cls, pattern):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if cls.is_enabled():
+                cls._observe_patterns(cls._fills, pattern, (), time.perf_counter() - start)
+
+    @classmethod
+    @contextmanager
+    def time_round_trip(cls, pattern, backend):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if cls.is_enabled():
+                cls._observe_patterns(
+                    cls._round_trips, pattern, (backend,), time.perf_counter() - start,
+                )
+
+    @classmethod
+    @contextmanager
+    def time_codec(cls, pattern, operation):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if cls.is_enabled():
+                cls._observe(
+                    cls._codecs, (pattern, operation), time.perf_counter() - start, CODEC_BUCKETS,
+                )
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls._hits.clear()
+            cls._misses.clear()
+            cls._fills.clear()
+            cls._round_trips.clear()
+            cls._codecs.clear()
+            cls._compressed_bytes.clear()
+
+    @classmethod
+    def _format_labels(cls, names, values, extra=()):
+        pairs = list(zip(names, values)) + list(extra)
+        return ','.join('{}="{}"'.format(name, value) for name, value in pairs)
+
+    @classmethod
+    def _render_histograms(cls, lines, name, label_names, histograms):
+        lines.append('# TYPE {} histogram'.format(name))
+        for labels, histogram in sorted(histograms.items()):
+            for bucket, count in histogram.cumulative_counts():
+                lines.append('{}_bucket{{{}}} {}'.format(
+                    name, cls._format_labels(label_names, labels, [('le', bucket)]), count,
+                ))
+            lines.append('{}_bucket{{{}}} {}'.format(
+                name, cls._format_labels(label_names, labels, [('le', '+Inf')]), histogram.count,
+            ))
+            label_text = cls._format_labels(label_names, labels)
+            lines.append('{}_sum{{{}}} {}'.format(name, label_text, histogram.sum))
+            lines.append('{}_count{{{}}} {}'.format(name, label_text, histogram.count))
+
+    @classmethod
+    def render(cls):
+        # prometheus text exposition format
+        with cls._lock:
+            lines = ['# TYPE twitter_cache_hits_total counter']
+            for (pattern, tier), count in sorted(cls._hits.items()):
+                lines.append('twitter_cache_hits_total{{{}}} {}'.format(
+                    cls._format_labels(('pattern', 'tier'), (pattern, tier)), count,
+                ))
+            lines.append('# TYPE twitter_cache_misses_total counter')
+            for pattern, count in sorted(cls._misses.items()):
+                lines.append('twitter_cache_misses_total{{{}}} {}'.format(
+                    cls._format_labels(('pattern',), (pattern,)), count,
+                ))
+            cls._render_histograms(
+                lines, 'twitter_cache_fill_seconds', ('pattern',), cls._fills,
+            )
+            cls._render_histograms(
+                lines, 'twitter_cache_round_trip_seconds', ('pattern', 'backend'), cls._round_trips,
+            )
+            # compression ratio of a pattern = output / input
+            for name, index in (('input', 0), ('output', 1)):
+                metric = 'twitter_cache_compression_{}_bytes_total'.format(name)
+                lines.append('# TYPE {} counter'.format(metric))
+                for pattern, sizes in sorted(cls._compressed_bytes.items()):
+                    lines.append('{}{{{}}} {}'.format(
+                        metric, cls._format_labels(('pattern',), (pattern,)), sizes[index],
+                    ))
+            cls._render_histograms(
+                lines, 'twitter_cache_compression_seconds', ('pattern', 'operation'), cls._codecs,
+            )
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,66 @@
+import pickle
+import zlib
+
+from django.conf import settings
+
+from utils.cache_metrics import CacheMetrics
+
+# first byte of a compressed value. none of the formats we store starts with it:
+# pickle starts with 0x80, CompactModelSerializer with its version, json with '['
+COMPRESSED_MARKER = b'\xfe'
+PICKLE_MARKER = b'\x80'
+
+
+class Compression:
+    """
+    zlib compression of the values at least as large as the threshold of their key
+    pattern (CACHE_COMPRESSION_THRESHOLDS, else CACHE_COMPRESSION_THRESHOLD). Compressed
+    values start with COMPRESSED_MARKER, anything else is read as it is, so values
+    written before, or not worth compressing, need no migration.
+    Sizes before / after and the time spent go to CacheMetrics, to tune the thresholds.
+    """
+
+    @classmethod
+    def get_threshold(cls, pattern):
+        return settings.CACHE_COMPRESSION_THRESHOLDS.get(
+            pattern, settings.CACHE_COMPRESSION_THRESHOLD,
+        )
+
+    @classmethod
+    def compress(cls, pattern, data):
+        threshold = cls.get_threshold(pattern)
+        if threshold is None or len(data) < threshold:
+            return data
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        with CacheMetrics.time_codec(pattern, 'compress'):
+            compressed = COMPRESSED_MARKER + zlib.compress(data, settings.CACHE_COMPRESSION_LEVEL)
+        if len(compressed) >= len(data):
+            # not compressible, e.g. already compressed images
+            CacheMetrics.compressed(pattern, len(data), len(data))
+            return data
+        CacheMetrics.compressed(pattern, len(data), len(compressed))
+        return compressed
+
+    @classmethod
+    def decompress(cls, pattern, data):
+        if not isinstance(data, bytes) or data[:1] != COMPRESSED_MARKER:
+            return data
+        with CacheMetrics.time_codec(pattern, 'decompress'):
+            return zlib.decompress(data[1:])
+
+    @classmethod
+    def dumps(cls, pattern, value):
+        # for memcached: values are pickled here, so that their size is known.
+        # python-memcached stores bytes as they are
+        return cls.compress(pattern, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    @classmethod
+    def loads(cls, pattern, data):
+        # values pickled by python-memcached itself come back as objects already
+        if not isinstance(data, bytes):
+            return data
+        data = cls.decompress(pattern, data)
+        if data[:1] != PICKLE_MARKER:
+            return data
+        return pickle.loads(data)
@@ -0,0 +1,58 @@
+import math
+import random
+import time
+from collections import namedtuple
+
+from django.conf import settings
+
+# a cached value with the time it took to compute (delta, in seconds)
+# and the unix time it expires at
+CacheEntry = namedtuple('CacheEntry', ['value', 'delta', 'expiry'])
+
+
+class EarlyRefresh:
+    """
+    Probabilistic early recomputation (XFetch). Before a value expires, a reader
+    recomputes it with a probability that grows as the expiry gets closer and as the
+    value gets more expensive to compute:
+        now - delta * beta * log(random()) >= expiry
+    so one reader of a hot key rebuilds it a little early while the others keep using
+    the cached value, instead of all of them going to db at the moment it expires.
+    TTLs are jittered on write, so that keys written together do not expire together.
+    Off unless settings.CACHE_EARLY_REFRESH.
+    """
+
+    @classmethod
+    def is_enabled(cls):
+        return settings.CACHE_EARLY_REFRESH
+
+    @classmethod
+    def get_ttl(cls, ttl):
+        # only shortened, ttl stays an upper bound
+        if not cls.is_enabled() or not ttl:
+            return ttl
+        return max(1, int(ttl * (1 - random.uniform(0, settings.CACHE_TTL_JITTER))))
+
+    @classmethod
+    def should_refresh(cls, delta, expiry):
+        if not cls.is_enabled() or delta is None or expiry is None:
+            return False
+        # 1 - random() is in (0, 1], log of it is <= 0
+        gap = -delta * settings.CACHE_EARLY_REFRESH_BETA * math.log(1 - random.random())
+        return time.time() + gap >= expiry
+
+    @classmethod
+    def wrap(cls, value, delta, ttl):
+        # returns what to store in memcached and its ttl
+        if not cls.is_enabled():
+            return value, ttl
+        ttl = cls.get_ttl(ttl)
+        return CacheEntry(value, delta, time.time() + ttl), ttl
+
+    @classmethod
+    def unwrap(cls, stored):
+        # returns the cached value and whether this reader should recompute it now.
+        # values written while the mode was off are plain
+        if isinstance(stored, CacheEntry):
+            return stored.value, cls.should_refresh(stored.delta, stored.expiry)
+        return stored, False
@@ -0,0 +1,60 @@
+import bisect
+import hashlib
+
+
+class HashRing:
+    """
+    Ketama style consistent hashing.
+    Every node owns `replicas` points on a ring of 32 bit integers, a key belongs to
+    the node of the first point at or after the hash of the key. Adding or removing
+    a node only moves the keys that fall on the points it gains or loses.
+    Nodes are identified by name (host:port), so the order of the nodes in the
+    settings does not matter.
+    """
+
+    def __init__(self, nodes, replicas=160):
+        self.nodes = list(nodes)
+        points = []
+        for node in self.nodes:
+            # one md5 digest gives 4 points
+            for i in range(replicas // 4):
+                digest = hashlib.md5('{}-{}'.format(node, i).encode('utf-8')).digest()
+                for j in range(4):
+                    points.append((self._get_point(digest, j), node))
+        points.sort()
+        self._points = [point for point, _ in points]
+        self._point_nodes = [node for _, node in points]
+
+    @classmethod
+    def _get_point(cls, digest, index):
+        return int.from_bytes(digest[index * 4: index * 4 + 4], 'little')
+
+    @classmethod
+    def hash(cls, key):
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        return cls._get_point(hashlib.md5(key).digest(), 0)
+
+    def get_node(self, key):
+        if len(self.nodes) == 1:
+            return self.nodes[0]
+        index = bisect.bisect_left(self._points, self.hash(key))
+        if index == len(self._points):
+            index = 0
+        return self._point_nodes[index]
+
+
+    def get_nodes(self, key):
+        # all the nodes, starting from the owner of the key and going clockwise,
+        # the next ones take over the key when the owner is down
+        if len(self.nodes) == 1:
+            return list(self.nodes)
+        index = bisect.bisect_left(self._points, self.hash(key))
+        nodes = []
+        for offset in range(len(self._points)):
+            node = self._point_nodes[(index + offset) % len(self._points)]
+            if node not in nodes:
+                nodes.append(node)
+                if len(nodes) == len(self.nodes):
+                    break
+        return nodes
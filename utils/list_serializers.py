@@ -0,0 +1,16 @@
+from django.db import models
+from rest_framework import serializers
+
+
+class PrefetchListSerializer(serializers.ListSerializer):
+    """
+    Used as Meta.list_serializer_class. Before rendering a page (many=True), let the
+    child serializer load everything it needs for all instances at once through
+    its prefetch(instances) method, rather than one cache round trip per row.
+    """
+
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, models.Manager) else data
+        instances = list(iterable)
+        self.child.prefetch(instances)
+        return super(PrefetchListSerializer, self).to_representation(instances)
@@ -1,3 +1,10 @@
 def invalidate_object_cache(sender, instance, **kwargs):
     from utils.memcached_helper import MemcachedHelper
-    MemcachedHelper.invalidate_cached_object(sender, instance.id)
\ No newline at end of file
+    MemcachedHelper.invalidate_cached_object(sender, instance.id)
+
+
+def refresh_object_cache(sender, instance, **kwargs):
+    # post_save: the saved object is written to cache after commit,
+    # deletes still go through invalidate_object_cache
+    from utils.memcached_helper import MemcachedHelper
+    MemcachedHelper.refresh_cached_object(sender, instance, kwargs.get('update_fields'))
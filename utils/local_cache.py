@@ -0,0 +1,126 @@
+import logging
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from utils.redis_client import RedisClient
+
+logger = logging.getLogger(__name__)
+
+
+class LocalCache:
+    """
+    Optional process local LRU tier between the request cache and memcached, for the
+    hottest objects (celebrity users, their profiles, viral tweets).
+    Entries are bounded by LOCAL_CACHE_MAX_SIZE and expire after LOCAL_CACHE_TIMEOUT.
+    Invalidations are published on a redis channel, every worker process listens to
+    that channel and drops its own copy.
+    """
+    _store = OrderedDict()
+    _lock = threading.Lock()
+    _subscriber_pid = None
+
+    @classmethod
+    def is_enabled(cls):
+        return settings.LOCAL_CACHE_ENABLED
+
+    @classmethod
+    def get(cls, key):
+        if not cls.is_enabled():
+            return None
+        cls._ensure_subscriber()
+        with cls._lock:
+            entry = cls._store.get(key)
+            if entry is None:
+                return None
+            serialized_value, expire_at = entry
+            if expire_at <= time.monotonic():
+                del cls._store[key]
+                return None
+            cls._store.move_to_end(key)
+        # store pickled bytes so that callers never share (and mutate) the same instance
+        return pickle.loads(serialized_value)
+
+    @classmethod
+    def set(cls, key, value):
+        if not cls.is_enabled() or value is None:
+            return
+        serialized_value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        expire_at = time.monotonic() + settings.LOCAL_CACHE_TIMEOUT
+        with cls._lock:
+            cls._store[key] = (serialized_value, expire_at)
+            cls._store.move_to_end(key)
+            while len(cls._store) > settings.LOCAL_CACHE_MAX_SIZE:
+                cls._store.popitem(last=False)
+
+    @classmethod
+    def get_many(cls, keys):
+        found = {}
+        for key in keys:
+            value = cls.get(key)
+            if value is not None:
+                found[key] = value
+        return found
+
+    @classmethod
+    def set_many(cls, mapping):
+        for key, value in mapping.items():
+            cls.set(key, value)
+
+    @classmethod
+    def delete(cls, key):
+        # only drop the copy in this process
+        with cls._lock:
+            cls._store.pop(key, None)
+
+    @classmethod
+    def invalidate(cls, key):
+        # drop the copy in this process and tell all the other processes to do the same
+        if not cls.is_enabled():
+            return
+        cls.delete(key)
+        conn = RedisClient.get_connection()
+        conn.publish(settings.LOCAL_CACHE_INVALIDATION_CHANNEL, key)
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._store.clear()
+
+    @classmethod
+    def _ensure_subscriber(cls):
+        # one listener thread per process, started again in forked children
+        pid = os.getpid()
+        if cls._subscriber_pid == pid:
+            return
+        with cls._lock:
+            if cls._subscriber_pid == pid:
+                return
+            cls._subscriber_pid = pid
+            # whatever the parent process cached may already be stale
+            cls._store.clear()
+        thread = threading.Thread(
+            target=cls._listen,
+            name='local-cache-invalidation',
+            daemon=True,
+        )
+        thread.start()
+
+    @classmethod
+    def _listen(cls):
+        while True:
+            try:
+                pubsub = RedisClient.get_pubsub()
+                pubsub.subscribe(settings.LOCAL_CACHE_INVALIDATION_CHANNEL)
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        cls.delete(message['data'].decode())
+            except Exception:
+                # invalidations may have been missed while disconnected, start over empty
+                logger.exception('local cache invalidation listener disconnected')
+                cls.clear()
+                time.sleep(1)
@@ -0,0 +1,65 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from newsfeeds.models import NewsFeed
+from tweets.models import Tweet
+from utils.redis_serializers import CompactModelSerializer, DjangoModelSerializer
+from utils.time_helpers import utc_now
+
+
+class Command(BaseCommand):
+    help = 'Compare DjangoModelSerializer and CompactModelSerializer on redis list payloads'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=200, help='objects per list')
+        parser.add_argument('--rounds', type=int, default=50)
+
+    def handle(self, *args, **options):
+        size, rounds = options['size'], options['rounds']
+        # in memory objects only, nothing is written to the database
+        now = utc_now()
+        tweets = [
+            Tweet(
+                id=i + 1,
+                user_id=i % 17 + 1,
+                content='benchmark tweet content number {}'.format(i),
+                created_at=now,
+                likes_count=i * 3,
+                comments_count=i,
+            )
+            for i in range(size)
+        ]
+        newsfeeds = [
+            NewsFeed(id=i + 1, user_id=1, tweet_id=i + 1, created_at=now)
+            for i in range(size)
+        ]
+
+        for name, objects in (('Tweet', tweets), ('NewsFeed', newsfeeds)):
+            for serializer in (DjangoModelSerializer, CompactModelSerializer):
+                self._run(name, serializer, objects, rounds)
+
+    def _run(self, name, serializer, objects, rounds):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            serialized_list = [serializer.serialize(obj) for obj in objects]
+        serialize_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for data in serialized_list:
+                serializer.deserialize(data)
+        deserialize_time = time.perf_counter() - start
+
+        operations = rounds * len(objects)
+        total_bytes = sum(len(data) for data in serialized_list)
+        self.stdout.write(
+            '{:<8} {:<24} serialize {:7.2f} us/obj  deserialize {:7.2f} us/obj  '
+            '{:6.1f} bytes/obj'.format(
+                name,
+                serializer.__name__,
+                serialize_time / operations * 1e6,
+                deserialize_time / operations * 1e6,
+                total_bytes / len(objects),
+            )
+        )
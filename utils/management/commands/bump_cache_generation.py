@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from utils.cache_generations import CacheGenerations
+
+
+class Command(BaseCommand):
+    help = (
+        'Drop every cached entry of a namespace, e.g. User or userprofile, '
+        'by bumping its generation instead of flushing memcached'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('namespaces', nargs='+')
+
+    def handle(self, *args, **options):
+        for namespace in options['namespaces']:
+            generation = CacheGenerations.bump(namespace)
+            self.stdout.write('{} is now at generation {}'.format(namespace, generation))
@@ -0,0 +1,72 @@
+import redis
+from django.core.management.base import BaseCommand
+
+from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper
+
+
+class Command(BaseCommand):
+    help = 'Move every redis key to the node that owns it after REDIS_NODES changed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--dry-run', action='store_true', help='only count the keys to move')
+
+    def handle(self, *args, **options):
+        batch_size, dry_run = options['batch_size'], options['dry_run']
+        if not dry_run:
+            # the write behind deltas stay on their node, once a counter moves its
+            # back fill would not see them. write them all to db first
+            flushed = RedisHelper.flush_all_count_deltas()
+            self.stdout.write('{} counters flushed'.format(flushed))
+        moved = kept = 0
+        connections = RedisClient.get_node_connections()
+        for source, conn in connections.items():
+            batch = []
+            for key in conn.scan_iter(count=batch_size):
+                # node local keys (write behind deltas, locks of node wide jobs) stay
+                if RedisClient.is_node_local(key):
+                    continue
+                target = RedisClient.get_node(key)
+                if target == source:
+                    kept += 1
+                    continue
+                batch.append((key, target))
+                if len(batch) >= batch_size:
+                    moved += self._move(conn, connections, batch, dry_run)
+                    batch = []
+            if batch:
+                moved += self._move(conn, connections, batch, dry_run)
+        self.stdout.write('{} keys {}, {} keys already on their node'.format(
+            moved, 'to move' if dry_run else 'moved', kept,
+        ))
+
+    def _move(self, conn, connections, batch, dry_run):
+        if dry_run:
+            return len(batch)
+        pipe = conn.pipeline(transaction=False)
+        for key, _ in batch:
+            pipe.pttl(key)
+            pipe.dump(key)
+        results = pipe.execute()
+
+        moved = 0
+        targets = {}
+        for index, (key, target) in enumerate(batch):
+            ttl, data = results[index * 2], results[index * 2 + 1]
+            if data is None:
+                # expired meanwhile
+                continue
+            if target not in targets:
+                targets[target] = connections[target].pipeline(transaction=False)
+            # no REPLACE: if the key has been rebuilt on the new node since the nodes
+            # changed, that copy is newer than the one we are moving
+            targets[target].restore(key, max(ttl, 0), data)
+            moved += 1
+        for pipe in targets.values():
+            for result in pipe.execute(raise_on_error=False):
+                if isinstance(result, redis.exceptions.ResponseError) \
+                        and not str(result).startswith('BUSYKEY'):
+                    raise result
+        conn.delete(*[key for key, _ in batch])
+        return moved
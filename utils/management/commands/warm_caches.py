@@ -0,0 +1,116 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from newsfeeds.services import NewsFeedService
+from tweets.models import Tweet
+from tweets.services import TweetService
+from utils.memcached_helper import MemcachedHelper
+from utils.redis_helper import RedisHelper
+from utils.time_helpers import utc_now
+
+COUNT_ATTRS = ['likes_count', 'comments_count']
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuild the cold tweet / newsfeed caches and counters of the recently active '
+        'users, e.g. after redis was restarted or flushed'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=7, help='users who logged in during the last days')
+        parser.add_argument('--limit', type=int, default=None, help='at most this many users')
+        parser.add_argument('--batch-size', type=int, default=100, help='users per batch')
+        parser.add_argument('--concurrency', type=int, default=4, help='batches in flight')
+        parser.add_argument(
+            '--rate', type=float, default=0,
+            help='at most this many users per second, 0 for no limit',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        concurrency = max(options['concurrency'], 1)
+        rate = options['rate']
+
+        # most recently active first, so they are warm first
+        user_ids = User.objects.filter(
+            last_login__gte=utc_now() - timedelta(days=options['days']),
+        ).order_by('-last_login').values_list('id', flat=True)
+        if options['limit'] is not None:
+            user_ids = user_ids[:options['limit']]
+        user_ids = list(user_ids)
+        batches = [
+            user_ids[start:start + batch_size]
+            for start in range(0, len(user_ids), batch_size)
+        ]
+
+        self.total = len(user_ids)
+        self.done = self.lists = 0
+        self.start = time.monotonic()
+        if concurrency == 1:
+            for index, batch in enumerate(batches):
+                self._wait_for_rate(index * batch_size, rate)
+                self._report(len(batch), self._warm(batch))
+        else:
+            self._run_concurrently(batches, batch_size, concurrency, rate)
+
+        elapsed = time.monotonic() - self.start
+        self.stdout.write('warmed {} users, {} lists filled in {:.1f}s'.format(
+            self.done, self.lists, elapsed,
+        ))
+
+    def _run_concurrently(self, batches, batch_size, concurrency, rate):
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {}
+            for index, batch in enumerate(batches):
+                if len(futures) >= concurrency:
+                    self._collect(futures, wait(futures, return_when=FIRST_COMPLETED).done)
+                self._wait_for_rate(index * batch_size, rate)
+                futures[executor.submit(self._warm_in_thread, batch)] = len(batch)
+            self._collect(futures, wait(futures).done)
+
+    def _collect(self, futures, done):
+        for future in done:
+            self._report(futures.pop(future), future.result())
+
+    def _wait_for_rate(self, submitted, rate):
+        # users are submitted no faster than --rate, so that the db queries of the
+        # warming do not starve the production traffic
+        if not rate:
+            return
+        delay = self.start + submitted / rate - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _warm_in_thread(self, user_ids):
+        try:
+            return self._warm(user_ids)
+        finally:
+            # every thread has its own db connection
+            connections.close_all()
+
+    def _warm(self, user_ids):
+        # returns the number of lists filled, the empty ones are not cached
+        tweets = TweetService.warm_cached_tweets(user_ids)
+        newsfeeds = NewsFeedService.warm_cached_newsfeeds(user_ids)
+        lists = len({tweet.user_id for tweet in tweets}) + len({nf.user_id for nf in newsfeeds})
+
+        # the tweets of the newsfeeds are read from memcached, warm them with the counters
+        tweet_ids = {newsfeed.tweet_id for newsfeed in newsfeeds} - {tweet.id for tweet in tweets}
+        tweets += MemcachedHelper.get_objects_through_cache(Tweet, list(tweet_ids))
+        # only the missing counters are back filled
+        RedisHelper.get_counts(tweets, COUNT_ATTRS)
+        return lists
+
+    def _report(self, users, lists):
+        self.done += users
+        self.lists += lists
+        elapsed = max(time.monotonic() - self.start, 1e-6)
+        self.stdout.write('{}/{} users, {} lists filled, {:.1f} users/s'.format(
+            self.done, self.total, self.lists, self.done / elapsed,
+        ))
@@ -0,0 +1,212 @@
+import logging
+import pickle
+import threading
+import time
+from collections import defaultdict
+
+import memcache
+from django.core.cache.backends.memcached import MemcachedCache
+
+from utils.hash_ring import HashRing
+
+logger = logging.getLogger(__name__)
+
+
+class KetamaMemcachedClient:
+    """
+    memcache.Client look alike over several memcached nodes.
+    A key goes to its node on a ketama hash ring, so adding or removing a node
+    only moves the keys of that node (memcache.Client hashes modulo the number
+    of nodes, which moves almost every key).
+    Every node has its own memcache.Client, which keeps one connection per thread.
+    A node that fails is ejected from the ring for dead_retry seconds, its keys go
+    to the next node on the ring meanwhile. The invalidations of its keys go there
+    as well, so a node is flushed when it rejoins instead of serving what it had,
+    and the keys written to the next node expire after dead_retry seconds.
+    Multi key commands send one multi get / set / delete per node.
+    """
+    # node -> time.monotonic() until which it is ejected, shared by all the threads
+    _dead_until = {}
+    # nodes being flushed by _rejoin, the other threads keep skipping them meanwhile
+    _rejoining = set()
+    _lock = threading.Lock()
+
+    def __init__(self, servers, dead_retry=30, **options):
+        self.ring = HashRing(servers)
+        self.dead_retry = dead_retry
+        self.clients = {
+            server: memcache.Client([server], dead_retry=dead_retry, **options)
+            for server in servers
+        }
+
+    def _is_alive(self, node, now):
+        dead_until = self._dead_until.get(node)
+        if dead_until is None:
+            return True
+        if dead_until > now:
+            return False
+        return self._rejoin(node)
+
+    def _rejoin(self, node):
+        # flushed before any thread reads it again, it missed the invalidations
+        # of its keys while it was ejected. the flush is network i/o, it runs outside
+        # the lock so that the lookups of the other nodes do not wait for it.
+        # returns False if it is still down
+        with self._lock:
+            dead_until = self._dead_until.get(node)
+            if dead_until is None:
+                # another thread did it
+                return True
+            if dead_until > time.monotonic() or node in self._rejoining:
+                # ejected again, or another thread is flushing it
+                return False
+            self._rejoining.add(node)
+        alive = False
+        try:
+            self.clients[node].flush_all()
+            alive = self.clients[node].servers[0].deaduntil <= time.time()
+        finally:
+            with self._lock:
+                self._rejoining.discard(node)
+                # _check_node ejects it again if a command failed on it meanwhile
+                alive = alive and self._dead_until.get(node) == dead_until
+                if alive:
+                    logger.warning('memcached node %s is back, flushed', node)
+                    del self._dead_until[node]
+                else:
+                    self._dead_until[node] = time.monotonic() + self.dead_retry
+        return alive
+
+    def _get_timeout(self, key, node, timeout):
+        # a key written to the next node while its own node is ejected
+        # is gone again when its own node rejoins
+        if node == self.ring.get_node(key):
+            return timeout
+        return min(timeout, self.dead_retry) if timeout else self.dead_retry
+
+    def get_node(self, key):
+        now = time.monotonic()
+        node = self.ring.get_node(key)
+        if self._is_alive(node, now):
+            return node
+        for node in self.ring.get_nodes(key):
+            if self._is_alive(node, now):
+                return node
+        return None
+
+    def _check_node(self, node):
+        # memcache.Client marks its host dead when a command fails on the socket
+        if self.clients[node].servers[0].deaduntil > time.time():
+            with self._lock:
+                # not through _is_alive, _rejoin takes the lock as well
+                dead_until = self._dead_until.get(node)
+                if dead_until is None or dead_until <= time.monotonic():
+                    logger.warning('memcached node %s is down, ejected for %ss', node, self.dead_retry)
+                    self._dead_until[node] = time.monotonic() + self.dead_retry
+
+    def _call(self, method, key, *args, **kwargs):
+        node = self.get_node(key)
+        if node is None:
+            # every node is down, same as a miss
+            return None
+        result = getattr(self.clients[node], method)(key, *args, **kwargs)
+        self._check_node(node)
+        return result
+
+    def _write(self, method, key, *args, time=0):
+        node = self.get_node(key)
+        if node is None:
+            return None
+        result = getattr(self.clients[node], method)(
+            key, *args, self._get_timeout(key, node, time),
+        )
+        self._check_node(node)
+        return result
+
+    def _group_by_node(self, keys):
+        groups = defaultdict(list)
+        for key in keys:
+            node = self.get_node(key)
+            if node is not None:
+                groups[node].append(key)
+        return groups
+
+    def get(self, key):
+        return self._call('get', key)
+
+    def set(self, key, value, time=0):
+        return self._write('set', key, value, time=time)
+
+    def add(self, key, value, time=0):
+        return self._write('add', key, value, time=time)
+
+    def touch(self, key, time=0):
+        return self._write('touch', key, time=time)
+
+    def incr(self, key, delta=1):
+        return self._call('incr', key, delta)
+
+    def decr(self, key, delta=1):
+        return self._call('decr', key, delta)
+
+    def delete(self, key, time=None):
+        return self._call('delete', key, time)
+
+    def _deletetouch(self, expected, cmd, key, time=0):
+        # used by django's MemcachedCache.delete
+        node = self.get_node(key)
+        if node is None:
+            return 0
+        result = self.clients[node]._deletetouch(expected, cmd, key, time)
+        self._check_node(node)
+        return result
+
+    def get_multi(self, keys):
+        values = {}
+        for node, node_keys in self._group_by_node(keys).items():
+            values.update(self.clients[node].get_multi(node_keys))
+            self._check_node(node)
+        return values
+
+    def set_multi(self, mapping, time=0):
+        # returns the keys that could not be set
+        failed_keys = []
+        for node, node_keys in self._group_by_node(mapping.keys()).items():
+            by_timeout = defaultdict(dict)
+            for key in node_keys:
+                by_timeout[self._get_timeout(key, node, time)][key] = mapping[key]
+            for timeout, node_mapping in by_timeout.items():
+                failed_keys.extend(self.clients[node].set_multi(node_mapping, timeout))
+            self._check_node(node)
+        return failed_keys
+
+    def delete_multi(self, keys, time=None):
+        success = 1
+        for node, node_keys in self._group_by_node(list(keys)).items():
+            if not self.clients[node].delete_multi(node_keys, time):
+                success = 0
+            self._check_node(node)
+        return success
+
+    def flush_all(self):
+        for client in self.clients.values():
+            client.flush_all()
+
+    def disconnect_all(self):
+        for client in self.clients.values():
+            client.disconnect_all()
+
+
+class KetamaMemcachedCache(MemcachedCache):
+    """
+    python-memcached backend for several nodes, LOCATION is the list of nodes.
+    OPTIONS are passed to memcache.Client, e.g. dead_retry and socket_timeout.
+    """
+
+    @property
+    def _cache(self):
+        if getattr(self, '_client', None) is None:
+            client_kwargs = {'pickleProtocol': pickle.HIGHEST_PROTOCOL}
+            client_kwargs.update(self._options)
+            self._client = KetamaMemcachedClient(self._servers, **client_kwargs)
+        return self._client
@@ -1,31 +1,317 @@
+import copy
+import time
+
 from django.conf import settings
 from django.core.cache import caches
+from django.core.exceptions import FieldDoesNotExist
+from django.db import transaction
+from django.db.models.expressions import BaseExpression
+from utils.cache_generations import CacheGenerations
+from utils.cache_metrics import CacheMetrics
+from utils.compression import Compression
+from utils.early_refresh import EarlyRefresh
+from utils.local_cache import LocalCache
+from utils.request_cache import RequestCache
 
 cache = caches['testing'] if settings.TESTING else caches['default']
 
+# cached instead of an object that is not in db, so that looking up a deleted or unknown
+# id again is answered by cache. it lives under the key of the object, so post_save
+# (invalidate_object_cache) removes it like any cached object
+TOMBSTONE = '__object_does_not_exist__'
+
 # user and tweet both require cache, so use MemcachedHelper to avoid duplicate
 class MemcachedHelper:
 
     @classmethod
     def get_key(cls, model_class, object_id):
-        return '{}:{}'.format(model_class.__name__, object_id)
+        key = '{}:{}'.format(model_class.__name__, object_id)
+        return CacheGenerations.format_key(model_class.__name__, key)
+
+    @classmethod
+    def get_invalidation_keys(cls, model_class, object_id):
+        key = '{}:{}'.format(model_class.__name__, object_id)
+        return CacheGenerations.get_invalidation_keys(model_class.__name__, key)
+
+    @classmethod
+    def invalidate_keys(cls, keys):
+        # cache, local and request copies of every key
+        cache.delete_many(keys)
+        for key in keys:
+            LocalCache.invalidate(key)
+            RequestCache.delete(key)
+
+    @classmethod
+    def invalidate_deleted_keys(cls, keys):
+        # pre_delete: the write_through hook of a save earlier in the same transaction
+        # runs at commit and would cache the deleted row again, the keys are
+        # invalidated again after it
+        cls.invalidate_keys(keys)
+        if settings.CACHE_WRITE_THROUGH and transaction.get_connection().in_atomic_block:
+            transaction.on_commit(lambda: cls.invalidate_keys(keys))
+
+    @classmethod
+    def cache_get(cls, pattern, key):
+        # memcached values go through Compression, pattern is the one of CacheMetrics
+        return Compression.loads(pattern, cache.get(key))
+
+    @classmethod
+    def cache_get_many(cls, pattern, keys):
+        return {
+            key: Compression.loads(pattern, value)
+            for key, value in cache.get_many(keys).items()
+        }
+
+    @classmethod
+    def cache_set(cls, pattern, key, value, timeout):
+        cache.set(key, Compression.dumps(pattern, value), timeout)
+
+    @classmethod
+    def cache_set_many(cls, pattern, mapping, timeout):
+        cache.set_many(
+            {key: Compression.dumps(pattern, value) for key, value in mapping.items()},
+            timeout,
+        )
+
+    @classmethod
+    def is_tombstone(cls, value):
+        return isinstance(value, str) and value == TOMBSTONE
+
+    @classmethod
+    def _check_tombstone(cls, model_class, obj):
+        if cls.is_tombstone(obj):
+            raise model_class.DoesNotExist(
+                '{} matching query does not exist.'.format(model_class._meta.object_name)
+            )
+        return cls._detach(obj)
+
+    @classmethod
+    def _detach(cls, obj):
+        # RequestCache hands the same instance to every caller of the request, each one
+        # gets its own copy so that what it attaches to it, like the related objects of
+        # prefetch_objects_through_cache, does not reach the others
+        if not RequestCache.is_active():
+            return obj
+        detached = copy.copy(obj)
+        detached._state = copy.copy(obj._state)
+        detached._state.fields_cache = {}
+        return detached
 
     @classmethod
     def get_object_through_cache(cls, model_class, object_id):
         key = cls.get_key(model_class, object_id)
-        # cache hit
-        obj = cache.get(key)
-        if obj:
-            return obj
+        pattern = model_class.__name__
+        # already loaded in this request
+        obj = RequestCache.get(key)
+        if obj is not None:
+            CacheMetrics.hit(pattern, 'request')
+            return cls._check_tombstone(model_class, obj)
+
+        # process local cache hit
+        obj = LocalCache.get(key)
+        if obj is not None:
+            CacheMetrics.hit(pattern, 'local')
+            RequestCache.set(key, obj)
+            return cls._check_tombstone(model_class, obj)
+
+        # cache hit, unless this reader was picked to refresh it early
+        with CacheMetrics.time_round_trip(pattern, 'memcached'):
+            obj, refresh = EarlyRefresh.unwrap(cls.cache_get(pattern, key))
+        if obj and not refresh:
+            CacheMetrics.hit(pattern, 'memcached')
+            LocalCache.set(key, obj)
+            RequestCache.set(key, obj)
+            return cls._check_tombstone(model_class, obj)
 
         # cache miss
-        obj = model_class.objects.get(id=object_id)
-        # using default expire time
-        cache.set(key, obj)
-        return obj
+        CacheMetrics.miss(pattern)
+        with CacheMetrics.time_fill(pattern):
+            start = time.perf_counter()
+            try:
+                obj = model_class.objects.get(id=object_id)
+                timeout = cache.default_timeout
+            except model_class.DoesNotExist:
+                obj = TOMBSTONE
+                timeout = settings.MEMCACHED_TOMBSTONE_TIMEOUT
+            cls.cache_set(pattern, key, *EarlyRefresh.wrap(obj, time.perf_counter() - start, timeout))
+        LocalCache.set(key, obj)
+        RequestCache.set(key, obj)
+        return cls._check_tombstone(model_class, obj)
+
+    @classmethod
+    def get_objects_through_cache(cls, model_class, object_ids):
+        # batch version of get_object_through_cache, one get_many for the whole page
+        # and one id__in query for all the misses, instead of one round trip per object
+        object_ids = [object_id for object_id in object_ids if object_id is not None]
+        keys = [cls.get_key(model_class, object_id) for object_id in object_ids]
+        pattern = model_class.__name__
+        cached = RequestCache.get_many(keys)
+        CacheMetrics.hit(pattern, 'request', len(cached))
+        missed_keys = [key for key in keys if key not in cached]
+        if missed_keys:
+            from_local = LocalCache.get_many(missed_keys)
+            CacheMetrics.hit(pattern, 'local', len(from_local))
+            RequestCache.set_many(from_local)
+            cached.update(from_local)
+            missed_keys = [key for key in missed_keys if key not in cached]
+        if missed_keys:
+            with CacheMetrics.time_round_trip(pattern, 'memcached'):
+                from_cache = cls._unwrap_many(cls.cache_get_many(pattern, missed_keys))
+            CacheMetrics.hit(pattern, 'memcached', len(from_cache))
+            LocalCache.set_many(from_cache)
+            RequestCache.set_many(from_cache)
+            cached.update(from_cache)
+
+        missed_ids = [
+            object_id
+            for object_id, key in zip(object_ids, keys)
+            if key not in cached
+        ]
+        if missed_ids:
+            CacheMetrics.miss(pattern, len(missed_ids))
+            fetched = {}
+            with CacheMetrics.time_fill(pattern):
+                start = time.perf_counter()
+                for obj in model_class.objects.filter(id__in=missed_ids):
+                    fetched[cls.get_key(model_class, obj.id)] = obj
+                tombstones = {
+                    cls.get_key(model_class, object_id): TOMBSTONE
+                    for object_id in missed_ids
+                    if cls.get_key(model_class, object_id) not in fetched
+                }
+                delta = time.perf_counter() - start
+                # using default expire time
+                timeout = cache.default_timeout
+                cls.cache_set_many(pattern, cls._wrap_many(fetched, delta, timeout), timeout)
+                if tombstones:
+                    timeout = settings.MEMCACHED_TOMBSTONE_TIMEOUT
+                    cls.cache_set_many(pattern, cls._wrap_many(tombstones, delta, timeout), timeout)
+            fetched.update(tombstones)
+            LocalCache.set_many(fetched)
+            RequestCache.set_many(fetched)
+            cached.update(fetched)
+
+        # keep the order of object_ids, ids that do not exist in db are skipped
+        return [
+            cls._detach(cached[key])
+            for key in keys
+            if key in cached and not cls.is_tombstone(cached[key])
+        ]
+
+    @classmethod
+    def _unwrap_many(cls, stored):
+        # the entries picked for an early refresh are left out, they are read from db
+        values = {}
+        for key, value in stored.items():
+            value, refresh = EarlyRefresh.unwrap(value)
+            if not refresh:
+                values[key] = value
+        return values
+
+    @classmethod
+    def _wrap_many(cls, mapping, delta, timeout):
+        # one set_many shares one memcached ttl, the expiry inside every entry
+        # is jittered on its own, early refresh happens before that expiry
+        return {
+            key: EarlyRefresh.wrap(value, delta, timeout)[0]
+            for key, value in mapping.items()
+        }
+
+    @classmethod
+    def prefetch_objects_through_cache(cls, instances, model_class, id_attr, cached_attr):
+        # load the related objects of a whole page at once and attach them to every
+        # instance, so that properties like Tweet.cached_user do not hit cache one by one
+        instances = [instance for instance in instances if instance is not None]
+        object_ids = [getattr(instance, id_attr) for instance in instances]
+        objects = cls.get_objects_through_cache(model_class, object_ids)
+        object_map = {obj.id: obj for obj in objects}
+        for instance in instances:
+            obj = object_map.get(getattr(instance, id_attr))
+            if obj is not None:
+                setattr(instance, cached_attr, obj)
+            else:
+                # not found, the property looks it up on its own and raises like it would
+                # without the prefetch. also drops what an earlier prefetch attached
+                instance.__dict__.pop(cached_attr, None)
+        return objects
 
     @classmethod
     def invalidate_cached_object(cls, model_class, object_id):
-        key = cls.get_key(model_class, object_id)
-        cache.delete(key)
+        cls.invalidate_deleted_keys(cls.get_invalidation_keys(model_class, object_id))
+
+    @classmethod
+    def _copy_for_cache(cls, instance):
+        # only the columns, not the related objects and counters cached on the instance.
+        # None if a column is only known by db: deferred, or an F() expression
+        if instance.get_deferred_fields():
+            return None
+        values = {}
+        for field in instance._meta.concrete_fields:
+            value = getattr(instance, field.attname)
+            if isinstance(value, BaseExpression):
+                return None
+            values[field.attname] = value
+        obj = instance.__class__(**values)
+        obj._state.adding = False
+        obj._state.db = instance._state.db
+        return obj
+
+    @classmethod
+    def write_through(cls, keys, instance, update_fields=None):
+        """
+        Write a saved instance to cache when the transaction commits, instead of deleting
+        the key and letting all the readers of a hot key miss at once. Until the commit,
+        readers keep the old row from cache, which is also what db gives them.
+        keys come from get_invalidation_keys: the instance is written to the first one,
+        the key of the previous generation is deleted.
+        The commit hooks of concurrent saves of the same row can run in any order:
+        a model with updated_at is not written over a newer cached row, the others
+        are cached for CACHE_WRITE_THROUGH_TIMEOUT only, so that a stale one is short lived.
+        Returns False if the instance can not be written through, delete the key then,
+        e.g. saved with update_fields, the other columns may be older than db.
+        """
+        if not settings.CACHE_WRITE_THROUGH or update_fields is not None:
+            return False
+        obj = cls._copy_for_cache(instance)
+        if obj is None:
+            return False
+        transaction.on_commit(lambda: cls._write_cache(keys, obj))
+        return True
+
+    @classmethod
+    def _get_version(cls, obj):
+        try:
+            obj._meta.get_field('updated_at')
+        except FieldDoesNotExist:
+            return None
+        return obj.updated_at
 
+    @classmethod
+    def _write_cache(cls, keys, obj):
+        key = keys[0]
+        if keys[1:]:
+            cls.invalidate_keys(keys[1:])
+        pattern = CacheMetrics.get_pattern(key)
+        version = cls._get_version(obj)
+        if version is None:
+            timeout = settings.CACHE_WRITE_THROUGH_TIMEOUT
+        else:
+            timeout = cache.default_timeout
+            cached, _ = EarlyRefresh.unwrap(cls.cache_get(pattern, key))
+            if cached is not None and not cls.is_tombstone(cached) \
+                    and cls._get_version(cached) > version:
+                # the hook of a later save ran first
+                LocalCache.invalidate(key)
+                RequestCache.delete(key)
+                return
+        # no db read was needed, delta 0
+        cls.cache_set(pattern, key, *EarlyRefresh.wrap(obj, 0, timeout))
+        # the other processes drop their local copy
+        LocalCache.invalidate(key)
+        RequestCache.set(key, obj)
+
+    @classmethod
+    def refresh_cached_object(cls, model_class, instance, update_fields=None):
+        keys = cls.get_invalidation_keys(model_class, instance.id)
+        if not cls.write_through(keys, instance, update_fields):
+            cls.invalidate_keys(keys)
@@ -0,0 +1,53 @@
+import logging
+
+from utils.request_cache import RequestCache
+
+logger = logging.getLogger(__name__)
+
+
+class RequestCacheMiddleware:
+    """
+    Sets up the request scoped identity map (RequestCache) for every request and tears
+    it down afterwards. The hit / miss counts are returned in the response headers so we
+    can see how many memcached round trips were saved by the identity map.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        RequestCache.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            stats = RequestCache.stop()
+
+        response['X-Request-Cache-Hits'] = stats['hits']
+        response['X-Request-Cache-Misses'] = stats['misses']
+        logger.debug(
+            'request cache %s %s: %d hits, %d misses',
+            request.method,
+            request.path,
+            stats['hits'],
+            stats['misses'],
+        )
+        return response
+
+
+class UserActivityMiddleware:
+    """
+    Records when the authenticated users were last seen, see UserService.touch.
+    Done after the view, so that the users authenticated by rest framework are seen too.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            # import inside the function to avoid circle dependency
+            from accounts.services import UserService
+            UserService.touch(user.id)
+        return response
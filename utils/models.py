@@ -0,0 +1,13 @@
+from django.db import models
+
+
+class CounterFlush(models.Model):
+    # flushes of the write behind counters applied to db, see RedisHelper.flush_count_deltas.
+    # written in the same transaction as the counters, so that a flush retried after a
+    # crash is not applied twice
+    flush_id = models.CharField(max_length=32, unique=True)
+    # old flushes are deleted, see RedisHelper.delete_old_flushes
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f'{self.created_at} flush {self.flush_id}'
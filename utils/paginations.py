@@ -1,46 +1,148 @@
+import sys
+
 from dateutil import parser
 from django.conf import settings
+from django.core import signing
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
 from rest_framework.pagination import BasePagination
 from rest_framework.response import Response
 
+from utils.time_helpers import from_microseconds, to_microseconds
+
+CURSOR_SALT = 'utils.paginations.cursor'
+# a cursor either asks for the page after an item (scroll down),
+# or for all the items before it (scroll up to refresh)
+NEXT = 'n'
+PREVIOUS = 'p'
+
 
 class EndlessPagination(BasePagination):
+    """
+    Keyset pagination on (created_at, id).
+    The response contains a signed, opaque next_cursor for the next page and a
+    previous_cursor to refresh everything newer than the first item.
+    A cursor becomes WHERE (created_at, id) < (...) on the (owner, created_at) indexes,
+    so a deep page costs the same as the first one, and items created at the same
+    time are never skipped or returned twice.
+    created_at__lt / created_at__gt from old clients are still accepted.
+    """
     page_size = 20 if not settings.TESTING else 10
+    # the client can choose the page size with this param, up to max_page_size
+    page_size_query_param = None
+    max_page_size = None
+    cursor_query_param = 'cursor'
+    # order of the list, id breaks the ties of the first field
+    ordering = ('-created_at', '-id')
 
     def __init__(self):
         super(EndlessPagination, self).__init__()
         self.has_next_page = False
+        self.page = []
+        self.direction = NEXT
+        self.position = None
 
     def to_html(self):
         pass
 
+    @property
+    def field(self):
+        return self.ordering[0].lstrip('-')
+
+    @property
+    def descending(self):
+        return self.ordering[0].startswith('-')
+
+    def get_key(self, obj):
+        return to_microseconds(getattr(obj, self.field)), obj.id
+
+    def encode_cursor(self, obj, direction):
+        return signing.dumps([direction, *self.get_key(obj)], salt=CURSOR_SALT)
+
+    def decode_cursor(self, cursor):
+        try:
+            direction, score, object_id = signing.loads(cursor, salt=CURSOR_SALT)
+        except (signing.BadSignature, ValueError, TypeError):
+            raise NotFound('Invalid cursor')
+        if direction not in (NEXT, PREVIOUS):
+            raise NotFound('Invalid cursor')
+        return direction, (score, object_id)
+
+    def get_page_size(self, request):
+        if self.page_size_query_param not in request.query_params:
+            return self.page_size
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except ValueError:
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size or page_size)
+
+    def parse_request(self, request):
+        self.page_size = self.get_page_size(request)
+        if self.cursor_query_param in request.query_params:
+            self.direction, self.position = self.decode_cursor(
+                request.query_params[self.cursor_query_param],
+            )
+        elif 'created_at__gt' in request.query_params:
+            # 2020-11-11 00:00:00.123456
+            # isoparse用来解析时间戳
+            created_at__gt = parser.isoparse(request.query_params['created_at__gt'])
+            self.direction = PREVIOUS
+            self.position = (to_microseconds(created_at__gt), sys.maxsize)
+        elif 'created_at__lt' in request.query_params:
+            created_at__lt = parser.isoparse(request.query_params['created_at__lt'])
+            self.direction = NEXT
+            self.position = (to_microseconds(created_at__lt), 0)
+
+    def is_after(self, obj, position):
+        # obj comes after the position in the order of the list
+        key = self.get_key(obj)
+        return key < position if self.descending else key > position
+
+    def is_before(self, obj, position):
+        key = self.get_key(obj)
+        return key > position if self.descending else key < position
+
+    def get_keyset_filter(self):
+        score, object_id = self.position
+        value = from_microseconds(score)
+        lookup = 'lt' if (self.direction == NEXT) == self.descending else 'gt'
+        return Q(**{'{}__{}'.format(self.field, lookup): value}) | Q(**{
+            self.field: value,
+            'id__{}'.format(lookup): object_id,
+        })
+
     def paginate_queryset(self, queryset, request, view=None):
         if type(queryset) == list:
             return self.paginate_ordered_list(queryset, request)
+        self.parse_request(request)
+        queryset = queryset.order_by(*self.ordering)
+        if self.position is not None:
+            queryset = queryset.filter(self.get_keyset_filter())
+
         # refresh to load new information by scrolling up
         # to simplify, the scroll up refresh does not contain pagination.
         # just load all updated data
         # because if the data hasn't been updated for a long time, we will use
         # reloading to refresh, rather than scrolling up.
-        if 'created_at__gt' in request.query_params:
-            created_at__gt = request.query_params['created_at__gt']
-            queryset = queryset.filter(created_at__gt=created_at__gt)
+        if self.direction == PREVIOUS:
             self.has_next_page = False
-            return queryset.order_by('-created_at')
+            self.page = list(queryset)
+            return self.page
 
-        if 'created_at__lt' in request.query_params:
-            created_at__lt = request.query_params['created_at__lt']
-            queryset = queryset.filter(created_at__lt=created_at__lt)
-        queryset = queryset.order_by('-created_at')[:self.page_size + 1]
-        self.has_next_page = len(queryset) > self.page_size
-        return queryset[:self.page_size]
+        page = list(queryset[:self.page_size + 1])
+        self.has_next_page = len(page) > self.page_size
+        self.page = page[:self.page_size]
+        return self.page
 
     def paginate_cached_list(self, cached_list, request):
         paginated_list = self.paginate_ordered_list(cached_list, request)
 
         # if scroll to the previous page,
         # paginated_list has already contained all the latest data, return directly
-        if 'created_ar__gt' in request.query_params:
+        if self.direction == PREVIOUS:
             return paginated_list
 
         # scroll to the next page,
@@ -58,37 +160,56 @@ class EndlessPagination(BasePagination):
         # should request from database
         return None
 
+    def paginate_cached_index(self, load_page, request):
+        # load_page(before=None, after=None, count=None) reads a sorted set index scored
+        # by created_at (see RedisHelper.load_object_ids), redis finds the page with
+        # ZREVRANGEBYSCORE instead of scanning a list here. only for newest first lists.
+        # load_page can also find the page in db, e.g. NewsFeedService.get_newsfeeds_page.
+        # returns None if the page should be read from db
+        self.parse_request(request)
+        if self.direction == PREVIOUS:
+            self.has_next_page = False
+            self.page = load_page(after=self.position)
+            return self.page
+
+        objects = load_page(before=self.position, count=self.page_size + 1)
+        if objects is None:
+            return None
+        self.has_next_page = len(objects) > self.page_size
+        self.page = objects[:self.page_size]
+        return self.page
 
     def get_paginated_response(self, data):
         return Response({
             'has_next_page': self.has_next_page,
+            'next_cursor': self.encode_cursor(self.page[-1], NEXT)
+            if self.has_next_page else None,
+            'previous_cursor': self.encode_cursor(self.page[0], PREVIOUS)
+            if self.page else None,
             'results': data,
         })
 
-    def paginate_ordered_list(self, reverse_ordered_list, request):
-        if 'created_at__gt' in request.query_params:
-            # 2020-11-11 00:00:00.123456
-            # isoparse用来解析时间戳
-            created_at__gt = parser.isoparse(request.query_params['created_at__gt'])
+    def paginate_ordered_list(self, ordered_list, request):
+        self.parse_request(request)
+        if self.direction == PREVIOUS:
             objects = []
-            for obj in reverse_ordered_list:
-                if obj.created_at > created_at__gt:
-                    objects.append(obj)
-                else:
+            for obj in ordered_list:
+                if not self.is_before(obj, self.position):
                     break
+                objects.append(obj)
             self.has_next_page = False
+            self.page = objects
             return objects
 
         index = 0
-        if 'created_at__lt' in request.query_params:
-            created_at__lt = parser.isoparse(request.query_params['created_at__lt'])
-            for index, obj in enumerate(reverse_ordered_list):
-                if obj.created_at < created_at__lt:
+        if self.position is not None:
+            for index, obj in enumerate(ordered_list):
+                if self.is_after(obj, self.position):
                     break
             else:
                 # if no objects satisfying the requirement, return empty list
                 # 注意这个else对应的是for
-                reverse_ordered_list = []
-        self.has_next_page = len(reverse_ordered_list) > index + self.page_size
-        return reverse_ordered_list[index: index + self.page_size]
-
+                index = len(ordered_list)
+        self.has_next_page = len(ordered_list) > index + self.page_size
+        self.page = ordered_list[index: index + self.page_size]
+        return self.page
@@ -1,28 +1,214 @@
+import os
+import re
+import threading
+from collections import defaultdict
+
 import redis
 from django.conf import settings
 
-#
+from utils.hash_ring import HashRing
+
+# keys built from twitter/cache.py are sharded by the first id in the key, so that
+# user_tweets:1, user_newsfeeds:1 and user_tweets:1:fill_lock live on the same node
+SHARD_ID_PATTERN = re.compile(r':(\d+)')
+
 
 class RedisClient:
-    conn = None
-
-    @classmethod
-    def get_connection(cls):
-        # use singleton mode, only create one connection in the global
-        if cls.conn:
-            return cls.conn
-        # if there hasn't been any connection, create one
-        cls.conn = redis.Redis(
-            host=settings.REDIS_HOST,
-            port=settings.REDIS_PORT,
-            db=settings.REDIS_DB,
+    """
+    Client side sharding over settings.REDIS_NODES.
+    Every key goes to one node chosen by consistent hashing on the id in the key.
+    Keys without an id (the write behind deltas of the counters, the locks of the
+    flush task) are node local: each node keeps its own copy and jobs that use them
+    go through every node, see get_all_connections.
+    Each process has its own connection pool per node.
+    """
+    nodes = None
+    ring = None
+    # node name -> client of that node, one per process
+    conns = {}
+    pools = {}
+    # the process that created the pools, a forked child must not reuse its sockets
+    pid = None
+    _lock = threading.Lock()
+    # lua script source -> sha1 returned by SCRIPT LOAD
+    script_shas = {}
+
+    @classmethod
+    def get_node_name(cls, node):
+        return '{}:{}/{}'.format(node['host'], node['port'], node.get('db', settings.REDIS_DB))
+
+    @classmethod
+    def _create_pool(cls, node):
+        # blocks up to REDIS_POOL_TIMEOUT for a free connection when all
+        # REDIS_MAX_CONNECTIONS are in use, instead of opening more
+        return redis.BlockingConnectionPool(
+            host=node['host'],
+            port=node['port'],
+            db=node.get('db', settings.REDIS_DB),
+            max_connections=settings.REDIS_MAX_CONNECTIONS,
+            timeout=settings.REDIS_POOL_TIMEOUT,
+            socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+            socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+            socket_keepalive=True,
+            # PING a connection idle for longer than this before using it,
+            # so a connection closed by the server is replaced instead of failing
+            health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
+        )
+
+    @classmethod
+    def _setup(cls):
+        # one pool per node per process, shared by all the threads of the process.
+        # celery prefork children and gunicorn workers are forked after the parent
+        # may have connected, they get fresh pools instead of the inherited sockets
+        pid = os.getpid()
+        if cls.pid == pid and cls.nodes is settings.REDIS_NODES:
+            return
+        with cls._lock:
+            if cls.pid == pid and cls.nodes is settings.REDIS_NODES:
+                return
+            nodes = settings.REDIS_NODES
+            pools, conns = {}, {}
+            for node in nodes:
+                name = cls.get_node_name(node)
+                pools[name] = cls._create_pool(node)
+                conns[name] = redis.Redis(connection_pool=pools[name])
+            cls.pools = pools
+            cls.conns = conns
+            cls.ring = HashRing(conns.keys())
+            cls.nodes = nodes
+            cls.pid = pid
+
+    @classmethod
+    def get_shard_key(cls, key):
+        if isinstance(key, bytes):
+            key = key.decode('utf-8')
+        match = SHARD_ID_PATTERN.search(key)
+        return match.group(1) if match else key
+
+    @classmethod
+    def is_node_local(cls, key):
+        if isinstance(key, bytes):
+            key = key.decode('utf-8')
+        return SHARD_ID_PATTERN.search(key) is None
+
+    @classmethod
+    def get_node(cls, key):
+        cls._setup()
+        return cls.ring.get_node(cls.get_shard_key(key))
+
+    @classmethod
+    def get_connection(cls, key=None):
+        # the client of the node that owns the key.
+        # without a key, the first node: pub/sub and other things that are not sharded
+        cls._setup()
+        if key is None:
+            return cls.conns[cls.get_node_name(cls.nodes[0])]
+        return cls.conns[cls.ring.get_node(cls.get_shard_key(key))]
+
+    @classmethod
+    def get_all_connections(cls):
+        cls._setup()
+        return list(cls.conns.values())
+
+    @classmethod
+    def get_node_connections(cls):
+        # node name -> client of the node
+        cls._setup()
+        return dict(cls.conns)
+
+    @classmethod
+    def group_by_node(cls, keys):
+        # node name -> indexes of the keys that live on the node
+        cls._setup()
+        groups = defaultdict(list)
+        for index, key in enumerate(keys):
+            groups[cls.ring.get_node(cls.get_shard_key(key))].append(index)
+        return groups
+
+    @classmethod
+    def mget(cls, keys):
+        # one MGET per node, values are returned in the order of the keys
+        values = [None] * len(keys)
+        for name, indexes in cls.group_by_node(keys).items():
+            node_values = cls.conns[name].mget([keys[index] for index in indexes])
+            for index, value in zip(indexes, node_values):
+                values[index] = value
+        return values
+
+    @classmethod
+    def delete(cls, keys):
+        # one DEL per node
+        for name, indexes in cls.group_by_node(keys).items():
+            cls.conns[name].delete(*[keys[index] for index in indexes])
+
+    @classmethod
+    def get_pubsub(cls):
+        # subscribers block on reading for as long as nothing is published,
+        # so they get their own connection without the socket timeout of the pool
+        node = settings.REDIS_NODES[0]
+        conn = redis.Redis(
+            host=node['host'],
+            port=node['port'],
+            db=node.get('db', settings.REDIS_DB),
+            socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+            socket_keepalive=True,
+            health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
         )
-        return cls.conn
+        return conn.pubsub(ignore_subscribe_messages=True)
+
+    @classmethod
+    def get_pool_stats(cls):
+        cls._setup()
+        stats = []
+        for name, pool in cls.pools.items():
+            # the queue of a BlockingConnectionPool holds the idle connections,
+            # and None for the connections that have not been created yet
+            idle = sum(1 for connection in list(pool.pool.queue) if connection is not None)
+            created = len(pool._connections)
+            stats.append({
+                'node': name,
+                'pid': cls.pid,
+                'max_connections': pool.max_connections,
+                'created': created,
+                'in_use': created - idle,
+                'idle': idle,
+            })
+        return stats
+
+    @classmethod
+    def load_script(cls, script):
+        # the sha only depends on the script, load it on every node at once
+        sha = cls.script_shas.get(script)
+        if sha is None:
+            for conn in cls.get_all_connections():
+                sha = conn.script_load(script)
+            cls.script_shas[script] = sha
+        return sha
+
+    @classmethod
+    def run_script(cls, script, keys=(), args=(), conn=None):
+        # send only the sha of the script instead of the whole source every time.
+        # the script runs on the node of its first key, all of its keys must live there
+        if conn is None:
+            conn = cls.get_connection(keys[0] if keys else None)
+        sha = cls.load_script(script)
+        try:
+            return conn.evalsha(sha, len(keys), *keys, *args)
+        except redis.exceptions.NoScriptError:
+            sha = cls.reload_script(script, conn)
+            return conn.evalsha(sha, len(keys), *keys, *args)
+
+    @classmethod
+    def reload_script(cls, script, conn):
+        # script cache on the server was flushed (restart, SCRIPT FLUSH), load it again
+        sha = conn.script_load(script)
+        cls.script_shas[script] = sha
+        return sha
 
     @classmethod
     def clear(cls):
         # clear all keys in redis, for testing purpose
         if not settings.TESTING:
             raise Exception('You can not flush redis in production environment!')
-        conn = cls.get_connection()
-        conn.flushdb()
\ No newline at end of file
+        for conn in cls.get_all_connections():
+            conn.flushdb()
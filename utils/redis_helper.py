@@ -1,56 +1,485 @@
+import time
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+
+import redis
+from django.apps import apps
 from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Exists, F
+from django.db.models.functions import Coalesce
 
+from twitter.cache import COUNTER_DELTAS_PATTERN, COUNTER_FLUSHING_PATTERN
+from utils.cache_metrics import CacheMetrics
+from utils.compression import Compression
+from utils.early_refresh import EarlyRefresh
+from utils.models import CounterFlush
 from utils.redis_client import RedisClient
-from utils.redis_serializers import DjangoModelSerializer
+from utils.redis_scripts import (
+    BACKFILL_COUNT_SCRIPT,
+    EXTEND_LOCK_SCRIPT,
+    FINISH_FLUSH_SCRIPT,
+    INCR_COUNT_SCRIPT,
+    PUSH_IF_EXISTS_SCRIPT,
+    PUSH_IF_MISSING_SCRIPT,
+    RELEASE_LOCK_SCRIPT,
+    START_FLUSH_SCRIPT,
+    ZADD_IF_EXISTS_SCRIPT,
+)
+from utils.redis_serializers import CompactModelSerializer
+from utils.time_helpers import to_microseconds, utc_now
+
+# field of a flushing hash that holds the id of its flush, object ids are numbers
+FLUSH_ID_FIELD = '__flush_id__'
+# a back fill reads db again when a flush takes the deltas meanwhile, at most this often
+COUNTER_BACKFILL_ATTEMPTS = 3
 
 
 class RedisHelper:
 
     @classmethod
-    def _load_objects_to_cache(cls, key, objects):
-        conn = RedisClient.get_connection()
+    def get_fill_lock_key(cls, key):
+        return '{}:fill_lock'.format(key)
+
+    @classmethod
+    def _acquire_lock(cls, lock_key, timeout, conn=None):
+        # returns the owner token, or None if the lock is held by someone else
+        conn = conn or RedisClient.get_connection(lock_key)
+        token = uuid.uuid4().hex
+        acquired = conn.set(lock_key, token, nx=True, px=int(timeout * 1000))
+        return token if acquired else None
 
+    @classmethod
+    def _release_lock(cls, lock_key, token, conn=None):
+        RedisClient.run_script(RELEASE_LOCK_SCRIPT, keys=[lock_key], args=[token], conn=conn)
+
+    @classmethod
+    def _extend_lock(cls, lock_key, token, timeout, conn=None):
+        # returns False if the lock expired and may be held by someone else now
+        return bool(RedisClient.run_script(
+            EXTEND_LOCK_SCRIPT, keys=[lock_key], args=[token, int(timeout * 1000)], conn=conn,
+        ))
+
+    @classmethod
+    def _acquire_fill_lock(cls, key):
+        return cls._acquire_lock(cls.get_fill_lock_key(key), settings.REDIS_FILL_LOCK_TIMEOUT)
+
+    @classmethod
+    def _release_fill_lock(cls, key, token):
+        cls._release_lock(cls.get_fill_lock_key(key), token)
+
+    @classmethod
+    def _wait_for_filler(cls, key):
+        # another reader is rebuilding this list from db, wait for it instead of
+        # sending one more identical query to db
+        conn = RedisClient.get_connection(key)
+        lock_key = cls.get_fill_lock_key(key)
+        deadline = time.monotonic() + settings.REDIS_FILL_LOCK_TIMEOUT
+        while time.monotonic() < deadline:
+            time.sleep(settings.REDIS_FILL_POLL_INTERVAL)
+            pipe = conn.pipeline(transaction=False)
+            pipe.lrange(key, 0, -1)
+            pipe.exists(lock_key)
+            serialized_list, is_filling = pipe.execute()
+            if serialized_list or not is_filling:
+                return serialized_list
+        return []
+
+    @classmethod
+    def _deserialize_list(cls, pattern, serialized_list):
+        return [
+            CompactModelSerializer.deserialize(Compression.decompress(pattern, serialized_data))
+            for serialized_data in serialized_list
+        ]
+
+    @classmethod
+    def get_cost_key(cls, key):
+        # seconds it took to build the key from db, for the early refresh
+        return '{}:cost'.format(key)
+
+    @classmethod
+    def _get_ttl(cls):
+        return EarlyRefresh.get_ttl(settings.REDIS_KEY_EXPIRE_TIME)
+
+    @classmethod
+    def _queue_cost(cls, pipe, key, delta, ttl):
+        if EarlyRefresh.is_enabled() and delta is not None:
+            pipe.set(cls.get_cost_key(key), delta, ex=ttl)
+
+    @classmethod
+    def _should_refresh(cls, pttl, cost):
+        # pttl is negative when the key does not exist or has no ttl. the cost can be gone
+        # before the key, pushes refresh the ttl of the key only, it then just expires
+        if pttl is None or pttl <= 0 or cost is None:
+            return False
+        return EarlyRefresh.should_refresh(float(cost), time.time() + pttl / 1000)
+
+    @classmethod
+    def _queue_list(cls, pipe, key, objects, delta=None):
+        pattern = CacheMetrics.get_pattern(key)
         serialized_list = []
         for obj in objects[:settings.REDIS_LIST_LENGTH_LIMIT]:
-            serialized_data = DjangoModelSerializer.serialize(obj)
-            serialized_list.append(serialized_data)
+            serialized_data = CompactModelSerializer.serialize(obj)
+            serialized_list.append(Compression.compress(pattern, serialized_data))
 
-        if serialized_list:
-            # rpush可以直接把一串数据都push进去，而不要用for循环，不然多次访问数据库会浪费
-            conn.rpush(key, *serialized_list)
-            conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+        if not serialized_list:
+            return False
+        # rpush可以直接把一串数据都push进去，而不要用for循环，不然多次访问数据库会浪费
+        ttl = cls._get_ttl()
+        pipe.delete(key)
+        pipe.rpush(key, *serialized_list)
+        pipe.expire(key, ttl)
+        cls._queue_cost(pipe, key, delta, ttl)
+        return True
+
+    @classmethod
+    def _load_objects_to_cache(cls, key, objects, delta=None):
+        # delete + rpush + expire in one MULTI, so the list is never pushed twice
+        pipe = RedisClient.get_connection(key).pipeline(transaction=True)
+        if cls._queue_list(pipe, key, objects, delta):
+            pipe.execute()
+
+    @classmethod
+    def _fill_cache(cls, key, queryset):
+        # rebuild the list from db if nobody else is doing it.
+        # return the loaded objects, or None if another process holds the fill lock
+        token = cls._acquire_fill_lock(key)
+        if token is None:
+            return None
+        try:
+            with CacheMetrics.time_fill(CacheMetrics.get_pattern(key)):
+                start = time.perf_counter()
+                objects = list(queryset[:settings.REDIS_LIST_LENGTH_LIMIT])
+                cls._load_objects_to_cache(key, objects, time.perf_counter() - start)
+        finally:
+            cls._release_fill_lock(key, token)
+        return objects
 
     @classmethod
     def load_objects(cls, key, queryset):
-        conn = RedisClient.get_connection()
+        conn = RedisClient.get_connection(key)
+        pattern = CacheMetrics.get_pattern(key)
 
-        # if exists in cache, take out and return
-        if conn.exists(key):
+        # one round trip. redis never keeps an empty list, so empty means cache miss
+        with CacheMetrics.time_round_trip(pattern, 'redis'):
+            if EarlyRefresh.is_enabled():
+                pipe = conn.pipeline(transaction=False)
+                pipe.lrange(key, 0, -1)
+                pipe.pttl(key)
+                pipe.get(cls.get_cost_key(key))
+                serialized_list, pttl, cost = pipe.execute()
+                refresh = cls._should_refresh(pttl, cost)
+            else:
+                serialized_list, refresh = conn.lrange(key, 0, -1), False
+        if serialized_list:
             # cache hit
-            serialized_list = conn.lrange(key, 0, -1)
-            objects = []
-            for serialized_data in serialized_list:
-                deserialized_obj = DjangoModelSerializer.deserialize(serialized_data)
-                objects.append(deserialized_obj)
+            CacheMetrics.hit(pattern, 'redis')
+            if refresh:
+                # this reader rebuilds the list before it expires, if another one is
+                # already doing it the cached list is still good to return
+                objects = cls._fill_cache(key, queryset)
+                if objects is not None:
+                    return objects
+            return cls._deserialize_list(pattern, serialized_list)
+
+        # cache miss, only one reader goes to db
+        CacheMetrics.miss(pattern)
+        objects = cls._fill_cache(key, queryset)
+        if objects is not None:
             return objects
 
-        # cache miss
-        cls._load_objects_to_cache(key, queryset)
+        serialized_list = cls._wait_for_filler(key)
+        if serialized_list:
+            return cls._deserialize_list(pattern, serialized_list)
 
+        # the filler found nothing in db or did not finish in time, read db without caching
         # 转为list是因为要保持返回类型的统一。因为redis里面的数据是list的形式
-        return list(queryset)
+        return list(queryset[:settings.REDIS_LIST_LENGTH_LIMIT])
 
     @classmethod
     def push_object(cls, key, obj, queryset):
-        conn = RedisClient.get_connection()
-        if not conn.exists(key):
+        # push + trim + refresh ttl atomically, so the key can not expire in between
+        # and leave a list that only contains the new object
+        if not cls.push_objects([(key, obj)]):
             # if key does not exist in cache, load data from database
             # and do not use push to append to cache
-            cls._load_objects_to_cache(key, queryset)
-            return
-        serialized_data = DjangoModelSerializer.serialize(obj)
-        conn.lpush(key, serialized_data)
-        conn.ltrim(key, 0, settings.REDIS_LIST_LENGTH_LIMIT - 1) # 0-199
+            cls._fill_cache(key, queryset)
+
+    @classmethod
+    def push_objects(cls, keyed_objects, if_missing=False):
+        """
+        Batch version of push_object for [(key, obj)], e.g. one tweet into the newsfeeds
+        of all the followers of a fanout batch: one pipeline of PUSH_IF_EXISTS_SCRIPT per
+        node. Keys that are not cached are skipped instead of rebuilt from db, the owner
+        loads them when reading them next time. Returns the number of cached lists that
+        have the object now.
+        if_missing: skip the lists that already have the object, it scans the lists,
+        only for objects that may have been pushed before
+        """
+        if not keyed_objects:
+            return 0
+        keys = [key for key, _ in keyed_objects]
+        pattern = CacheMetrics.get_pattern(keys[0])
+        ttl = cls._get_ttl()
+        entries = [
+            (key, Compression.compress(pattern, CompactModelSerializer.serialize(obj)))
+            for key, obj in keyed_objects
+        ]
+        script = PUSH_IF_MISSING_SCRIPT if if_missing else PUSH_IF_EXISTS_SCRIPT
+        sha = RedisClient.load_script(script)
+        connections = RedisClient.get_node_connections()
+        pushed = 0
+        filling = []
+        with CacheMetrics.time_round_trip(pattern, 'redis'):
+            for name, indexes in RedisClient.group_by_node(keys).items():
+                conn, node_entries = connections[name], [entries[index] for index in indexes]
+                try:
+                    results = cls._push_node_objects(conn, sha, node_entries, ttl)
+                except redis.exceptions.NoScriptError:
+                    # script cache on the server was flushed, every evalsha failed, send them again
+                    sha = RedisClient.reload_script(script, conn)
+                    results = cls._push_node_objects(conn, sha, node_entries, ttl)
+                for entry, (result, is_filling) in zip(node_entries, results):
+                    if is_filling:
+                        filling.append(entry)
+                    else:
+                        pushed += result
+        for key, serialized_data in filling:
+            pushed += cls._push_after_fill(key, serialized_data, ttl)
+        return pushed
+
+    @classmethod
+    def _push_node_objects(cls, conn, sha, entries, ttl):
+        # returns (pushed, whether a filler holds the lock) for every entry
+        pipe = conn.pipeline(transaction=False)
+        for key, serialized_data in entries:
+            pipe.evalsha(sha, 1, key, serialized_data, settings.REDIS_LIST_LENGTH_LIMIT, ttl)
+            pipe.exists(cls.get_fill_lock_key(key))
+        results = pipe.execute()
+        return list(zip(results[::2], results[1::2]))
+
+    @classmethod
+    def _push_after_fill(cls, key, serialized_data, ttl):
+        # a filler is rebuilding the list from a query that may predate the object,
+        # and writes over the list when it is done. push again after it, unless its
+        # query had the object. if it does not finish in time drop the list, the next
+        # reader loads it from db
+        cls._wait_for_fill_lock(key)
+        conn = RedisClient.get_connection(key)
+        if conn.exists(cls.get_fill_lock_key(key)):
+            conn.delete(key)
+            return 0
+        return RedisClient.run_script(
+            PUSH_IF_MISSING_SCRIPT,
+            keys=[key],
+            args=[serialized_data, settings.REDIS_LIST_LENGTH_LIMIT, ttl],
+            conn=conn,
+        )
+
+    @classmethod
+    def _wait_for_fill_lock(cls, key):
+        conn = RedisClient.get_connection(key)
+        lock_key = cls.get_fill_lock_key(key)
+        deadline = time.monotonic() + settings.REDIS_FILL_LOCK_TIMEOUT
+        while time.monotonic() < deadline and conn.exists(lock_key):
+            time.sleep(settings.REDIS_FILL_POLL_INTERVAL)
+
+    @classmethod
+    def get_index_member(cls, object_id):
+        # fixed width, so that members with the same score are ordered by id
+        return '{:020d}'.format(object_id)
+
+    @classmethod
+    def _queue_index(cls, pipe, key, rows, delta=None):
+        # rows are (id, created_at), the score is created_at in microseconds
+        mapping = {
+            cls.get_index_member(object_id): to_microseconds(created_at)
+            for object_id, created_at in rows[:settings.REDIS_LIST_LENGTH_LIMIT]
+        }
+        if not mapping:
+            return False
+        ttl = cls._get_ttl()
+        pipe.delete(key)
+        pipe.zadd(key, mapping)
+        pipe.expire(key, ttl)
+        cls._queue_cost(pipe, key, delta, ttl)
+        return True
+
+    @classmethod
+    def _load_index_to_cache(cls, key, rows, delta=None):
+        pipe = RedisClient.get_connection(key).pipeline(transaction=True)
+        if cls._queue_index(pipe, key, rows, delta):
+            pipe.execute()
+
+    @classmethod
+    def _fill_index(cls, key, queryset):
+        # same as _fill_cache, but only ids and created_at are read from db
+        token = cls._acquire_fill_lock(key)
+        if token is None:
+            return None
+        try:
+            with CacheMetrics.time_fill(CacheMetrics.get_pattern(key)):
+                start = time.perf_counter()
+                rows = list(
+                    queryset.values_list('id', 'created_at')[:settings.REDIS_LIST_LENGTH_LIMIT]
+                )
+                cls._load_index_to_cache(key, rows, time.perf_counter() - start)
+        finally:
+            cls._release_fill_lock(key, token)
+        return rows
+
+    @classmethod
+    def _range_index(cls, key, before, after, count):
+        # returns the size of the index, the (score, id) of the matched members, newest first,
+        # and whether this reader should rebuild the index early
+        conn = RedisClient.get_connection(key)
+        limit = {} if count is None else {'start': 0, 'num': count}
+        pipe = conn.pipeline(transaction=False)
+        pipe.zcard(key)
+        pipe.pttl(key)
+        pipe.get(cls.get_cost_key(key))
+        if after is not None:
+            pipe.zrevrangebyscore(key, '+inf', after[0], withscores=True)
+        elif before is not None:
+            # the members with the same score as the cursor are filtered by id below
+            pipe.zrevrangebyscore(key, before[0], before[0], withscores=True)
+            pipe.zrevrangebyscore(
+                key, '({}'.format(before[0]), '-inf', withscores=True, **limit,
+            )
+        else:
+            pipe.zrevrangebyscore(key, '+inf', '-inf', withscores=True, **limit)
+        size, pttl, cost, *results = pipe.execute()
+
+        rows = [
+            (int(score), int(member))
+            for result in results
+            for member, score in result
+        ]
+        if after is not None:
+            rows = [row for row in rows if row > tuple(after)]
+        elif before is not None:
+            rows = [row for row in rows if row < tuple(before)]
+        if count is not None:
+            rows = rows[:count]
+        return size, rows, cls._should_refresh(pttl, cost)
+
+    @classmethod
+    def load_object_ids(cls, key, queryset, before=None, after=None, count=None):
+        """
+        Read ids from a sorted set index, newest first. before / after are the
+        (created_at in microseconds, id) of a cursor: at most count ids older than
+        before, or all the ids newer than after.
+        Returns None if the answer can not come from the index: the page goes past the
+        oldest member of a full index, or the index could not be built. Read db then.
+        """
+        pattern = CacheMetrics.get_pattern(key)
+        with CacheMetrics.time_round_trip(pattern, 'redis'):
+            size, rows, refresh = cls._range_index(key, before, after, count)
+        if not size:
+            # cache miss, only one reader goes to db
+            CacheMetrics.miss(pattern)
+            if cls._fill_index(key, queryset) is None:
+                cls._wait_for_fill_lock(key)
+            size, rows, _ = cls._range_index(key, before, after, count)
+            if not size:
+                return None
+        else:
+            CacheMetrics.hit(pattern, 'redis')
+            # rebuilt before it expires by this reader, unless another one is on it
+            if refresh and cls._fill_index(key, queryset) is not None:
+                size, rows, _ = cls._range_index(key, before, after, count)
+
+        if count is not None and len(rows) < count \
+                and size >= settings.REDIS_LIST_LENGTH_LIMIT:
+            # older objects may only be in db
+            return None
+        return [object_id for _, object_id in rows]
+
+    @classmethod
+    def push_object_to_index(cls, key, obj, queryset):
+        pushed = RedisClient.run_script(
+            ZADD_IF_EXISTS_SCRIPT,
+            keys=[key],
+            args=[
+                cls.get_index_member(obj.id),
+                to_microseconds(obj.created_at),
+                settings.REDIS_LIST_LENGTH_LIMIT,
+                cls._get_ttl(),
+            ],
+        )
+        if not pushed:
+            cls._fill_index(key, queryset)
+
+    @classmethod
+    def fill_many(cls, querysets, index=False):
+        """
+        Rebuild the missing keys of {key: queryset} with a few pipelines per node instead
+        of a fill per key, used to warm the caches. Keys that exist, or that someone else
+        is filling, are left alone. Fill locks are taken like in _fill_cache.
+        index=False builds lists like load_objects, index=True sorted sets like
+        load_object_ids. Returns {key: objects, or (id, created_at) rows if index}
+        of the keys that were filled.
+        """
+        keys = list(querysets.keys())
+        connections = RedisClient.get_node_connections()
+        release_sha = RedisClient.load_script(RELEASE_LOCK_SCRIPT)
+        lock_timeout = int(settings.REDIS_FILL_LOCK_TIMEOUT * 1000)
+        filled = {}
+        for name, indexes in RedisClient.group_by_node(keys).items():
+            conn = connections[name]
+            node_keys = [keys[index] for index in indexes]
+
+            pipe = conn.pipeline(transaction=False)
+            for key in node_keys:
+                pipe.exists(key)
+            missed_keys = [
+                key for key, exists in zip(node_keys, pipe.execute()) if not exists
+            ]
+            if not missed_keys:
+                continue
+
+            tokens = {key: uuid.uuid4().hex for key in missed_keys}
+            pipe = conn.pipeline(transaction=False)
+            for key in missed_keys:
+                pipe.set(cls.get_fill_lock_key(key), tokens[key], nx=True, px=lock_timeout)
+            locked_keys = [
+                key for key, acquired in zip(missed_keys, pipe.execute()) if acquired
+            ]
+
+            pipe = conn.pipeline(transaction=False)
+            try:
+                for key in locked_keys:
+                    queryset = querysets[key][:settings.REDIS_LIST_LENGTH_LIMIT]
+                    start = time.perf_counter()
+                    if index:
+                        results = list(queryset.values_list('id', 'created_at'))
+                        delta = time.perf_counter() - start
+                        queued = cls._queue_index(pipe, key, results, delta)
+                    else:
+                        results = list(queryset)
+                        delta = time.perf_counter() - start
+                        queued = cls._queue_list(pipe, key, results, delta)
+                    if queued:
+                        filled[key] = results
+            finally:
+                for key in locked_keys:
+                    pipe.evalsha(release_sha, 1, cls.get_fill_lock_key(key), tokens[key])
+                cls._check_pipeline(conn, locked_keys, tokens, pipe.execute(raise_on_error=False))
+        return filled
+
+    @classmethod
+    def _check_pipeline(cls, conn, keys, tokens, results):
+        # the lock releases are the last results, the writes come before them
+        releases = results[len(results) - len(keys):]
+        for key, result in zip(keys, releases):
+            if isinstance(result, redis.exceptions.NoScriptError):
+                # script cache on the server was flushed, run_script loads it again
+                cls._release_lock(cls.get_fill_lock_key(key), tokens[key], conn=conn)
+        for result in results:
+            if isinstance(result, Exception) \
+                    and not isinstance(result, redis.exceptions.NoScriptError):
+                raise result
 
     @classmethod
     def get_count_key(cls, obj, attr):
@@ -59,47 +488,285 @@ class RedisHelper:
         return '{}.{}:{}'.format(obj.__class__.__name__, attr, obj.id)
 
     @classmethod
-    def incr_count(cls, obj, attr):
-        conn = RedisClient.get_connection()
-        key = cls.get_count_key(obj, attr)
-        if conn.exists(key):
-            # incr(key) will get the value, increase by 1 and return the new value
-            return conn.incr(key)
-
-        # set the attr with related key
-        # back fill cache from db
-        # obj.refresh_from_db() will reload data from db,
-        # 不执行+1操作，因为必须保证调用incr_count之前obj.attr已经+1过了
-        # 不能保证调用者会在调用本函数前更新最新数据，所以在这个函数内部写refresh，以防调用者没有使用更新过的数据
-        obj.refresh_from_db()
-        conn.set(key, getattr(obj, attr))
-        conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
-        return getattr(obj, attr)
+    def get_count_delta_keys(cls, model_class, attr):
+        counter = '{}.{}'.format(model_class.__name__, attr)
+        return (
+            COUNTER_DELTAS_PATTERN.format(counter=counter),
+            COUNTER_FLUSHING_PATTERN.format(counter=counter),
+        )
 
+    @classmethod
+    def _backfill_count(cls, obj, attr):
+        counts = {}
+        cls._backfill_counts(obj.__class__, [attr], [(obj, attr, cls.get_count_key(obj, attr))], counts)
+        return counts.get(obj.id, {}).get(attr, 0)
 
     @classmethod
-    def decr_count(cls, obj, attr):
-        conn = RedisClient.get_connection()
+    def incr_count(cls, obj, attr, amount=1):
+        # write behind: redis is the source of truth of the counter, the delta is
+        # written to db later by flush_count_deltas in bulk instead of one
+        # UPDATE per like / comment on the same hot row
         key = cls.get_count_key(obj, attr)
-        if conn.exists(key):
-            return conn.decr(key)
+        deltas_key, _ = cls.get_count_delta_keys(obj.__class__, attr)
+        count = RedisClient.run_script(
+            INCR_COUNT_SCRIPT,
+            keys=[key, deltas_key],
+            args=[obj.id, amount],
+        )
+        if count is not None:
+            return count
+        # counter not cached, back fill it, the delta above is already included
+        return cls._backfill_count(obj, attr)
 
-        # obj.refresh_from_db() will reload data from db,
-        # 不执行 -1 操作，因为必须保证调用 decr_count 之前 obj.attr 已经 -1 过了
-        obj.refresh_from_db()
-        conn.set(key, getattr(obj, attr))
-        conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
-        return getattr(obj, attr)
+    @classmethod
+    def decr_count(cls, obj, attr):
+        return cls.incr_count(obj, attr, amount=-1)
 
     @classmethod
     def get_count(cls, obj, attr):
-        conn = RedisClient.get_connection()
+        # already loaded for the whole page by prefetch_counts
+        prefetched_counts = getattr(obj, '_prefetched_counts', {})
+        if attr in prefetched_counts:
+            return prefetched_counts[attr]
+
         key = cls.get_count_key(obj, attr)
-        count = conn.get(key)
+        pattern = CacheMetrics.get_pattern(key)
+        with CacheMetrics.time_round_trip(pattern, 'redis'):
+            count = RedisClient.get_connection(key).get(key)
         if count is not None:
+            CacheMetrics.hit(pattern, 'redis')
             return int(count)
 
-        obj.refresh_from_db()
-        count = getattr(obj, attr)
-        conn.set(key, count)
-        return count
+        CacheMetrics.miss(pattern)
+        with CacheMetrics.time_fill(pattern):
+            return cls._backfill_count(obj, attr)
+
+    @classmethod
+    def get_counts(cls, objects, attrs):
+        # batch version of get_count for a page of objects of the same model:
+        # one MGET per node for all counters, one db query and one pipeline per node
+        # to back fill the misses
+        # returns {obj.id: {attr: count}}
+        objects = [obj for obj in objects if obj is not None]
+        if not objects:
+            return {}
+        pairs = [(obj, attr) for obj in objects for attr in attrs]
+        keys = [cls.get_count_key(obj, attr) for obj, attr in pairs]
+
+        model_class = objects[0].__class__
+        # the MGET covers all the attrs, its time is recorded under each counter
+        # pattern, e.g. Tweet.likes_count and Tweet.comments_count
+        patterns = [CacheMetrics.get_pattern(cls.get_count_key(objects[0], attr)) for attr in attrs]
+        with CacheMetrics.time_round_trip(patterns, 'redis'):
+            values = RedisClient.mget(keys)
+
+        counts = {}
+        missed = []
+        for (obj, attr), key, value in zip(pairs, keys, values):
+            if value is None:
+                CacheMetrics.miss(CacheMetrics.get_pattern(key))
+                missed.append((obj, attr, key))
+            else:
+                CacheMetrics.hit(CacheMetrics.get_pattern(key), 'redis')
+                counts.setdefault(obj.id, {})[attr] = int(value)
+        if not missed:
+            return counts
+
+        missed_patterns = {CacheMetrics.get_pattern(key) for _, _, key in missed}
+        with CacheMetrics.time_fill([pattern for pattern in patterns if pattern in missed_patterns]):
+            cls._backfill_counts(model_class, attrs, missed, counts)
+        return counts
+
+    @classmethod
+    def _backfill_counts(cls, model_class, attrs, missed, counts):
+        # the count in db does not contain the deltas that have not been flushed yet.
+        # a flush can commit between reading db and setting the counter, so the counter
+        # is only set if the flushing hash still holds the flush seen when reading db,
+        # and its deltas are only added if that flush is not in db yet
+        connections = RedisClient.get_node_connections()
+        for _ in range(COUNTER_BACKFILL_ATTEMPTS):
+            groups = RedisClient.group_by_node([key for _, _, key in missed])
+            flush_ids = cls._get_flush_ids(model_class, attrs, connections, groups.keys())
+            rows, applied_ids = cls._get_db_counts(
+                model_class, attrs, {obj.id for obj, _, _ in missed}, set(flush_ids.values()),
+            )
+            missed = [(obj, attr, key) for obj, attr, key in missed if obj.id in rows]
+            groups = RedisClient.group_by_node([key for _, _, key in missed])
+            retries = []
+            for name, indexes in groups.items():
+                conn, entries = connections[name], [missed[index] for index in indexes]
+                args = [
+                    (rows[obj.id][attr] or 0, flush_ids[(name, attr)])
+                    for obj, attr, _ in entries
+                ]
+                try:
+                    results = cls._backfill_node_counts(conn, model_class, entries, args, applied_ids)
+                except redis.exceptions.NoScriptError:
+                    # script cache on the server was flushed, every evalsha failed, send them again
+                    RedisClient.reload_script(BACKFILL_COUNT_SCRIPT, conn)
+                    results = cls._backfill_node_counts(conn, model_class, entries, args, applied_ids)
+                for entry, count in zip(entries, results):
+                    if count is None:
+                        retries.append(entry)
+                    else:
+                        counts.setdefault(entry[0].id, {})[entry[1]] = count
+            missed = retries
+            if not missed:
+                return
+        # flushed every time, return the count in db without caching it
+        for obj, attr, _ in missed:
+            counts.setdefault(obj.id, {})[attr] = rows[obj.id][attr] or 0
+
+    @classmethod
+    def _get_flush_ids(cls, model_class, attrs, connections, names):
+        # (node name, attr) -> id of the flush in the flushing hash of the node, or ''
+        flush_ids = {}
+        for name in names:
+            pipe = connections[name].pipeline(transaction=False)
+            for attr in attrs:
+                _, flushing_key = cls.get_count_delta_keys(model_class, attr)
+                pipe.hget(flushing_key, FLUSH_ID_FIELD)
+            for attr, flush_id in zip(attrs, pipe.execute()):
+                flush_ids[(name, attr)] = flush_id.decode() if flush_id else ''
+        return flush_ids
+
+    @classmethod
+    def _get_db_counts(cls, model_class, attrs, object_ids, flush_ids):
+        # returns {id: row} and the flush ids applied to these rows, read in one query
+        # so that both come from the same snapshot of db
+        queryset = model_class.objects.filter(id__in=object_ids)
+        applied_fields = {}
+        for index, flush_id in enumerate(sorted(flush_id for flush_id in flush_ids if flush_id)):
+            field = '_flush_applied_{}'.format(index)
+            applied_fields[field] = flush_id
+            queryset = queryset.annotate(**{
+                field: Exists(CounterFlush.objects.filter(flush_id=flush_id)),
+            })
+        rows = {row['id']: row for row in queryset.values('id', *attrs, *applied_fields)}
+        # the flags are the same on every row
+        row = next(iter(rows.values()), None)
+        if row is None:
+            return rows, set()
+        return rows, {flush_id for field, flush_id in applied_fields.items() if row[field]}
+
+    @classmethod
+    def _backfill_node_counts(cls, conn, model_class, entries, args, applied_ids):
+        sha = RedisClient.load_script(BACKFILL_COUNT_SCRIPT)
+        pipe = conn.pipeline(transaction=False)
+        for (obj, attr, key), (db_count, flush_id) in zip(entries, args):
+            # the deltas hashes are node local, the ones on the node of the counter
+            deltas_key, flushing_key = cls.get_count_delta_keys(model_class, attr)
+            pipe.evalsha(
+                sha, 3, key, deltas_key, flushing_key,
+                obj.id, db_count, cls._get_ttl(),
+                FLUSH_ID_FIELD, flush_id, '1' if flush_id in applied_ids else '0',
+            )
+        return pipe.execute()
+
+    @classmethod
+    def prefetch_counts(cls, objects, attrs):
+        # attach the counters to every object, get_count will use them instead of redis
+        counts = cls.get_counts(objects, attrs)
+        for obj in objects:
+            if obj is not None:
+                obj._prefetched_counts = counts.get(obj.id, {})
+
+    @classmethod
+    def flush_count_deltas(cls, model_class, attr):
+        # write the accumulated deltas to db in bulk, called periodically by celery.
+        # the pending hash is renamed to the flushing hash first and tagged with a flush id,
+        # new increments keep going to a fresh pending hash. the flush id is written to db
+        # in the same transaction as the counters, and the flushing hash is only deleted
+        # after that. if the worker dies in between, the next run finds the flush id in db
+        # and only deletes the hash, so the deltas are applied exactly once.
+        # every node keeps the deltas of the counters it owns, they are flushed one by one
+        flushed = 0
+        for conn in RedisClient.get_all_connections():
+            flushed += cls._flush_node_count_deltas(conn, model_class, attr)
+        return flushed
+
+    @classmethod
+    def _flush_node_count_deltas(cls, conn, model_class, attr):
+        deltas_key, flushing_key = cls.get_count_delta_keys(model_class, attr)
+        lock_key = '{}:lock'.format(flushing_key)
+        timeout = settings.COUNTER_FLUSH_LOCK_TIMEOUT
+        token = cls._acquire_lock(lock_key, timeout, conn=conn)
+        if token is None:
+            # another worker is flushing
+            return 0
+        try:
+            # deltas left by a worker that died mid flush go first
+            flushed = cls._apply_count_deltas(conn, model_class, attr, flushing_key)
+            # a flush slower than the lock timeout stops here, the flush ids keep it
+            # from applying anything twice meanwhile
+            if not cls._extend_lock(lock_key, token, timeout, conn=conn):
+                return flushed
+            started = RedisClient.run_script(
+                START_FLUSH_SCRIPT,
+                keys=[deltas_key, flushing_key],
+                args=[FLUSH_ID_FIELD, uuid.uuid4().hex],
+                conn=conn,
+            )
+            if started:
+                flushed += cls._apply_count_deltas(conn, model_class, attr, flushing_key)
+        finally:
+            cls._release_lock(lock_key, token, conn=conn)
+        return flushed
+
+    @classmethod
+    def _apply_count_deltas(cls, conn, model_class, attr, flushing_key):
+        if not conn.exists(flushing_key):
+            return 0
+        # a flushing hash taken before there were flush ids
+        conn.hsetnx(flushing_key, FLUSH_ID_FIELD, uuid.uuid4().hex)
+        deltas = conn.hgetall(flushing_key)
+        flush_id = deltas.pop(FLUSH_ID_FIELD.encode(), b'').decode()
+        # most deltas are small numbers, group the rows by delta so that each
+        # group is a single UPDATE ... WHERE id IN (...)
+        ids_by_delta = defaultdict(list)
+        for object_id, delta in deltas.items():
+            if int(delta):
+                ids_by_delta[int(delta)].append(int(object_id))
+        try:
+            with transaction.atomic():
+                CounterFlush.objects.create(flush_id=flush_id)
+                for delta, object_ids in ids_by_delta.items():
+                    model_class.objects.filter(id__in=object_ids).update(
+                        **{attr: Coalesce(F(attr), 0) + delta}
+                    )
+            flushed = len(deltas)
+        except IntegrityError:
+            # applied by a run that died, or lost its lock, before deleting the hash
+            flushed = 0
+        RedisClient.run_script(
+            FINISH_FLUSH_SCRIPT, keys=[flushing_key], args=[FLUSH_ID_FIELD, flush_id], conn=conn,
+        )
+        return flushed
+
+    @classmethod
+    def flush_all_count_deltas(cls):
+        # flush every counter that has deltas on any node, e.g. before the nodes change:
+        # the deltas stay on the node they were written to, while a back fill on the new
+        # node of a counter only adds the deltas of that node
+        counters = set()
+        for conn in RedisClient.get_all_connections():
+            for pattern in (COUNTER_DELTAS_PATTERN, COUNTER_FLUSHING_PATTERN):
+                prefix = pattern.format(counter='')
+                for key in conn.scan_iter(match=prefix + '*'):
+                    counter = key.decode('utf-8')[len(prefix):]
+                    # the flush locks
+                    if ':' not in counter:
+                        counters.add(counter)
+        models = {model.__name__: model for model in apps.get_models()}
+        flushed = 0
+        for counter in sorted(counters):
+            model_name, attr = counter.split('.', 1)
+            flushed += cls.flush_count_deltas(models[model_name], attr)
+        return flushed
+
+    @classmethod
+    def delete_old_flushes(cls):
+        # a flushing hash is applied within seconds, older flush ids are not needed
+        created_before = utc_now() - timedelta(seconds=settings.COUNTER_FLUSH_RETENTION)
+        deleted, _ = CounterFlush.objects.filter(created_at__lt=created_before).delete()
+        return deleted
@@ -0,0 +1,121 @@
+# Lua scripts run atomically on the redis server through RedisClient.run_script
+
+# delete the lock only if we are still the owner, it may have expired and been taken by others
+# KEYS[1]: lock key, ARGV[1]: owner token
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# push to the head of a cached list only if the list is still there,
+# then trim it and refresh its ttl. returns 0 if the list does not exist.
+# KEYS[1]: list key, ARGV[1]: serialized object, ARGV[2]: length limit, ARGV[3]: ttl in seconds
+PUSH_IF_EXISTS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('LPUSH', KEYS[1], ARGV[1])
+redis.call('LTRIM', KEYS[1], 0, tonumber(ARGV[2]) - 1)
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+# same as PUSH_IF_EXISTS_SCRIPT, but does nothing if the value is already in the list,
+# e.g. a retried fanout batch whose first run pushed it. returns 0 if the list does not
+# exist, 1 if it has the value now.
+# KEYS[1]: list key, ARGV[1]: serialized object, ARGV[2]: length limit, ARGV[3]: ttl in seconds
+PUSH_IF_MISSING_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+for _, value in ipairs(redis.call('LRANGE', KEYS[1], 0, -1)) do
+    if value == ARGV[1] then
+        return 1
+    end
+end
+redis.call('LPUSH', KEYS[1], ARGV[1])
+redis.call('LTRIM', KEYS[1], 0, tonumber(ARGV[2]) - 1)
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+# write behind counter increment: always record the delta for the flush task,
+# and bump the cached counter if it is there. returns nil if the counter is not cached.
+# KEYS[1]: counter key, KEYS[2]: deltas hash, ARGV[1]: object id, ARGV[2]: amount
+INCR_COUNT_SCRIPT = """
+redis.call('HINCRBY', KEYS[2], ARGV[1], ARGV[2])
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('INCRBY', KEYS[1], ARGV[2])
+end
+return false
+"""
+
+# back fill a counter: the value in db plus the deltas that are not in db yet.
+# does nothing if the counter has been filled by someone else meanwhile.
+# the flushing hash is only added if its flush was not applied to the db that was read,
+# returns nil if another flush took the deltas since the db was read, read it again then.
+# KEYS[1]: counter key, KEYS[2]: deltas hash, KEYS[3]: flushing hash
+# ARGV[1]: object id, ARGV[2]: count in db, ARGV[3]: ttl in seconds,
+# ARGV[4]: flush id field, ARGV[5]: flush id when the db was read or '',
+# ARGV[6]: '1' if that flush was applied to the db that was read
+BACKFILL_COUNT_SCRIPT = """
+local count = redis.call('GET', KEYS[1])
+if count then
+    return tonumber(count)
+end
+if (redis.call('HGET', KEYS[3], ARGV[4]) or '') ~= ARGV[5] then
+    return false
+end
+count = tonumber(ARGV[2]) + tonumber(redis.call('HGET', KEYS[2], ARGV[1]) or 0)
+if ARGV[6] ~= '1' then
+    count = count + tonumber(redis.call('HGET', KEYS[3], ARGV[1]) or 0)
+end
+redis.call('SET', KEYS[1], count, 'EX', ARGV[3])
+return count
+"""
+
+# take the pending deltas of a counter for a flush and tag them with the flush id,
+# unless the previous flush is not done. returns 0 if nothing was taken.
+# KEYS[1]: deltas hash, KEYS[2]: flushing hash, ARGV[1]: flush id field, ARGV[2]: flush id
+START_FLUSH_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 1 or redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('RENAME', KEYS[1], KEYS[2])
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+return 1
+"""
+
+# delete the flushing hash only if it still holds the flush that was applied,
+# a flusher that lost its lock must not delete the deltas taken after it.
+# KEYS[1]: flushing hash, ARGV[1]: flush id field, ARGV[2]: flush id
+FINISH_FLUSH_SCRIPT = """
+if redis.call('HGET', KEYS[1], ARGV[1]) == ARGV[2] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# extend the lock only if we are still the owner. returns 0 if the lock was lost.
+# KEYS[1]: lock key, ARGV[1]: owner token, ARGV[2]: timeout in milliseconds
+EXTEND_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# add to a cached sorted set index only if it is still there, then drop the oldest
+# members beyond the limit and refresh its ttl. returns 0 if the index does not exist.
+# KEYS[1]: index key, ARGV[1]: member, ARGV[2]: score, ARGV[3]: size limit, ARGV[4]: ttl in seconds
+ZADD_IF_EXISTS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -tonumber(ARGV[3]) - 1)
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return 1
+"""
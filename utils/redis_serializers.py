@@ -1,5 +1,11 @@
+import struct
+
+from django.apps import apps
 from django.core import serializers
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import DEFERRED
 from utils.json_encoder import JSONEncoder
+from utils.time_helpers import from_microseconds, to_microseconds
 
 
 class DjangoModelSerializer:
@@ -15,4 +21,145 @@ class DjangoModelSerializer:
         # .object is required to get the object data of primitive model type,
         # otherwise will get DeserializedObject type rather than ORM object
         # will return the original object
-        return list(serializers.deserialize('json', serialized_data))[0].object
\ No newline at end of file
+        return list(serializers.deserialize('json', serialized_data))[0].object
+
+
+# model code -> (model label, field attnames)
+# the code and the order of the fields are part of the stored format:
+# only append new fields or new models, anything else needs a new COMPACT_FORMAT_VERSION
+COMPACT_MODEL_FIELD_TABLES = {
+    1: ('tweets.Tweet', (
+        'id', 'user_id', 'content', 'created_at', 'likes_count', 'comments_count',
+    )),
+    2: ('newsfeeds.NewsFeed', ('id', 'user_id', 'tweet_id', 'created_at')),
+}
+COMPACT_FORMAT_VERSION = 1
+
+INT_FIELD_TYPES = {
+    'AutoField', 'BigAutoField', 'SmallAutoField',
+    'IntegerField', 'BigIntegerField', 'SmallIntegerField',
+    'PositiveIntegerField', 'PositiveBigIntegerField', 'PositiveSmallIntegerField',
+}
+STR_FIELD_TYPES = {'CharField', 'TextField'}
+DATETIME_FIELD_TYPES = {'DateTimeField'}
+
+HEADER = struct.Struct('>BBB')  # version, model code, number of fields
+INT64 = struct.Struct('>q')
+UINT32 = struct.Struct('>I')
+
+
+class CompactFieldTable:
+
+    def __init__(self, code, model_class, attnames):
+        self.code = code
+        self.model_class = model_class
+        self.attnames = attnames
+        fields = {field.attname: field for field in model_class._meta.concrete_fields}
+        self.kinds = [self._get_kind(fields[attname]) for attname in attnames]
+        self.concrete_attnames = [
+            field.attname for field in model_class._meta.concrete_fields
+        ]
+        self.bitmap_size = (len(attnames) + 7) // 8
+
+    @classmethod
+    def _get_kind(cls, field):
+        # ForeignKey is stored as the id of the target row
+        field_type = field.target_field.get_internal_type() if field.is_relation \
+            else field.get_internal_type()
+        if field_type in INT_FIELD_TYPES:
+            return 'int'
+        if field_type in DATETIME_FIELD_TYPES:
+            return 'datetime'
+        if field_type in STR_FIELD_TYPES:
+            return 'str'
+        raise ValueError('{} is not supported by CompactModelSerializer'.format(field))
+
+
+class CompactModelSerializer:
+    """
+    Schema aware binary codec for the objects we keep in redis lists.
+    Layout: version | model code | number of fields | null bitmap | non null values
+    ints are packed as int64, datetimes as int64 microseconds since epoch (UTC),
+    strings as uint32 length + utf-8 bytes.
+    Models without a field table (and data written by DjangoModelSerializer before)
+    still go through DjangoModelSerializer.
+    """
+    _tables_by_code = None
+    _tables_by_model = None
+
+    @classmethod
+    def _load_tables(cls):
+        if cls._tables_by_code is not None:
+            return
+        tables_by_code, tables_by_model = {}, {}
+        for code, (label, attnames) in COMPACT_MODEL_FIELD_TABLES.items():
+            table = CompactFieldTable(code, apps.get_model(label), attnames)
+            tables_by_code[code] = table
+            tables_by_model[table.model_class] = table
+        cls._tables_by_model = tables_by_model
+        cls._tables_by_code = tables_by_code
+
+    @classmethod
+    def serialize(cls, instance):
+        cls._load_tables()
+        table = cls._tables_by_model.get(instance.__class__)
+        if table is None:
+            return DjangoModelSerializer.serialize(instance)
+
+        bitmap = bytearray(table.bitmap_size)
+        chunks = []
+        for index, (attname, kind) in enumerate(zip(table.attnames, table.kinds)):
+            value = getattr(instance, attname)
+            if value is None:
+                bitmap[index // 8] |= 1 << (index % 8)
+                continue
+            if kind == 'int':
+                chunks.append(INT64.pack(int(value)))
+            elif kind == 'datetime':
+                chunks.append(INT64.pack(to_microseconds(value)))
+            else:
+                encoded = value.encode('utf-8')
+                chunks.append(UINT32.pack(len(encoded)))
+                chunks.append(encoded)
+        header = HEADER.pack(COMPACT_FORMAT_VERSION, table.code, len(table.attnames))
+        return header + bytes(bitmap) + b''.join(chunks)
+
+    @classmethod
+    def deserialize(cls, serialized_data):
+        if isinstance(serialized_data, str) or serialized_data[0] != COMPACT_FORMAT_VERSION:
+            return DjangoModelSerializer.deserialize(serialized_data)
+
+        cls._load_tables()
+        _, code, num_fields = HEADER.unpack_from(serialized_data)
+        table = cls._tables_by_code[code]
+        offset = HEADER.size
+        bitmap_size = (num_fields + 7) // 8
+        bitmap = serialized_data[offset: offset + bitmap_size]
+        offset += bitmap_size
+
+        values = {}
+        for index in range(num_fields):
+            attname, kind = table.attnames[index], table.kinds[index]
+            if bitmap[index // 8] & (1 << (index % 8)):
+                values[attname] = None
+                continue
+            if kind == 'str':
+                length, = UINT32.unpack_from(serialized_data, offset)
+                offset += UINT32.size
+                values[attname] = serialized_data[offset: offset + length].decode('utf-8')
+                offset += length
+                continue
+            number, = INT64.unpack_from(serialized_data, offset)
+            offset += INT64.size
+            if kind == 'datetime':
+                values[attname] = from_microseconds(number)
+            else:
+                values[attname] = number
+
+        # fields appended to the table after this entry was written stay deferred
+        return table.model_class.from_db(
+            DEFAULT_DB_ALIAS,
+            table.concrete_attnames,
+            [values.get(attname, DEFERRED) for attname in table.concrete_attnames],
+        )
+
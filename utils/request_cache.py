@@ -0,0 +1,75 @@
+import threading
+
+_local = threading.local()
+
+
+class RequestCache:
+    """
+    Per-request identity map in front of memcached.
+    RequestCacheMiddleware starts it when a request comes in and drops it when the
+    response goes out, so every key is fetched over the network at most once per request.
+    Outside a request (celery tasks, shell, service unit tests) it is inactive and
+    every method is a no-op.
+    """
+
+    @classmethod
+    def start(cls):
+        _local.store = {}
+        _local.hits = 0
+        _local.misses = 0
+
+    @classmethod
+    def stop(cls):
+        stats = cls.get_stats()
+        for attr in ('store', 'hits', 'misses'):
+            if hasattr(_local, attr):
+                delattr(_local, attr)
+        return stats
+
+    @classmethod
+    def is_active(cls):
+        return getattr(_local, 'store', None) is not None
+
+    @classmethod
+    def get_stats(cls):
+        if not cls.is_active():
+            return {'hits': 0, 'misses': 0}
+        return {'hits': _local.hits, 'misses': _local.misses}
+
+    @classmethod
+    def get(cls, key):
+        # None means miss, so None should never be stored
+        if not cls.is_active():
+            return None
+        value = _local.store.get(key)
+        if value is None:
+            _local.misses += 1
+        else:
+            _local.hits += 1
+        return value
+
+    @classmethod
+    def get_many(cls, keys):
+        if not cls.is_active():
+            return {}
+        found = {key: _local.store[key] for key in keys if key in _local.store}
+        _local.hits += len(found)
+        _local.misses += len(keys) - len(found)
+        return found
+
+    @classmethod
+    def set(cls, key, value):
+        if not cls.is_active() or value is None:
+            return
+        _local.store[key] = value
+
+    @classmethod
+    def set_many(cls, mapping):
+        for key, value in mapping.items():
+            cls.set(key, value)
+
+    @classmethod
+    def delete(cls, key):
+        if not cls.is_active():
+            return
+        _local.store.pop(key, None)
@@ -1,5 +1,36 @@
+import os
+import threading
+import time
+from io import StringIO
+
+import memcache
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models import F
+from django.test import override_settings
+
+from accounts.models import UserProfile
+from accounts.services import UserService
+from friendships.services import FriendshipService
 from testing.testcases import TestCase
+from tweets.models import Tweet
+from twitter.cache import USER_PROFILE_PATTERN, USER_TWEETS_PATTERN
+from utils.cache_generations import CacheGenerations
+from utils.cache_metrics import CacheMetrics
+from utils.compression import COMPRESSED_MARKER, Compression
+from utils.early_refresh import CacheEntry, EarlyRefresh
+from utils.hash_ring import HashRing
+from utils.local_cache import LocalCache
+from utils.memcached_backend import KetamaMemcachedClient
+from utils.memcached_helper import MemcachedHelper, cache
 from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper
+from utils.redis_scripts import RELEASE_LOCK_SCRIPT
+from utils.redis_serializers import CompactModelSerializer, DjangoModelSerializer
+from utils.request_cache import RequestCache
+from utils.time_helpers import utc_now
 
 
 class UtilsTests(TestCase):
@@ -16,4 +47,934 @@ class UtilsTests(TestCase):
 
         RedisClient.clear()
         cached_list = conn.lrange('redis_key', 0, -1)
-        self.assertEqual(cached_list, [])
\ No newline at end of file
+        self.assertEqual(cached_list, [])
+
+    def test_redis_pool_per_process(self):
+        conn = RedisClient.get_connection()
+        pools = RedisClient.pools
+        self.assertEqual(RedisClient.get_connection() is conn, True)
+        stats = RedisClient.get_pool_stats()
+        self.assertEqual(len(stats), len(settings.REDIS_NODES))
+        self.assertEqual(stats[0]['max_connections'], settings.REDIS_MAX_CONNECTIONS)
+        self.assertEqual(stats[0]['in_use'] + stats[0]['idle'], stats[0]['created'])
+
+        # as if this process had been forked, the child gets its own pools and clients
+        RedisClient.pid = -1
+        self.assertEqual(RedisClient.get_connection() is conn, False)
+        self.assertEqual(RedisClient.pools is pools, False)
+        self.assertEqual(RedisClient.get_pool_stats()[0]['created'], 0)
+
+
+class RedisShardingTests(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+        self.two_nodes = settings.REDIS_NODES + [
+            {'host': settings.REDIS_HOST, 'port': settings.REDIS_PORT, 'db': 15},
+        ]
+
+    def test_hash_ring(self):
+        ring = HashRing(['a', 'b', 'c'])
+        owners = {str(i): ring.get_node(str(i)) for i in range(1000)}
+        self.assertEqual(set(owners.values()), {'a', 'b', 'c'})
+
+        # adding a node only moves keys to the new node
+        ring = HashRing(['a', 'b', 'c', 'd'])
+        moved = 0
+        for key, owner in owners.items():
+            new_owner = ring.get_node(key)
+            self.assertEqual(new_owner in (owner, 'd'), True)
+            moved += new_owner != owner
+        self.assertEqual(100 < moved < 400, True)
+
+    def test_sharded_counters(self):
+        user = self.create_user('user1')
+        tweets = [self.create_tweet(user) for i in range(10)]
+        with override_settings(REDIS_NODES=self.two_nodes):
+            RedisClient.clear()
+            # keys of the same id live on the same node
+            self.assertEqual(
+                RedisClient.get_node('user_tweets:1'),
+                RedisClient.get_node('user_tweets:1:fill_lock'),
+            )
+            self.assertEqual(len(RedisClient.group_by_node(
+                ['Tweet.likes_count:{}'.format(tweet.id) for tweet in tweets],
+            )), 2)
+
+            for tweet in tweets:
+                RedisHelper.incr_count(tweet, 'likes_count')
+            counts = RedisHelper.get_counts(tweets, ['likes_count', 'comments_count'])
+            for tweet in tweets:
+                self.assertEqual(counts[tweet.id], {'likes_count': 1, 'comments_count': 0})
+
+            # the deltas of every node are flushed
+            self.assertEqual(RedisHelper.flush_count_deltas(Tweet, 'likes_count'), 10)
+            for tweet in tweets:
+                tweet.refresh_from_db()
+                self.assertEqual(tweet.likes_count, 1)
+            RedisClient.clear()
+
+    def test_rebalance(self):
+        user = self.create_user('user1')
+        tweets = [self.create_tweet(user) for i in range(10)]
+        for tweet in tweets:
+            RedisHelper.incr_count(tweet, 'likes_count')
+        keys = ['Tweet.likes_count:{}'.format(tweet.id) for tweet in tweets]
+
+        # a second node is added
+        with override_settings(REDIS_NODES=self.two_nodes):
+            out = StringIO()
+            call_command('rebalance_redis', stdout=out)
+            lines = out.getvalue().splitlines()
+            # the deltas are written to db before the counters move away from them
+            self.assertEqual(lines[0], '10 counters flushed')
+            self.assertEqual(lines[1].startswith('0 keys moved'), False)
+            for key in keys:
+                conn = RedisClient.get_connection(key)
+                self.assertEqual(conn.get(key), b'1')
+            self.assertEqual(RedisHelper.flush_count_deltas(Tweet, 'likes_count'), 0)
+            self.assertEqual(
+                set(Tweet.objects.filter(user=user).values_list('likes_count', flat=True)), {1},
+            )
+            RedisClient.clear()
+
+
+class KetamaMemcachedClientTests(TestCase):
+
+    def tearDown(self):
+        KetamaMemcachedClient._dead_until.clear()
+        KetamaMemcachedClient._rejoining.clear()
+
+    def test_dead_node_ejection(self):
+        # nothing listens on these ports
+        nodes = ['127.0.0.1:1', '127.0.0.1:2']
+        client = KetamaMemcachedClient(nodes, dead_retry=30, socket_timeout=0.1)
+        owner = client.get_node('key')
+        other = nodes[1] if owner == nodes[0] else nodes[0]
+
+        # a failed node is a miss, and is left out of the ring
+        self.assertEqual(client.get('key'), None)
+        self.assertEqual(client.get_node('key'), other)
+
+        # its keys go to the next node, until that one fails too
+        self.assertEqual(client.get_multi(['key', 'key2']), {})
+        self.assertEqual(client.get_node('key'), None)
+        self.assertEqual(client.set_multi({'key': 1}), [])
+
+        # written to the next node for dead_retry only
+        self.assertEqual(client._get_timeout('key', other, 0), 30)
+        self.assertEqual(client._get_timeout('key', owner, 3600), 3600)
+
+        # still down after dead_retry, ejected again
+        KetamaMemcachedClient._dead_until[owner] = 0
+        self.assertEqual(client.get_node('key') == owner, False)
+
+        # back in the ring after dead_retry, flushed before it serves again
+        class FlushedClient:
+            def __init__(self):
+                self.servers = [memcache._Host('127.0.0.1:3')]
+                self.flushes = 0
+
+            def flush_all(self):
+                self.flushes += 1
+
+        client.clients[owner] = FlushedClient()
+        KetamaMemcachedClient._dead_until[owner] = 0
+        self.assertEqual(client.get_node('key'), owner)
+        self.assertEqual(client.get_node('key'), owner)
+        self.assertEqual(client.clients[owner].flushes, 1)
+
+    def test_failure_after_dead_retry(self):
+        # a command fails on a node whose ejection has just expired
+        node = '127.0.0.1:1'
+        client = KetamaMemcachedClient([node], dead_retry=30, socket_timeout=0.1)
+
+        # memcache.Client is thread local, the thread below would not see its dead host
+        class FailedClient:
+            def __init__(self):
+                self.servers = [memcache._Host(node)]
+                self.servers[0].deaduntil = time.time() + 30
+
+        client.clients[node] = FailedClient()
+        KetamaMemcachedClient._dead_until[node] = 0
+        thread = threading.Thread(target=client._check_node, args=(node,), daemon=True)
+        thread.start()
+        thread.join(5)
+        self.assertEqual(thread.is_alive(), False)
+        self.assertGreater(KetamaMemcachedClient._dead_until[node], time.monotonic())
+
+        # the node is skipped while another thread flushes it
+        KetamaMemcachedClient._dead_until[node] = 0
+        KetamaMemcachedClient._rejoining.add(node)
+        self.assertEqual(client.get_node('key'), None)
+
+
+class MemcachedHelperTests(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+
+    def test_get_objects_through_cache(self):
+        users = [self.create_user('user{}'.format(i)) for i in range(3)]
+        ids = [users[2].id, users[0].id, users[1].id]
+
+        # cache miss, keep the input order
+        objects = MemcachedHelper.get_objects_through_cache(User, ids)
+        self.assertEqual([user.id for user in objects], ids)
+
+        # cache hit, no db query at all
+        with self.assertNumQueries(0):
+            objects = MemcachedHelper.get_objects_through_cache(User, ids)
+        self.assertEqual([user.id for user in objects], ids)
+
+        # partially cached, only one query for the misses
+        MemcachedHelper.invalidate_cached_object(User, users[0].id)
+        MemcachedHelper.invalidate_cached_object(User, users[1].id)
+        with self.assertNumQueries(1):
+            objects = MemcachedHelper.get_objects_through_cache(User, ids + [None])
+        self.assertEqual([user.id for user in objects], ids)
+
+        # ids not in db are skipped
+        objects = MemcachedHelper.get_objects_through_cache(User, [users[0].id, -1])
+        self.assertEqual([user.id for user in objects], [users[0].id])
+
+    def test_tombstone(self):
+        user = self.create_user('user1')
+        tweet = self.create_tweet(user)
+        tweet_id = tweet.id
+        tweet.delete()
+
+        # the first lookup goes to db, the following ones are answered by the tombstone
+        with self.assertNumQueries(1):
+            with self.assertRaises(Tweet.DoesNotExist):
+                MemcachedHelper.get_object_through_cache(Tweet, tweet_id)
+        with self.assertNumQueries(0):
+            with self.assertRaises(Tweet.DoesNotExist):
+                MemcachedHelper.get_object_through_cache(Tweet, tweet_id)
+            self.assertEqual(MemcachedHelper.get_objects_through_cache(Tweet, [tweet_id]), [])
+
+        # batch lookups leave tombstones as well
+        with self.assertNumQueries(1):
+            self.assertEqual(MemcachedHelper.get_objects_through_cache(User, [-1]), [])
+        with self.assertNumQueries(0):
+            self.assertEqual(MemcachedHelper.get_objects_through_cache(User, [-1]), [])
+
+        # post_save replaces the tombstone
+        tweet = Tweet.objects.create(id=tweet_id, user=user, content='back')
+        self.run_on_commit_callbacks()
+        cached = MemcachedHelper.get_object_through_cache(Tweet, tweet_id)
+        self.assertEqual(cached.content, 'back')
+
+    def test_write_through(self):
+        user = self.create_user('user1')
+        MemcachedHelper.get_object_through_cache(User, user.id)
+        user.username = 'newname'
+        user.save()
+        # not committed yet, readers keep the old row
+        with self.assertNumQueries(0):
+            cached = MemcachedHelper.get_object_through_cache(User, user.id)
+        self.assertEqual(cached.username, 'user1')
+        # written through on commit, no miss
+        self.run_on_commit_callbacks()
+        with self.assertNumQueries(0):
+            cached = MemcachedHelper.get_object_through_cache(User, user.id)
+        self.assertEqual(cached.username, 'newname')
+
+        # the value of an F() expression is only known by db
+        tweet = self.create_tweet(user)
+        self.run_on_commit_callbacks()
+        tweet.likes_count = F('likes_count') + 1
+        tweet.save()
+        with self.assertNumQueries(1):
+            MemcachedHelper.get_object_through_cache(Tweet, tweet.id)
+
+        with override_settings(CACHE_WRITE_THROUGH=False):
+            user.username = 'user1'
+            user.save()
+            with self.assertNumQueries(1):
+                cached = MemcachedHelper.get_object_through_cache(User, user.id)
+            self.assertEqual(cached.username, 'user1')
+
+    def test_write_through_then_delete(self):
+        user = self.create_user('user1')
+        tweet = self.create_tweet(user)
+        profile = UserService.get_profile_through_cache(user.id)
+        self.run_on_commit_callbacks()
+        # saved then deleted in one transaction, the hooks of the saves run at commit
+        with transaction.atomic():
+            tweet.content = 'edited'
+            tweet.save()
+            profile.nickname = 'edited'
+            profile.save()
+            tweet_id, profile_id = tweet.id, profile.id
+            tweet.delete()
+            profile.delete()
+        self.run_on_commit_callbacks()
+        with self.assertRaises(Tweet.DoesNotExist):
+            MemcachedHelper.get_object_through_cache(Tweet, tweet_id)
+        # a miss, a new profile is created
+        LocalCache.clear()
+        profile = UserService.get_profile_through_cache(user.id)
+        self.assertNotEqual(profile.id, profile_id)
+        self.assertEqual(profile.nickname, None)
+
+    def test_write_through_out_of_order(self):
+        user = self.create_user('user1')
+        profile = UserService.get_profile_through_cache(user.id)
+        self.run_on_commit_callbacks()
+        # two concurrent saves whose commit hooks run in the wrong order
+        profile.nickname = 'first'
+        profile.save()
+        profile = UserProfile.objects.get(id=profile.id)
+        profile.nickname = 'second'
+        profile.save()
+        first, second = [callback for _, callback in connection.run_on_commit]
+        connection.run_on_commit = []
+        second()
+        first()
+        LocalCache.clear()
+        self.assertEqual(UserService.get_profile_through_cache(user.id).nickname, 'second')
+
+        # the other columns of a save with update_fields may be older than db
+        profile.nickname = 'third'
+        profile.save(update_fields=['nickname'])
+        self.assertEqual(connection.run_on_commit, [])
+        with self.assertNumQueries(1):
+            self.assertEqual(UserService.get_profile_through_cache(user.id).nickname, 'third')
+
+    def test_prefetch_objects_through_cache(self):
+        user1 = self.create_user('user1')
+        user2 = self.create_user('user2')
+        tweets = [self.create_tweet(user1), self.create_tweet(user2), self.create_tweet(user1)]
+        MemcachedHelper.prefetch_objects_through_cache(tweets, User, 'user_id', '_cached_user')
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                [tweet.cached_user.id for tweet in tweets],
+                [user1.id, user2.id, user1.id],
+            )
+
+        # a missing user is not attached, the property raises like without the prefetch
+        tweet = Tweet(id=10000, user_id=-1, content='orphan')
+        MemcachedHelper.prefetch_objects_through_cache([tweet], User, 'user_id', '_cached_user')
+        with self.assertRaises(User.DoesNotExist):
+            tweet.cached_user
+
+    def test_prefetch_does_not_leak_through_request_cache(self):
+        user = self.create_user('user1')
+        tweet = self.create_tweet(user)
+        RequestCache.start()
+        try:
+            cached = MemcachedHelper.get_object_through_cache(Tweet, tweet.id)
+            MemcachedHelper.prefetch_objects_through_cache([cached], User, 'user_id', '_cached_user')
+            self.assertEqual(cached.cached_user.id, user.id)
+            # the next reader of the request gets the tweet without what was attached
+            cached = MemcachedHelper.get_objects_through_cache(Tweet, [tweet.id])[0]
+            self.assertEqual(hasattr(cached, '_cached_user'), False)
+        finally:
+            RequestCache.stop()
+
+
+class CacheMetricsTests(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+        CacheMetrics.reset()
+
+    def test_hits_and_misses_by_pattern(self):
+        users = [self.create_user('user{}'.format(i)) for i in range(2)]
+        ids = [user.id for user in users]
+        MemcachedHelper.get_objects_through_cache(User, ids)
+        MemcachedHelper.get_objects_through_cache(User, ids)
+        MemcachedHelper.get_object_through_cache(User, ids[0])
+
+        text = CacheMetrics.render()
+        self.assertIn('twitter_cache_misses_total{pattern="User"} 2', text)
+        self.assertIn('twitter_cache_hits_total{pattern="User",tier="memcached"} 3', text)
+        self.assertIn('twitter_cache_fill_seconds_count{pattern="User"} 1', text)
+        self.assertIn(
+            'twitter_cache_round_trip_seconds_count{pattern="User",backend="memcached"} 3',
+            text,
+        )
+        self.assertIn(
+            'twitter_cache_fill_seconds_bucket{pattern="User",le="+Inf"} 1',
+            text,
+        )
+
+    def test_redis_patterns(self):
+        user = self.create_user('user1')
+        tweet = self.create_tweet(user)
+        RedisHelper.get_count(tweet, 'likes_count')
+        RedisHelper.get_counts([tweet], ['likes_count', 'comments_count'])
+
+        text = CacheMetrics.render()
+        self.assertIn('twitter_cache_misses_total{pattern="Tweet.likes_count"} 1', text)
+        self.assertIn('twitter_cache_misses_total{pattern="Tweet.comments_count"} 1', text)
+        self.assertIn(
+            'twitter_cache_hits_total{pattern="Tweet.likes_count",tier="redis"} 1',
+            text,
+        )
+        # the batch MGET and back fill are timed under the same counter patterns
+        self.assertIn(
+            'twitter_cache_round_trip_seconds_count{pattern="Tweet.likes_count",backend="redis"} 2',
+            text,
+        )
+        self.assertIn(
+            'twitter_cache_round_trip_seconds_count{pattern="Tweet.comments_count",backend="redis"} 1',
+            text,
+        )
+        self.assertIn('twitter_cache_fill_seconds_count{pattern="Tweet.likes_count"} 1', text)
+        self.assertIn('twitter_cache_fill_seconds_count{pattern="Tweet.comments_count"} 1', text)
+        self.assertNotIn('Tweet.*', text)
+
+    def test_histogram_buckets_are_cumulative(self):
+        for seconds in [0.0001, 0.003, 0.003, 5]:
+            CacheMetrics._observe(CacheMetrics._fills, ('followings',), seconds)
+        text = CacheMetrics.render()
+        self.assertIn('twitter_cache_fill_seconds_bucket{pattern="followings",le="0.0005"} 1', text)
+        self.assertIn('twitter_cache_fill_seconds_bucket{pattern="followings",le="0.005"} 3', text)
+        self.assertIn('twitter_cache_fill_seconds_bucket{pattern="followings",le="1.0"} 3', text)
+        self.assertIn('twitter_cache_fill_seconds_bucket{pattern="followings",le="+Inf"} 4', text)
+
+    @override_settings(CACHE_METRICS_ENABLED=False)
+    def test_disabled(self):
+        user = self.create_user('user1')
+        MemcachedHelper.get_object_through_cache(User, user.id)
+        self.assertNotIn('pattern="User"', CacheMetrics.render())
+
+    def test_metrics_api(self):
+        url = '/api/metrics/'
+        _, client = self.create_user_and_client('user1')
+        self.assertEqual(self.anonymous_client.get(url).status_code, 403)
+        self.assertEqual(client.get(url).status_code, 403)
+
+        admin = User.objects.create_superuser('admin', 'admin@twitter.com', 'password')
+        client.force_authenticate(admin)
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn(b'# TYPE twitter_cache_hits_total counter', response.content)
+
+
+class CompressionTests(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+        CacheMetrics.reset()
+
+    def test_threshold(self):
+        data = b'x' * 100
+        self.assertIs(Compression.compress('followings', data), data)
+        with override_settings(CACHE_COMPRESSION_THRESHOLDS={'followings': 50}):
+            compressed = Compression.compress('followings', data)
+            self.assertEqual(compressed[:1], COMPRESSED_MARKER)
+            self.assertEqual(len(compressed) < len(data), True)
+            self.assertEqual(Compression.decompress('followings', compressed), data)
+            # other patterns keep the default threshold
+            self.assertIs(Compression.compress('userprofile', data), data)
+        with override_settings(CACHE_COMPRESSION_THRESHOLD=None):
+            data = b'x' * 10000
+            self.assertIs(Compression.compress('followings', data), data)
+
+    def test_incompressible(self):
+        data = os.urandom(2000)
+        self.assertIs(Compression.compress('followings', data), data)
+        self.assertIn(
+            'twitter_cache_compression_output_bytes_total{pattern="followings"} 2000',
+            CacheMetrics.render(),
+        )
+
+    def test_followings_round_trip(self):
+        # a small pickled set does not get smaller
+        users = [self.create_user('user{}'.format(i)) for i in range(30)]
+        for user in users[1:]:
+            self.create_friendship(users[0], user)
+        key = 'followings:{}'.format(users[0].id)
+        with override_settings(CACHE_COMPRESSION_THRESHOLD=1):
+            FriendshipService.get_following_user_id_set(users[0].id)
+            self.assertEqual(cache.get(key)[:1], COMPRESSED_MARKER)
+            with self.assertNumQueries(0):
+                user_id_set = FriendshipService.get_following_user_id_set(users[0].id)
+        self.assertEqual(user_id_set, {user.id for user in users[1:]})
+        # values stored uncompressed before are still read
+        cache.set(key, {users[1].id})
+        self.assertEqual(MemcachedHelper.cache_get('followings', key), {users[1].id})
+
+        text = CacheMetrics.render()
+        self.assertIn('twitter_cache_compression_input_bytes_total{pattern="followings"}', text)
+        self.assertIn(
+            'twitter_cache_compression_seconds_count{pattern="followings",operation="decompress"} 1',
+            text,
+        )
+
+    @override_settings(CACHE_COMPRESSION_THRESHOLD=1)
+    def test_redis_list(self):
+        user = self.create_user('user1')
+        tweets = [self.create_tweet(user, 'content ' * 20) for _ in range(2)]
+        RedisClient.clear()
+        key = USER_TWEETS_PATTERN.format(user_id=user.id)
+        queryset = Tweet.objects.filter(user=user).order_by('-created_at')
+        RedisHelper.load_objects(key, queryset)
+        tweets.append(self.create_tweet(user, 'content ' * 20))
+        conn = RedisClient.get_connection(key)
+        for data in conn.lrange(key, 0, -1):
+            self.assertEqual(data[:1], COMPRESSED_MARKER)
+        objects = RedisHelper.load_objects(key, queryset)
+        self.assertEqual([t.id for t in objects], [t.id for t in tweets[::-1]])
+        self.assertEqual(objects[0].content, 'content ' * 20)
+
+
+@override_settings(CACHE_EARLY_REFRESH=True)
+class EarlyRefreshTests(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+        RedisClient.clear()
+
+    def test_should_refresh(self):
+        now = time.time()
+        self.assertEqual(EarlyRefresh.should_refresh(0, now + 60), False)
+        self.assertEqual(EarlyRefresh.should_refresh(0, now - 1), True)
+        # so expensive that it is always refreshed early
+        self.assertEqual(EarlyRefresh.should_refresh(10 ** 9, now + 60), True)
+        with override_settings(CACHE_EARLY_REFRESH=False):
+            self.assertEqual(EarlyRefresh.should_refresh(0, now - 1), False)
+            self.assertEqual(EarlyRefresh.wrap('value', 0.1, 100), ('value', 100))
+
+    def test_wrap(self):
+        for _ in range(20):
+            entry, ttl = EarlyRefresh.wrap('value', 0.1, 1000)
+            self.assertEqual(900 <= ttl <= 1000, True)
+            self.assertEqual(entry.value, 'value')
+            self.assertEqual(abs(entry.expiry - time.time() - ttl) < 1, True)
+        self.assertEqual(EarlyRefresh.unwrap('plain'), ('plain', False))
+
+    def test_memcached_early_refresh(self):
+        user = self.create_user('user1')
+        key = MemcachedHelper.get_key(User, user.id)
+        MemcachedHelper.get_object_through_cache(User, user.id)
+        self.assertEqual(isinstance(MemcachedHelper.cache_get('User', key), CacheEntry), True)
+        with self.assertNumQueries(0):
+            MemcachedHelper.get_object_through_cache(User, user.id)
+
+        # about to expire, the reader recomputes it
+        User.objects.filter(id=user.id).update(username='renamed')
+        MemcachedHelper.cache_set('User', key, CacheEntry(user, 10 ** 9, time.time() + 60), None)
+        with self.assertNumQueries(1):
+            refreshed = MemcachedHelper.get_object_through_cache(User, user.id)
+        self.assertEqual(refreshed.username, 'renamed')
+
+        MemcachedHelper.cache_set('User', key, CacheEntry(user, 10 ** 9, time.time() + 60), None)
+        with self.assertNumQueries(1):
+            objects = MemcachedHelper.get_objects_through_cache(User, [user.id])
+        self.assertEqual(objects[0].username, 'renamed')
+
+    def test_redis_early_refresh(self):
+        user = self.create_user('user1')
+        self.create_tweet(user)
+        RedisClient.clear()
+        key = USER_TWEETS_PATTERN.format(user_id=user.id)
+        queryset = Tweet.objects.filter(user=user).order_by('-created_at')
+        RedisHelper.load_objects(key, queryset)
+        conn = RedisClient.get_connection(key)
+        self.assertEqual(conn.ttl(key) <= settings.REDIS_KEY_EXPIRE_TIME, True)
+        self.assertEqual(conn.exists(RedisHelper.get_cost_key(key)), 1)
+        with self.assertNumQueries(0):
+            RedisHelper.load_objects(key, queryset)
+
+        self.create_tweet(user)
+        conn.set(RedisHelper.get_cost_key(key), 10 ** 9)
+        with self.assertNumQueries(1):
+            objects = RedisHelper.load_objects(key, queryset)
+        self.assertEqual(len(objects), 2)
+
+
+class CacheGenerationsTests(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+
+    def tearDown(self):
+        CacheGenerations.clear()
+
+    def test_bump_model(self):
+        user = self.create_user('user1')
+        old_key = MemcachedHelper.get_key(User, user.id)
+        self.assertEqual(old_key, 'User:{}'.format(user.id))
+        MemcachedHelper.get_object_through_cache(User, user.id)
+
+        out = StringIO()
+        call_command('bump_cache_generation', 'User', stdout=out)
+        self.assertEqual(out.getvalue(), 'User is now at generation 1\n')
+        self.assertEqual(MemcachedHelper.get_key(User, user.id), 'User:g1:{}'.format(user.id))
+        # the whole namespace misses, the old entries are left to expire
+        with self.assertNumQueries(1):
+            MemcachedHelper.get_object_through_cache(User, user.id)
+        self.assertEqual(cache.get(old_key) is not None, True)
+
+        # other namespaces are not affected
+        self.assertEqual(MemcachedHelper.get_key(Tweet, 1), 'Tweet:1')
+
+    def test_bump_pattern(self):
+        CacheGenerations.bump('userprofile')
+        CacheGenerations.bump('userprofile')
+        key = CacheGenerations.get_pattern_key(USER_PROFILE_PATTERN, user_id=3)
+        self.assertEqual(key, 'userprofile:g2:3')
+
+        # redis keys stay on the node of their id
+        CacheGenerations.bump('user_tweets')
+        key = CacheGenerations.get_pattern_key(USER_TWEETS_PATTERN, user_id=5)
+        self.assertEqual(key, 'user_tweets:g1:5')
+        self.assertEqual(RedisClient.get_shard_key(key), '5')
+
+    def test_refresh(self):
+        self.assertEqual(CacheGenerations.get('User'), 0)
+        # bumped by another process
+        RedisClient.get_connection().incr('cache_generation:User')
+        self.assertEqual(CacheGenerations.get('User'), 0)
+        with override_settings(CACHE_GENERATION_REFRESH=0):
+            self.assertEqual(CacheGenerations.get('User'), 1)
+
+    def test_invalidate_across_generations(self):
+        user = self.create_user('user1')
+        self.assertEqual(CacheGenerations.get('User'), 0)
+        # bumped by another process, whose readers fill the new generation
+        RedisClient.get_connection().incr('cache_generation:User')
+        new_key = 'User:g1:{}'.format(user.id)
+        cache.set(new_key, user)
+        cache.set(MemcachedHelper.get_key(User, user.id), user)
+
+        # this process has not seen the bump yet, both generations are invalidated
+        MemcachedHelper.invalidate_cached_object(User, user.id)
+        self.assertEqual(cache.get(new_key), None)
+        self.assertEqual(cache.get('User:{}'.format(user.id)), None)
+        self.assertEqual(
+            MemcachedHelper.get_invalidation_keys(User, user.id),
+            [new_key, 'User:{}'.format(user.id)],
+        )
+
+
+class RequestCacheTests(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+
+    def tearDown(self):
+        RequestCache.stop()
+
+    def test_inactive_outside_request(self):
+        RequestCache.set('key', 1)
+        self.assertEqual(RequestCache.get('key'), None)
+        self.assertEqual(RequestCache.get_stats(), {'hits': 0, 'misses': 0})
+
+    def test_identity_map(self):
+        user = self.create_user('user1')
+        RequestCache.start()
+        with self.assertNumQueries(1):
+            first = MemcachedHelper.get_object_through_cache(User, user.id)
+        with self.assertNumQueries(0):
+            second = MemcachedHelper.get_object_through_cache(User, user.id)
+        # loaded once inside a request, every caller gets its own copy to attach things to
+        self.assertIsNot(first, second)
+        self.assertEqual(second.username, 'user1')
+        self.assertEqual(RequestCache.get_stats(), {'hits': 1, 'misses': 1})
+
+        # invalidation drops the request level copy as well
+        MemcachedHelper.invalidate_cached_object(User, user.id)
+        with self.assertNumQueries(1):
+            MemcachedHelper.get_object_through_cache(User, user.id)
+
+        stats = RequestCache.stop()
+        self.assertEqual(stats, {'hits': 1, 'misses': 2})
+        self.assertEqual(RequestCache.is_active(), False)
+
+
+@override_settings(LOCAL_CACHE_ENABLED=True, LOCAL_CACHE_MAX_SIZE=2)
+class LocalCacheTests(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+        LocalCache.clear()
+
+    def tearDown(self):
+        LocalCache.clear()
+
+    def test_lru(self):
+        LocalCache.set('a', 1)
+        LocalCache.set('b', 2)
+        # touch a, so b is the least recently used one
+        self.assertEqual(LocalCache.get('a'), 1)
+        LocalCache.set('c', 3)
+        self.assertEqual(LocalCache.get('b'), None)
+        self.assertEqual(LocalCache.get('a'), 1)
+        self.assertEqual(LocalCache.get('c'), 3)
+
+    def test_timeout(self):
+        with self.settings(LOCAL_CACHE_TIMEOUT=0):
+            LocalCache.set('a', 1)
+        self.assertEqual(LocalCache.get('a'), None)
+
+    def test_values_are_copies(self):
+        LocalCache.set('a', {1, 2})
+        LocalCache.get('a').add(3)
+        self.assertEqual(LocalCache.get('a'), {1, 2})
+
+    def test_invalidate_through_memcached_helper(self):
+        user = self.create_user('user1')
+        MemcachedHelper.get_object_through_cache(User, user.id)
+        key = MemcachedHelper.get_key(User, user.id)
+        self.assertEqual(LocalCache.get(key).id, user.id)
+
+        # post_save writes the new row through after commit, and drops the local copy
+        user.username = 'newname'
+        user.save()
+        self.assertEqual(LocalCache.get(key).username, 'user1')
+        self.run_on_commit_callbacks()
+        self.assertEqual(LocalCache.get(key), None)
+        self.assertEqual(
+            MemcachedHelper.get_object_through_cache(User, user.id).username,
+            'newname',
+        )
+
+
+class CompactModelSerializerTests(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+        self.user1 = self.create_user('user1')
+
+    def assertRoundTrip(self, instance, field_names):
+        data = CompactModelSerializer.serialize(instance)
+        self.assertEqual(isinstance(data, bytes), True)
+        obj = CompactModelSerializer.deserialize(data)
+        self.assertEqual(obj.__class__, instance.__class__)
+        for field_name in field_names:
+            self.assertEqual(getattr(obj, field_name), getattr(instance, field_name))
+        return obj
+
+    def test_tweet(self):
+        tweet = self.create_tweet(self.user1, '测试 unicode content')
+        tweet.likes_count = 3
+        obj = self.assertRoundTrip(tweet, [
+            'id', 'user_id', 'content', 'created_at', 'likes_count', 'comments_count',
+        ])
+        self.assertEqual(obj, tweet)
+        self.assertEqual(obj.created_at.microsecond, tweet.created_at.microsecond)
+        # same as loaded from the database
+        self.assertEqual(obj._state.adding, False)
+
+        # null values
+        tweet.user_id = None
+        tweet.likes_count = None
+        self.assertRoundTrip(tweet, ['user_id', 'likes_count', 'content'])
+
+    def test_newsfeed(self):
+        tweet = self.create_tweet(self.user1)
+        newsfeed = self.create_newsfeed(self.user1, tweet)
+        self.assertRoundTrip(newsfeed, ['id', 'user_id', 'tweet_id', 'created_at'])
+
+    def test_legacy_data(self):
+        # lists written by DjangoModelSerializer can still be read
+        tweet = self.create_tweet(self.user1)
+        data = DjangoModelSerializer.serialize(tweet).encode('utf-8')
+        obj = CompactModelSerializer.deserialize(data)
+        self.assertEqual(obj, tweet)
+        self.assertEqual(obj.content, tweet.content)
+
+
+class RedisHelperTests(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+        self.user1 = self.create_user('user1')
+        self.tweets = [self.create_tweet(self.user1) for i in range(3)][::-1]
+        RedisClient.clear()
+        self.key = USER_TWEETS_PATTERN.format(user_id=self.user1.id)
+        self.queryset = Tweet.objects.filter(user=self.user1).order_by('-created_at')
+
+    def test_load_objects(self):
+        # cache miss, one db query
+        with self.assertNumQueries(1):
+            objects = RedisHelper.load_objects(self.key, self.queryset)
+        self.assertEqual([t.id for t in objects], [t.id for t in self.tweets])
+
+        # cache hit
+        with self.assertNumQueries(0):
+            objects = RedisHelper.load_objects(self.key, self.queryset)
+        self.assertEqual([t.id for t in objects], [t.id for t in self.tweets])
+
+        # filling twice does not duplicate the list
+        RedisHelper._load_objects_to_cache(self.key, list(self.queryset))
+        conn = RedisClient.get_connection()
+        self.assertEqual(conn.llen(self.key), 3)
+        self.assertEqual(conn.exists(RedisHelper.get_fill_lock_key(self.key)), 0)
+
+    def test_wait_for_filler(self):
+        # another process is rebuilding the list
+        conn = RedisClient.get_connection()
+        lock_key = RedisHelper.get_fill_lock_key(self.key)
+        conn.set(lock_key, 'someone else')
+        objects = list(self.queryset)
+
+        def fill():
+            RedisHelper._load_objects_to_cache(self.key, objects)
+            conn.delete(lock_key)
+
+        timer = threading.Timer(0.05, fill)
+        timer.start()
+        with self.assertNumQueries(0):
+            loaded = RedisHelper.load_objects(self.key, self.queryset)
+        timer.join()
+        self.assertEqual([t.id for t in loaded], [t.id for t in self.tweets])
+
+    def test_push_object(self):
+        conn = RedisClient.get_connection()
+        new_tweet = Tweet(id=10000, user=self.user1, content='pushed')
+        new_tweet.created_at = self.tweets[0].created_at
+
+        # key does not exist, rebuild from db instead of pushing
+        RedisClient.clear()
+        with self.assertNumQueries(1):
+            RedisHelper.push_object(self.key, new_tweet, self.queryset)
+        self.assertEqual(conn.llen(self.key), 3)
+
+        # key exists, pushed to the head and ttl refreshed
+        conn.persist(self.key)
+        with self.assertNumQueries(0):
+            RedisHelper.push_object(self.key, new_tweet, self.queryset)
+        objects = RedisHelper.load_objects(self.key, self.queryset)
+        self.assertEqual(objects[0].id, new_tweet.id)
+        self.assertEqual(len(objects), 4)
+        self.assertEqual(conn.ttl(self.key) > 0, True)
+
+    def test_push_object_while_filling(self):
+        conn = RedisClient.get_connection()
+        new_tweet = Tweet(id=10000, user=self.user1, content='pushed')
+        new_tweet.created_at = self.tweets[0].created_at
+        lock_key = RedisHelper.get_fill_lock_key(self.key)
+        # another process is rebuilding the list from a query that predates the tweet
+        objects = list(self.queryset)
+        conn.set(lock_key, 'someone else')
+
+        def fill():
+            RedisHelper._load_objects_to_cache(self.key, objects)
+            conn.delete(lock_key)
+
+        timer = threading.Timer(0.05, fill)
+        timer.start()
+        with self.assertNumQueries(0):
+            RedisHelper.push_object(self.key, new_tweet, self.queryset)
+        timer.join()
+        objects = RedisHelper.load_objects(self.key, self.queryset)
+        self.assertEqual([t.id for t in objects], [new_tweet.id] + [t.id for t in self.tweets])
+
+        # the filler wrote the tweet already, it is not pushed twice
+        conn.set(lock_key, 'someone else')
+        objects = [new_tweet] + list(self.queryset)
+        timer = threading.Timer(0.05, fill)
+        timer.start()
+        RedisHelper.push_object(self.key, new_tweet, self.queryset)
+        timer.join()
+        self.assertEqual(conn.llen(self.key), 4)
+
+        # the filler did not finish in time, the list is dropped
+        conn.set(lock_key, 'someone else')
+        with override_settings(REDIS_FILL_LOCK_TIMEOUT=0.05):
+            self.assertEqual(RedisHelper.push_objects([(self.key, new_tweet)]), 0)
+        self.assertEqual(conn.exists(self.key), 0)
+
+    def test_fill_many(self):
+        user2 = self.create_user('user2')
+        user3 = self.create_user('user3')
+        tweet2 = self.create_tweet(user2)
+        keys = [USER_TWEETS_PATTERN.format(user_id=user.id) for user in [self.user1, user2, user3]]
+        querysets = {
+            key: Tweet.objects.filter(user=user).order_by('-created_at')
+            for key, user in zip(keys, [self.user1, user2, user3])
+        }
+        RedisClient.clear()
+        # someone else is filling user2, user1 is already cached
+        conn = RedisClient.get_connection(keys[1])
+        conn.set(RedisHelper.get_fill_lock_key(keys[1]), 'someone else')
+        RedisHelper.load_objects(self.key, self.queryset)
+        conn.lpush(self.key, 'unchanged')
+
+        # script cache on the server was flushed, the locks are still released
+        conn.script_flush()
+        self.assertEqual(RedisHelper.fill_many(querysets), {})
+        self.assertEqual(conn.lindex(self.key, 0), b'unchanged')
+
+        conn.delete(RedisHelper.get_fill_lock_key(keys[1]))
+        filled = RedisHelper.fill_many(querysets)
+        # user3 has no tweet, nothing to cache
+        self.assertEqual(list(filled.keys()), [keys[1]])
+        self.assertEqual([t.id for t in filled[keys[1]]], [tweet2.id])
+        with self.assertNumQueries(0):
+            objects = RedisHelper.load_objects(keys[1], querysets[keys[1]])
+        self.assertEqual([t.id for t in objects], [tweet2.id])
+        for key in keys:
+            self.assertEqual(conn.exists(RedisHelper.get_fill_lock_key(key)), 0)
+
+        # index mode
+        index_key = 'user_tweets_index:{}'.format(user2.id)
+        filled = RedisHelper.fill_many({index_key: querysets[keys[1]]}, index=True)
+        self.assertEqual([row[0] for row in filled[index_key]], [tweet2.id])
+        self.assertEqual(RedisHelper.load_object_ids(index_key, querysets[keys[1]]), [tweet2.id])
+
+    def test_warm_caches(self):
+        user2 = self.create_user('user2')
+        self.create_friendship(user2, self.user1)
+        for user in [self.user1, user2]:
+            self.create_newsfeed(user, self.tweets[0])
+        User.objects.filter(id__in=[self.user1.id, user2.id]).update(last_login=utc_now())
+        # redis restarted
+        RedisClient.clear()
+
+        out = StringIO()
+        call_command('warm_caches', '--concurrency=1', '--batch-size=1', stdout=out)
+        self.assertIn('2/2 users', out.getvalue())
+        # tweets of user1, newsfeeds of user1 and user2
+        self.assertIn('warmed 2 users, 3 lists filled', out.getvalue())
+        conn = RedisClient.get_connection(self.key)
+        self.assertEqual(conn.llen(self.key), 3)
+        self.assertEqual(
+            conn.get(RedisHelper.get_count_key(self.tweets[0], 'likes_count')),
+            b'0',
+        )
+
+        # everything is warm already
+        out = StringIO()
+        call_command('warm_caches', '--concurrency=1', stdout=out)
+        self.assertIn('warmed 2 users, 0 lists filled', out.getvalue())
+
+    def test_run_script_sha_cached(self):
+        conn = RedisClient.get_connection()
+        conn.set('lock', 'token')
+        RedisClient.run_script(RELEASE_LOCK_SCRIPT, keys=['lock'], args=['other'])
+        self.assertEqual(conn.get('lock'), b'token')
+        self.assertEqual(RELEASE_LOCK_SCRIPT in RedisClient.script_shas, True)
+
+        # server side script cache flushed
+        conn.script_flush()
+        RedisClient.run_script(RELEASE_LOCK_SCRIPT, keys=['lock'], args=['token'])
+        self.assertEqual(conn.get('lock'), None)
+
+    def test_get_counts(self):
+        conn = RedisClient.get_connection()
+        Tweet.objects.filter(id=self.tweets[0].id).update(likes_count=2)
+        attrs = ['likes_count', 'comments_count']
+
+        # all missed, one query to back fill
+        with self.assertNumQueries(1):
+            counts = RedisHelper.get_counts(self.tweets, attrs)
+        self.assertEqual(counts[self.tweets[0].id], {'likes_count': 2, 'comments_count': 0})
+        self.assertEqual(counts[self.tweets[1].id], {'likes_count': 0, 'comments_count': 0})
+        key = RedisHelper.get_count_key(self.tweets[0], 'likes_count')
+        self.assertEqual(conn.ttl(key) > 0, True)
+
+        # all hit
+        with self.assertNumQueries(0):
+            RedisHelper.prefetch_counts(self.tweets, attrs)
+        conn.delete(key)
+        # prefetched counts are used without going to redis
+        self.assertEqual(RedisHelper.get_count(self.tweets[0], 'likes_count'), 2)
+        self.assertEqual(conn.exists(key), 0)
@@ -1,5 +1,21 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import pytz
 
 def utc_now():
-    return datetime.now().replace(tzinfo=pytz.utc)
\ No newline at end of file
+    return datetime.now().replace(tzinfo=pytz.utc)
+
+
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+
+def to_microseconds(dt):
+    # integer microseconds since epoch, used as sorted set score.
+    # a float timestamp would lose the microseconds and break ties of created_at
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=pytz.utc)
+    delta = dt - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def from_microseconds(microseconds):
+    return EPOCH + timedelta(microseconds=microseconds)
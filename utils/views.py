@@ -0,0 +1,14 @@
+from django.http import HttpResponse
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
+
+from utils.cache_metrics import CacheMetrics
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def metrics(request):
+    # cache metrics of the worker process that serves this request
+    return HttpResponse(CacheMetrics.render(), content_type=PROMETHEUS_CONTENT_TYPE)